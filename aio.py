@@ -0,0 +1,129 @@
+'''
+Asyncio versions of the data access functions in main.py, on SQLAlchemy's async engine
+
+Each caller (e.g. each request of a GUI or network front end) uses its own session from 'AsyncSession', so
+callers wait for the database without blocking the event loop or each other. The queries are the same
+statement builders main.py uses. Changes run the same functions as main.py through 'AsyncSession.run_sync()',
+so they keep the stock totals, the caches and the export tracking up to date in the same way.
+
+Needs an async driver: aiosqlite for SQLite or asyncpg for PostgreSQL ('SQLALCHEMY_DATABASE_URI' is used
+with the driver replaced, e.g. 'sqlite:///inventory.db' becomes 'sqlite+aiosqlite:///inventory.db').
+
+Usage:
+    session_factory = await aio.db_init()
+    async with session_factory() as session:
+        deficits = await aio.deficit_stock(session)
+'''
+import logging
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+import main
+import instrumentation
+from cache import reference_cache
+
+# The async driver for each database
+DRIVERS = {
+    'sqlite': 'aiosqlite',
+    'postgresql': 'asyncpg',
+}
+
+# Sessions are not expired on commit: their objects can't lazy-load in async code
+AsyncSession = async_sessionmaker(expire_on_commit=False, sync_session_class=main.Session.class_)
+
+
+def _async_url(database):
+    '''Returns the database URL with the async driver for that database'''
+    url = make_url(database)
+    backend = url.get_backend_name()
+    if backend not in DRIVERS:
+        raise ValueError(f"No async driver known for '{backend}' databases")
+    return url.set(drivername=f'{backend}+{DRIVERS[backend]}')
+
+
+async def db_init(database=None):
+    '''
+    Set the async engine up and bring the database up to date, the same way as 'main.db_init()'
+
+    Parameters:
+        database (str): The database URL (default: 'SQLALCHEMY_DATABASE_URI', or 'main.DEFAULT_DATABASE')
+
+    Returns:
+        The session factory ('AsyncSession'), bound to the new engine
+    '''
+    database = database or main._database_url()
+    logging.info("Initialising async database.")
+    engine = create_async_engine(_async_url(database), echo=False)
+    main._sqlite_profile(engine.sync_engine)
+    instrumentation.instrument(engine.sync_engine)
+    AsyncSession.configure(bind=engine)
+    async with AsyncSession() as session:
+        await session.run_sync(main._prepare_database)
+        # Storage rows name their location from the cache, which can't be loaded lazily in async code
+        await session.run_sync(reference_cache.load)
+    return AsyncSession
+
+
+async def list_stock(session, item_id=None, exclude_empty=True):
+    '''Async version of 'main.list_stock()': the storage rows (with their item loaded)'''
+    return (await session.scalars(main._stock_select(item_id, exclude_empty))).all()
+
+
+async def list_items_with_stock_count(session, item_id=None, exclude_empty=True):
+    '''Async version of 'main.list_items_with_stock_count()': list of tuples (Item, stockCount)'''
+    result = await session.execute(main._items_with_stock_select(item_id, exclude_empty))
+    return [tuple(row) for row in result]
+
+
+async def stock_view(session, item_id=None, location_id=None, expired=False, exclude_empty=True, order_by='item',
+                     group_by=None):
+    '''Async version of 'main.stock_view()': list of StockRow, or with group_by a dict of those lists'''
+    result = await session.execute(
+        main._stock_view_select(item_id, location_id, expired, exclude_empty, group_by or order_by))
+    return main._stock_rows(result, group_by)
+
+
+async def stock_as_of(session, moment, item_id=None, location_id=None):
+    '''Async version of 'main.stock_as_of()': dict of the portions by (item_id, location_id)'''
+    return await session.run_sync(main.stock_as_of, moment, item_id=item_id, location_id=location_id)
+
+
+async def deficit_stock(session):
+    '''Async version of 'main.deficit_stock()': list of tuples (item_name, item_id, number_missing)'''
+    await session.execute(main._zero_stock_delete())
+    return [tuple(row) for row in await session.execute(main._deficits_select())]
+
+
+async def expired_stock(session):
+    '''Async version of 'main.expired_stock()': the storage rows past their date (with their item loaded)'''
+    await session.execute(main._zero_stock_delete())
+    return (await session.scalars(main._expired_select())).all()
+
+
+async def check_item_stock(session, repair=False):
+    '''Async version of 'main.check_item_stock()': the ids of the items whose stock totals are off'''
+    return await session.run_sync(main.check_item_stock, repair=repair)
+
+
+async def add_item(session, name, group, item_id=None, **kwargs):
+    '''Async version of 'main.add_item()': tuple (item, created)'''
+    return await session.run_sync(main.add_item, name, group, item_id=item_id, **kwargs)
+
+
+async def add_to_stock(session, item_id, location_id, portions, expiration_date=None, default_expiry_days=None,
+                       commit=True):
+    '''Async version of 'main.add_to_stock()', never asks for an expiry date: returns the new storage row'''
+    return await session.run_sync(main.add_to_stock, item_id, location_id, portions,
+                                  expiration_date=expiration_date, interactive=False,
+                                  default_expiry_days=default_expiry_days, commit=commit)
+
+
+async def remove_from_stock(session, item_id, portions, strategy='fefo', location_id=None, delete_empty=False,
+                            commit=True):
+    '''Async version of 'main.remove_from_stock()': list of Allocation, in the order taken'''
+    return await session.run_sync(main.remove_from_stock, item_id, portions, strategy=strategy,
+                                  location_id=location_id, delete_empty=delete_empty, commit=commit)
+
+
+async def item_export_changes(session, file='item_status.json'):
+    '''Async version of 'main._item_export_changes()': the number of items exported'''
+    return await session.run_sync(main._item_export_changes, file=file)
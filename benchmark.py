@@ -0,0 +1,683 @@
+'''
+Benchmarks for PAI, run against a temporary SQLite database with synthetic data
+
+Usage:
+    python benchmark.py plans [--items N] [--rows N]
+    python benchmark.py menu [--items N] [--rows N] [--rounds N]
+    python benchmark.py startup [--runs N]
+    python benchmark.py loadtest [--database URL] [--clients N] [--seconds N]
+    python benchmark.py concurrency [--seconds N] [--writes FRACTION]
+    python benchmark.py logging [--rounds N]
+    python benchmark.py suite [--items N] [--rows N] [--runs N] [--output FILE] [--baseline FILE] [--threshold FRACTION]
+    python benchmark.py history [--items N] [--rows N [N ...]] [--queries N]
+    python benchmark.py forecast [--items N] [--rows N] [--runs N]
+'''
+import os
+import sys
+import json
+import logging
+import time
+import statistics
+import subprocess
+import threading
+import http.client
+import argparse
+import contextlib
+import random
+import tempfile
+import timeit
+import tracemalloc
+import datetime as dt
+import sqlalchemy as db
+from sqlalchemy import func
+from sqlalchemy.orm import Session, sessionmaker
+from models import Base, Item, Storage, ItemGroup, ContainerType, Location, StockMovement
+import datagen
+
+DEFAULTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'default_values.json')
+
+
+def _temp_engine(directory):
+    '''Returns an engine for a new SQLite database file in directory'''
+    return db.create_engine('sqlite:///' + os.path.join(directory, 'benchmark.db'))
+
+
+def _populate(session, items, rows, seed=42):
+    '''Fills an empty database with a synthetic household (see datagen.py)'''
+    return datagen.generate(session, items, rows, seed, defaults=DEFAULTS)
+
+
+def _hot_queries(items):
+    '''The filtered queries the application issues most often, by name'''
+    today = dt.date.today()
+    return {
+        'stock by item': db.select(Storage).where(Storage.item_id == items // 2, Storage.portions > 0),
+        'expired stock': db.select(Storage).where(Storage.expiration_date < today, Storage.portions > 0),
+        'item by name': db.select(Item).where(func.upper(Item.name) == 'ORGANIC CHICKEN'),
+        'items by group': db.select(Item).where(Item.group_id == 3),
+        'stock totals': db.select(Storage.item_id, func.sum(Storage.portions)).where(
+            Storage.item_id.in_(range(1, 50)), Storage.portions > 0).group_by(Storage.item_id),
+    }
+
+
+def _measure(connection, queries, number):
+    '''Returns {name: (query plan, milliseconds per execution)}'''
+    results = {}
+    for name, stmt in queries.items():
+        sql = str(stmt.compile(connection, compile_kwargs={'literal_binds': True}))
+        plan = '; '.join(row[-1] for row in connection.exec_driver_sql('EXPLAIN QUERY PLAN ' + sql))
+        seconds = timeit.timeit(lambda: connection.exec_driver_sql(sql).all(), number=number)
+        results[name] = (plan, 1000 * seconds / number)
+    return results
+
+
+def bench_plans(args):
+    '''Compares the query plans and timings of the hot queries without and with the secondary indexes'''
+    with tempfile.TemporaryDirectory() as directory:
+        engine = _temp_engine(directory)
+        Base.metadata.create_all(engine)
+        indexes = [index for table in Base.metadata.sorted_tables for index in table.indexes
+                   if not index.unique]
+        with engine.begin() as connection:
+            for index in indexes:
+                index.drop(connection)
+        with Session(engine) as session:
+            _populate(session, args.items, args.rows)
+
+        queries = _hot_queries(args.items)
+        with engine.connect() as connection:
+            before = _measure(connection, queries, args.number)
+            for index in indexes:
+                index.create(connection)
+            connection.exec_driver_sql('ANALYZE')
+            after = _measure(connection, queries, args.number)
+        engine.dispose()
+
+    print(f"{args.items} items, {args.rows} storage rows")
+    for name in queries:
+        print(f"\n{name}: {before[name][1]:.3f} ms -> {after[name][1]:.3f} ms")
+        print(f"  without indexes: {before[name][0]}")
+        print(f"  with indexes:    {after[name][0]}")
+
+
+def bench_menu(args):
+    '''Drives the menu with scripted input, the time per screen and the memory use should not grow with the rounds'''
+    import main
+    with tempfile.TemporaryDirectory() as directory:
+        engine = _temp_engine(directory)
+        Base.metadata.create_all(engine)
+        with Session(engine) as session:
+            _populate(session, args.items, args.rows)
+        main.Session.configure(bind=engine)
+
+        # The menu exports the items when it quits
+        cwd = os.getcwd()
+        os.chdir(directory)
+        try:
+            for rounds in (max(1, args.rounds // 10), args.rounds):
+                tracemalloc.start()
+                start = time.perf_counter()
+                with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                    shown = main.menu(main.Session(), inputs=['2', 'L', 'D', ''] * rounds + ['0'])
+                seconds = time.perf_counter() - start
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                print(f"{rounds} rounds: {shown} screens, {1000 * seconds / shown:.3f} ms per screen, "
+                      f"peak memory {peak / 1e6:.1f} MB")
+        finally:
+            os.chdir(cwd)
+            engine.dispose()
+
+
+def bench_startup(args):
+    '''Starts PAI in a new process against the same database: the first (new database) and the later start-ups'''
+    basedir = os.path.abspath(os.path.dirname(__file__))
+    script = 'import json, main; main.db_init(); print(json.dumps(main.startup_timings))'
+    with tempfile.TemporaryDirectory() as directory:
+        env = dict(os.environ, SQLALCHEMY_DATABASE_URI='sqlite:///' + os.path.join(directory, 'startup.db'))
+        runs = []
+        for _ in range(args.runs + 1):
+            start = time.perf_counter()
+            output = subprocess.run([sys.executable, '-c', script], cwd=basedir, env=env,
+                                    capture_output=True, text=True, check=True).stdout
+            timings = json.loads(output.splitlines()[-1])
+            timings['process'] = round(1000 * (time.perf_counter() - start), 1)
+            runs.append(timings)
+
+    def show(label, timings):
+        print(f"{label}: " + ', '.join(f"{step} {ms:.1f} ms" for step, ms in timings.items()))
+
+    show('new database', runs[0])
+    show(f"median of {args.runs} later start-ups",
+         {step: statistics.median(run[step] for run in runs[1:]) for step in runs[0]})
+
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))] if values else 0
+
+
+def _client(port, items, deadline, seed, latencies, statuses):
+    '''One client of the load test: reads the lists (conditionally, like a browser) and changes the stock'''
+    rnd = random.Random(seed)
+    connection = http.client.HTTPConnection('127.0.0.1', port)
+    etags = {}
+    while time.perf_counter() < deadline:
+        draw = rnd.random()
+        body = None
+        if draw < 0.5:
+            method, path = 'GET', '/stock'
+        elif draw < 0.7:
+            method, path = 'GET', '/deficits'
+        elif draw < 0.75:
+            method, path = 'GET', f'/items/{rnd.randint(1, items)}'
+        elif draw < 0.8:
+            # The search index is shared by the request threads
+            method, path = 'GET', '/items?q=' + rnd.choice(('organic', 'stor', 'small', 'spicy'))
+        else:
+            method, path = 'POST', rnd.choice(('/stock/add', '/stock/remove'))
+            body = json.dumps({'item': rnd.randint(1, items), 'portions': 1})
+        headers = {'Content-Type': 'application/json'}
+        if path in etags:
+            headers['If-None-Match'] = etags[path]
+        start = time.perf_counter()
+        connection.request(method, path, body=body, headers=headers)
+        response = connection.getresponse()
+        response.read()
+        latencies.append(time.perf_counter() - start)
+        statuses[response.status] = statuses.get(response.status, 0) + 1
+        if response.getheader('ETag'):
+            etags[path] = response.getheader('ETag')
+    connection.close()
+
+
+def bench_loadtest(args):
+    '''Requests per second and latencies of the HTTP service (server.py) with concurrent clients'''
+    import main
+    import server
+    # e.g. removals of items that ran out are expected
+    logging.disable(logging.WARNING)
+    with tempfile.TemporaryDirectory() as directory:
+        database = args.database or 'sqlite:///' + os.path.join(directory, 'loadtest.db')
+        engine = db.create_engine(database)
+        Base.metadata.create_all(engine)
+        with Session(engine) as session:
+            _populate(session, args.items, args.rows)
+        engine.dispose()
+
+        os.environ['SQLALCHEMY_DATABASE_URI'] = database
+        service = server.create_server(port=0)
+        threading.Thread(target=service.serve_forever, daemon=True).start()
+
+        latencies = []
+        statuses = {}
+        deadline = time.perf_counter() + args.seconds
+        clients = [threading.Thread(target=_client, args=(service.server_port, args.items, deadline, n,
+                                                          latencies, statuses))
+                   for n in range(args.clients)]
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        service.shutdown()
+        service.server_close()
+        main.Session.kw['bind'].dispose()
+
+    print(f"{db.engine.make_url(database).get_backend_name()}, {args.clients} clients, {args.seconds} s: "
+          f"{len(latencies) / args.seconds:.0f} requests/s, p50 {1000 * _percentile(latencies, 0.5):.1f} ms, "
+          f"p99 {1000 * _percentile(latencies, 0.99):.1f} ms, status codes {dict(sorted(statuses.items()))}")
+
+
+def _worker(sessions, write_queue, items, deadline, writes, seed, latencies, errors):
+    '''One client of the concurrency benchmark: reads the stock and, now and then, changes it'''
+    import main
+    rnd = random.Random(seed)
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        try:
+            if rnd.random() < writes:
+                item_id = rnd.randint(1, items)
+                if rnd.random() < 0.5:
+                    change = lambda session: main.add_to_stock(session, item_id, 1, 1, interactive=False)
+                else:
+                    change = lambda session: main.remove_from_stock(session, item_id, 1)
+                if write_queue:
+                    write_queue.run(change)
+                else:
+                    with sessions() as session:
+                        change(session)
+            else:
+                with sessions() as session:
+                    session.execute(main._items_with_stock_select()).all()
+                    session.execute(main._deficits_select()).all()
+        except db.exc.OperationalError as e:
+            errors.append(str(e.orig))
+        latencies.append(time.perf_counter() - start)
+
+
+def bench_concurrency(args):
+    '''Throughput with 1, 4 and 16 clients on a SQLite file: SQLite's defaults against WAL plus one writer thread'''
+    import main
+    from writer import WriteQueue
+    logging.disable(logging.WARNING)
+    for profile in ('default', 'wal + writer'):
+        for clients in args.clients:
+            with tempfile.TemporaryDirectory() as directory:
+                engine = _temp_engine(directory)
+                if profile != 'default':
+                    main._sqlite_profile(engine)
+                Base.metadata.create_all(engine)
+                sessions = sessionmaker(bind=engine)
+                with sessions() as session:
+                    _populate(session, args.items, args.rows)
+                write_queue = WriteQueue(sessions).start() if profile != 'default' else None
+
+                latencies = []
+                errors = []
+                deadline = time.perf_counter() + args.seconds
+                workers = [threading.Thread(target=_worker, args=(sessions, write_queue, args.items, deadline,
+                                                                  args.writes, n, latencies, errors))
+                           for n in range(clients)]
+                for worker in workers:
+                    worker.start()
+                for worker in workers:
+                    worker.join()
+                if write_queue:
+                    write_queue.stop()
+                engine.dispose()
+
+            print(f"{profile:>12}, {clients:>2} clients: {len(latencies) / args.seconds:7.0f} operations/s, "
+                  f"p99 {1000 * _percentile(latencies, 0.99):7.1f} ms, {len(errors)} errors"
+                  f"{' (' + errors[0] + ')' if errors else ''}")
+
+
+def _stock_changes(session, items, rounds, seed=1):
+    '''The logged hot path: puts one portion of an item in stock and takes it out again, rounds times'''
+    import main
+    rnd = random.Random(seed)
+    for _ in range(rounds):
+        item_id = rnd.randint(1, items)
+        main.add_to_stock(session, item_id, 1, 1, interactive=False)
+        main.remove_from_stock(session, item_id, 1)
+
+
+def bench_logging(args):
+    '''
+    The cost of the logging: the stock changes with the log level at INFO and DEBUG against logging switched off,
+    and a log call through the queue of 'setup()' against writing to the log file directly
+    '''
+    import main
+    from logging.handlers import RotatingFileHandler
+    with tempfile.TemporaryDirectory() as directory:
+        # The log goes to the temporary directory
+        cwd = os.getcwd()
+        os.chdir(directory)
+        try:
+            main.setup(directory)
+            engine = _temp_engine(directory)
+            main._sqlite_profile(engine)
+            Base.metadata.create_all(engine)
+            with Session(engine) as session:
+                _populate(session, args.items, args.rows)
+            main.Session.configure(bind=engine)
+            queries = []
+            db.event.listen(engine, 'after_cursor_execute', lambda *_: queries.append(1))
+
+            root = logging.getLogger()
+            for label, level in (('off', None), ('INFO', logging.INFO), ('DEBUG', logging.DEBUG)):
+                logging.disable(logging.CRITICAL if level is None else logging.NOTSET)
+                root.setLevel(level or logging.INFO)
+                with main.Session() as session:
+                    _stock_changes(session, args.items, 5)
+                    queries.clear()
+                    start = time.perf_counter()
+                    _stock_changes(session, args.items, args.rounds)
+                    seconds = time.perf_counter() - start
+                print(f"logging {label:>5}: {1000 * seconds / args.rounds:.3f} ms and "
+                      f"{len(queries) / args.rounds:.1f} queries per stock change")
+            logging.disable(logging.NOTSET)
+            root.setLevel(logging.INFO)
+
+            # A debug message at INFO level: formatted right away (with the row's repr) against deferred
+            with main.Session() as session:
+                row = session.scalars(db.select(Storage).limit(1)).one()
+                for label, log in (('f-string', lambda: logging.debug(f"Storage updated: {row}")),
+                                   ('deferred', lambda: logging.debug("Storage updated: %s", row))):
+                    queries.clear()
+                    seconds = 0
+                    for _ in range(args.rounds):
+                        # As after a commit: the next attribute access reloads the row
+                        session.expire(row)
+                        start = time.perf_counter()
+                        log()
+                        seconds += time.perf_counter() - start
+                    print(f"debug message at INFO, {label}: {1e6 * seconds / args.rounds:.1f} us and "
+                          f"{len(queries) / args.rounds:.1f} queries per message")
+
+            number = 20000
+            queued = timeit.timeit(lambda: logging.info("Removed %s portions of item %s", 1, 2), number=number)
+            direct = RotatingFileHandler(os.path.join(directory, 'direct.log'), maxBytes=256000, backupCount=10)
+            direct.setFormatter(logging.Formatter('%(asctime)s %(levelname)s: %(message)s'))
+            handlers = root.handlers[:]
+            root.handlers[:] = [direct]
+            try:
+                unqueued = timeit.timeit(lambda: logging.info("Removed %s portions of item %s", 1, 2), number=number)
+            finally:
+                root.handlers[:] = handlers
+                direct.close()
+            print(f"log call: {1e6 * queued / number:.1f} us through the queue, "
+                  f"{1e6 * unqueued / number:.1f} us writing the file directly")
+        finally:
+            os.chdir(cwd)
+            engine.dispose()
+
+
+def _definitions(session, extra_limit=0):
+    '''The items in the format of '_quick_init()' (raw_data.json), with extra_limit added to the minimum limits'''
+    definitions = {}
+    for name, name_dk, group, container, min_limit, duration in session.query(
+            Item.name, Item.name_dk, ItemGroup.name, ContainerType.name, Item.min_limit, Item.standard_duration).join(
+            ItemGroup, Item.group_id == ItemGroup.id).outerjoin(ContainerType, Item.type_id == ContainerType.id):
+        definitions.setdefault(group, []).append({'name_en': name, 'name_da': name_dk, 'container_type': container,
+                                                  'minimum_limit': min_limit + extra_limit,
+                                                  'standard_duration': duration})
+    return definitions
+
+
+def _suite_functions(directory):
+    '''
+    The functions timed by the suite, by name: each is called with a new session and may leave changes behind
+
+    '_quick_init()' and '_item_import()' switch between two versions of their file with different minimum
+    limits, so every run updates all the items instead of finding nothing changed.
+    '''
+    import main
+    with main.Session() as session:
+        versions = {}
+        for extra in (1, 0):
+            definitions = os.path.join(directory, f'definitions{extra}.json')
+            with open(definitions, 'w', encoding='utf-8') as f:
+                json.dump(_definitions(session, extra), f, ensure_ascii=False)
+            export = os.path.join(directory, f'export{extra}.json')
+            records = list(main._item_status_records(session))
+            for record in records:
+                record['min_limit'] += extra
+            with open(export, 'w', encoding='utf-8') as f:
+                json.dump(records, f, ensure_ascii=False)
+            versions[extra] = (definitions, export)
+    runs = {'quick_init': 0, 'import': 0}
+
+    def quick_init(session):
+        definitions = versions[runs['quick_init'] % 2][0]
+        runs['quick_init'] += 1
+        return main._quick_init(session, definitions)
+
+    def item_import(session):
+        # The import renames its file, so it gets a copy
+        export = versions[runs['import'] % 2][1]
+        runs['import'] += 1
+        copy = os.path.join(directory, 'import.json')
+        with open(export, 'rb') as source, open(copy, 'wb') as target:
+            target.write(source.read())
+        return main._item_import(session, copy)
+
+    return {
+        'list_stock': main.list_stock,
+        'stock_view': main.stock_view,
+        'list_items_with_stock_count': main.list_items_with_stock_count,
+        # Their clean-up of the used-up rows is rolled back afterwards, so every run has the same rows
+        'deficit_stock': main.deficit_stock,
+        'expired_stock': main.expired_stock,
+        '_quick_init': quick_init,
+        '_item_import': item_import,
+        '_item_export': lambda session: main._item_export(session, file=os.path.join(directory, 'export.json')),
+    }
+
+
+def _compare(results, baseline, threshold):
+    '''Prints the results against the baseline, returns the names of the functions that got slower than threshold'''
+    regressions = []
+    for name, result in results.items():
+        line = f"{name:>28}: median {result['median_ms']:9.1f} ms, min {result['min_ms']:9.1f} ms"
+        before = baseline.get(name)
+        if before:
+            change = result['median_ms'] / before['median_ms'] - 1
+            line += f", baseline {before['median_ms']:9.1f} ms ({change:+.0%})"
+            if change > threshold:
+                regressions.append(name)
+                line += ' REGRESSION'
+        print(line)
+    return regressions
+
+
+def bench_suite(args):
+    '''
+    Times the core functions against a synthetic household and saves the results as JSON
+
+    Every function runs with a new session; the changes of the listing functions are rolled back. With
+    --baseline the results are compared against an earlier results file and the exit code is 1 if any
+    function got slower by more than --threshold.
+    '''
+    import main
+    logging.disable(logging.WARNING)
+    with tempfile.TemporaryDirectory() as directory:
+        engine = _temp_engine(directory)
+        main._sqlite_profile(engine)
+        Base.metadata.create_all(engine)
+        start = time.perf_counter()
+        with Session(engine) as session:
+            household = _populate(session, args.items, args.rows, args.seed)
+        print(f"Generated {household} in {time.perf_counter() - start:.1f} s")
+        main.Session.configure(bind=engine)
+
+        functions = _suite_functions(directory)
+        timings = {name: [] for name in functions}
+        for _ in range(args.runs):
+            for name, function in functions.items():
+                with main.Session() as session:
+                    start = time.perf_counter()
+                    function(session)
+                    timings[name].append(1000 * (time.perf_counter() - start))
+                    session.rollback()
+        engine.dispose()
+
+    results = {name: {'median_ms': round(statistics.median(values), 2), 'min_ms': round(min(values), 2),
+                      'runs': len(values)} for name, values in timings.items()}
+    report = {'meta': {'items': args.items, 'rows': args.rows, 'seed': args.seed, 'runs': args.runs,
+                       'python': sys.version.split()[0], 'sqlalchemy': db.__version__,
+                       'date': dt.datetime.now().isoformat(timespec='seconds')},
+              'results': results}
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=4)
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if (baseline['meta']['items'], baseline['meta']['rows']) != (args.items, args.rows):
+            print(f"Note: the baseline has {baseline['meta']['items']} items and {baseline['meta']['rows']} rows")
+        baseline = baseline['results']
+    regressions = _compare(results, baseline, args.threshold)
+    print(f"Results saved to '{args.output}'")
+    if regressions:
+        print(f"Slower than the baseline by more than {args.threshold:.0%}: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+def bench_history(args):
+    '''
+    Times point-in-time stock queries on households with a longer and longer history
+
+    'stock_as_of()' adds a checkpoint and at most 'PAI_CHECKPOINT_MOVEMENTS' movements up, so its time should
+    stay about the same as the ledger grows, unlike adding up all the movements before the date.
+    '''
+    import main
+    logging.disable(logging.WARNING)
+    rnd = random.Random(args.seed)
+    names = ('as of: all', 'as of: item', 'as of: location', 'history: 90 days', 'full replay')
+    print(f"{'movements':>10} " + ' '.join(f"{name:>16}" for name in names) + '  (median ms)')
+    for rows in args.rows:
+        with tempfile.TemporaryDirectory() as directory:
+            engine = _temp_engine(directory)
+            main._sqlite_profile(engine)
+            Base.metadata.create_all(engine)
+            with Session(engine) as session:
+                household = _populate(session, args.items, rows, args.seed)
+                last = session.scalar(db.select(func.max(StockMovement.id)))
+                hot_item = session.scalar(db.select(StockMovement.item_id).group_by(StockMovement.item_id).order_by(
+                    func.count(StockMovement.id).desc()).limit(1))
+                fridge = session.scalar(db.select(Location.id).where(Location.name == 'Fridge'))
+                timings = {name: [] for name in names}
+                for _ in range(args.queries):
+                    # The day of a random movement, so the dates are spread like the history itself
+                    day = session.scalar(db.select(StockMovement.timestamp).where(
+                        StockMovement.id == rnd.randint(1, last))).date()
+                    end = dt.datetime.combine(day, dt.time.max)
+                    for name, function in zip(names, (
+                            lambda: main.stock_as_of(session, day),
+                            lambda: main.stock_as_of(session, day, item_id=hot_item),
+                            lambda: main.stock_as_of(session, day, location_id=fridge),
+                            lambda: main.stock_history(session, hot_item, days=90),
+                            lambda: session.execute(db.select(
+                                StockMovement.item_id, StockMovement.location_id, func.sum(StockMovement.delta)).where(
+                                StockMovement.timestamp <= end).group_by(
+                                StockMovement.item_id, StockMovement.location_id)).all())):
+                        start = time.perf_counter()
+                        function()
+                        timings[name].append(1000 * (time.perf_counter() - start))
+            engine.dispose()
+        print(f"{household['movements']:>10} " +
+              ' '.join(f"{statistics.median(timings[name]):>16.1f}" for name in names))
+    return 0
+
+
+def bench_forecast(args):
+    '''
+    Times the consumption forecast of all items on a synthetic household
+
+    The first forecast reads the removals of the longest window, a repeated one comes from the cache, and after a
+    new movement only today is read again. A loop with one query per item is timed for comparison.
+    '''
+    import main
+    import forecast
+    logging.disable(logging.WARNING)
+    with tempfile.TemporaryDirectory() as directory:
+        engine = _temp_engine(directory)
+        main._sqlite_profile(engine)
+        Base.metadata.create_all(engine)
+        with Session(engine) as session:
+            household = _populate(session, args.items, args.rows, args.seed)
+        print(f"{household['items']} items, {household['movements']} movements")
+        main.Session.configure(bind=engine)
+
+        timings = {'first forecast': [], 'cached': [], 'after a new movement': [], 'one query per item': []}
+        with main.Session() as session:
+            since = dt.datetime.combine(dt.date.today() - dt.timedelta(89), dt.time())
+            busiest = session.scalar(db.select(StockMovement.item_id).where(StockMovement.source == 'remove').group_by(
+                StockMovement.item_id).order_by(func.count(StockMovement.id).desc()).limit(1))
+            for _ in range(args.runs):
+                forecast.clear_cache()
+                for name in ('first forecast', 'cached'):
+                    start = time.perf_counter()
+                    result = forecast.forecast(session)
+                    timings[name].append(1000 * (time.perf_counter() - start))
+                main.remove_from_stock(session, busiest, 1)
+                start = time.perf_counter()
+                forecast.forecast(session)
+                timings['after a new movement'].append(1000 * (time.perf_counter() - start))
+
+            start = time.perf_counter()
+            for item_id in result:
+                session.scalar(db.select(func.sum(StockMovement.delta)).where(
+                    StockMovement.item_id == item_id, StockMovement.source == 'remove',
+                    StockMovement.timestamp >= since))
+            timings['one query per item'].append(1000 * (time.perf_counter() - start))
+        engine.dispose()
+
+    for name, values in timings.items():
+        print(f"{name:>21}: median {statistics.median(values):9.1f} ms, min {min(values):9.1f} ms")
+    running_out = sum(entry.run_out is not None and entry.run_out <= dt.date.today() + dt.timedelta(14)
+                      for entry in result.values())
+    print(f"{running_out} items run out within 14 days")
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks for PAI')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    plans = commands.add_parser('plans', help='query plans with and without the secondary indexes')
+    plans.add_argument('--items', type=int, default=2000)
+    plans.add_argument('--rows', type=int, default=100000)
+    plans.add_argument('--number', type=int, default=20,
+                       help='executions per query')
+    plans.set_defaults(func=bench_plans)
+
+    menu = commands.add_parser('menu', help='the menu loop driven by scripted input')
+    menu.add_argument('--items', type=int, default=200)
+    menu.add_argument('--rows', type=int, default=2000)
+    menu.add_argument('--rounds', type=int, default=2000,
+                      help='times the deficits are listed (more than the recursion limit)')
+    menu.set_defaults(func=bench_menu)
+
+    startup = commands.add_parser('startup', help='start-up time, split up by step')
+    startup.add_argument('--runs', type=int, default=5)
+    startup.set_defaults(func=bench_startup)
+
+    loadtest = commands.add_parser('loadtest', help='requests per second and latencies of the HTTP service')
+    loadtest.add_argument('--database', help='an empty database to use, e.g. a local PostgreSQL '
+                                             '(default: a temporary SQLite file)')
+    loadtest.add_argument('--items', type=int, default=500)
+    loadtest.add_argument('--rows', type=int, default=5000)
+    loadtest.add_argument('--clients', type=int, default=8)
+    loadtest.add_argument('--seconds', type=float, default=10)
+    loadtest.set_defaults(func=bench_loadtest)
+
+    concurrency = commands.add_parser('concurrency', help='SQLite throughput with concurrent clients')
+    concurrency.add_argument('--clients', type=int, nargs='+', default=[1, 4, 16])
+    concurrency.add_argument('--items', type=int, default=500)
+    concurrency.add_argument('--rows', type=int, default=5000)
+    concurrency.add_argument('--seconds', type=float, default=5)
+    concurrency.add_argument('--writes', type=float, default=0.2,
+                             help='the fraction of the operations that change the stock')
+    concurrency.set_defaults(func=bench_concurrency)
+
+    logs = commands.add_parser('logging', help='the cost of the logging at INFO and DEBUG level')
+    logs.add_argument('--items', type=int, default=500)
+    logs.add_argument('--rows', type=int, default=5000)
+    logs.add_argument('--rounds', type=int, default=1000)
+    logs.set_defaults(func=bench_logging)
+
+    suite = commands.add_parser('suite', help='time the core functions on a synthetic household, save as JSON')
+    suite.add_argument('--items', type=int, default=10000)
+    suite.add_argument('--rows', type=int, default=1000000)
+    suite.add_argument('--seed', type=int, default=42)
+    suite.add_argument('--runs', type=int, default=5)
+    suite.add_argument('--output', default='benchmark_results.json')
+    suite.add_argument('--baseline', help='an earlier results file to compare against')
+    suite.add_argument('--threshold', type=float, default=0.2,
+                       help='the slow-down (as a fraction of the baseline) counted as a regression')
+    suite.set_defaults(func=bench_suite)
+
+    history = commands.add_parser('history', help='point-in-time stock queries as the ledger grows')
+    history.add_argument('--items', type=int, default=1000)
+    history.add_argument('--rows', type=int, nargs='+', default=[100000, 300000, 1000000],
+                         help='storage rows per household (about two movements each)')
+    history.add_argument('--seed', type=int, default=42)
+    history.add_argument('--queries', type=int, default=20, help='random dates per household')
+    history.set_defaults(func=bench_history)
+
+    forecasting = commands.add_parser('forecast', help='the consumption forecast of all items')
+    forecasting.add_argument('--items', type=int, default=10000)
+    forecasting.add_argument('--rows', type=int, default=1000000)
+    forecasting.add_argument('--seed', type=int, default=42)
+    forecasting.add_argument('--runs', type=int, default=5)
+    forecasting.set_defaults(func=bench_forecast)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,215 @@
+'''
+In-memory caches in front of small or frequently read tables
+
+The caches are shared by all threads (e.g. the request threads of server.py), so each guards its data with a lock:
+a reader never sees a table or index halfway through a reload or a change.
+'''
+import logging
+import threading
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from models import Barcode, ItemGroup, ContainerType, Location, _upsert
+
+
+def _run_pending(session):
+    for apply in session.info.pop('cache_pending', []):
+        apply()
+
+
+def _drop_pending(session, previous_transaction):
+    session.info.pop('cache_pending', None)
+
+
+def _after_commit(session, apply):
+    '''Calls apply() once the session's current transaction is committed (and forgets it on a rollback)'''
+    if not event.contains(session, 'after_commit', _run_pending):
+        event.listen(session, 'after_commit', _run_pending)
+        event.listen(session, 'after_soft_rollback', _drop_pending)
+    session.info.setdefault('cache_pending', []).append(apply)
+
+
+class BarcodeIndex:
+    '''
+    Barcode to item_id lookups from memory, so a burst of scans doesn't cost a query per scan
+
+    The index is loaded once with 'load()'; barcodes should then be changed through 'associate()',
+    'associate_many()' and 'remove()' so the index stays consistent with the 'barcode' table.
+    '''
+
+    def __init__(self):
+        self._items = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.loaded = False
+
+    @staticmethod
+    def _normalise(code):
+        return str(code).strip()
+
+    def load(self, session):
+        '''(Re)load all barcodes from the database with one query'''
+        # Under the lock, so a change committed meanwhile is not lost when the new index replaces the old one
+        with self._lock:
+            self._items = dict(session.query(Barcode.barcode, Barcode.item_id))
+            self.loaded = True
+            count = len(self._items)
+        logging.info("Loaded %s barcodes into the barcode index", count)
+        return count
+
+    def lookup(self, code):
+        '''Returns the item_id for the barcode, or None if the barcode is unknown'''
+        code = self._normalise(code)
+        with self._lock:
+            item_id = self._items.get(code)
+            if item_id is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return item_id
+
+    def __contains__(self, code):
+        return self._normalise(code) in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def associate(self, session, code, item_id, commit=True):
+        '''Associate a barcode with an item (moving it if it belonged to another item)'''
+        return self.associate_many(session, [(code, item_id)], commit=commit)
+
+    def associate_many(self, session, pairs, commit=True):
+        '''
+        Associate many barcodes with existing items in one batched upsert
+
+        Parameters:
+            pairs (list): (barcode, item_id) tuples
+            commit (boolean): Whether to commit, otherwise the index is updated when the caller commits
+
+        Returns:
+            The number of barcodes associated
+        '''
+        mapping = {self._normalise(code): item_id for code, item_id in pairs}
+        if not mapping:
+            return 0
+        _upsert(session, Barcode, [{'barcode': code, 'item_id': item_id}
+                                   for code, item_id in mapping.items()])
+        self._apply(session, lambda: self._items.update(mapping), commit)
+        logging.info("Associated %s barcodes with items", len(mapping))
+        return len(mapping)
+
+    def remove(self, session, code, commit=True):
+        '''Delete a barcode, returns whether it existed'''
+        code = self._normalise(code)
+        deleted = session.query(Barcode).filter(Barcode.barcode == code).delete(
+            synchronize_session='fetch')
+        self._apply(session, lambda: self._items.pop(code, None), commit)
+        return deleted > 0
+
+    def _apply(self, session, change, commit):
+        def locked_change():
+            with self._lock:
+                change()
+        if commit:
+            session.commit()
+            locked_change()
+        else:
+            _after_commit(session, locked_change)
+
+    def stats(self):
+        '''Returns the size of the index and the hit/miss statistics of the lookups'''
+        with self._lock:
+            barcodes, hits, misses = len(self._items), self.hits, self.misses
+        lookups = hits + misses
+        return {'barcodes': barcodes,
+                'hits': hits,
+                'misses': misses,
+                'hit_rate': hits / lookups if lookups else None}
+
+
+class ReferenceCache:
+    '''
+    Name/id maps of the small reference tables (item groups, container types and locations)
+
+    Name lookups are case-insensitive. A table is (re)loaded with one query the first time it is needed after
+    any write to it; writes through a session are noticed through session events. Other processes writing to
+    these tables are not noticed - call 'invalidate()' if that matters.
+    '''
+    MODELS = (ItemGroup, ContainerType, Location)
+
+    def __init__(self):
+        # (ids by upper case name, names by id) of each table, replaced as a whole when it is reloaded
+        self._tables = {}
+        self._stale = set(self.MODELS)
+        # Reentrant: the query of a reload can flush the session, whose events invalidate
+        self._lock = threading.RLock()
+
+    def load(self, session, models=MODELS):
+        '''(Re)load the given tables, one query each'''
+        with self._lock:
+            for model in models:
+                rows = session.query(model.id, model.name).order_by(model.id).all()
+                self._tables[model] = ({name.upper(): model_id for model_id, name in rows}, dict(rows))
+                self._stale.discard(model)
+        return None
+
+    def invalidate(self, model=None):
+        '''Mark a table (or all tables) to be reloaded on the next lookup'''
+        with self._lock:
+            self._stale.update(self.MODELS if model is None else [model])
+
+    def _get(self, session, model):
+        with self._lock:
+            if model in self._stale:
+                self.load(session, [model])
+            return self._tables[model]
+
+    def id_of(self, session, model, name):
+        '''Returns the id of the row with that name (in any case), or None'''
+        if name is None:
+            return None
+        return self._get(session, model)[0].get(name.upper())
+
+    def name_of(self, session, model, model_id):
+        '''Returns the name of the row with that id, or None'''
+        return self._get(session, model)[1].get(model_id)
+
+    def names(self, session, model):
+        '''Returns the {id: name} of all rows, in the order of their ids'''
+        return dict(self._get(session, model)[1])
+
+
+# Process-wide instances
+barcode_index = BarcodeIndex()
+reference_cache = ReferenceCache()
+
+
+@event.listens_for(Session, 'after_flush')
+def _reference_flush(session, flush_context):
+    '''Session event: invalidate the reference tables changed by a flush'''
+    for instance in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(instance, ReferenceCache.MODELS):
+            reference_cache.invalidate(type(instance))
+            session.info['reference_changed'] = True
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def _reference_execute(orm_execute_state):
+    '''Session event: invalidate the reference tables changed by bulk statements'''
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        mapper = orm_execute_state.bind_mapper
+        if mapper is not None and mapper.class_ in ReferenceCache.MODELS:
+            reference_cache.invalidate(mapper.class_)
+            orm_execute_state.session.info['reference_changed'] = True
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _reference_rollback(session, previous_transaction):
+    '''Session event: rows loaded after an uncommitted change may be gone now'''
+    if session.info.pop('reference_changed', False):
+        reference_cache.invalidate()
+
+
+@event.listens_for(Session, 'after_commit')
+def _reference_commit(session):
+    session.info.pop('reference_changed', None)
@@ -0,0 +1,361 @@
+'''
+Non-interactive command line for PAI, for scripts and cron jobs
+
+Every command calls the same functions as the menu, but never asks for input. Only commands that change
+something export the changed items afterwards, and '--json' prints the result as JSON instead of text.
+
+Usage:
+    python cli.py [--json] stock list [--item ITEM] [--rows]
+    python cli.py [--json] stock add ITEM PORTIONS [--location NAME] [--expires YYYY-MM-DD] [--default-expiry-days N]
+    python cli.py [--json] stock remove ITEM PORTIONS [--strategy fefo|fifo|location] [--location NAME]
+    python cli.py [--json] stock check [--repair]
+    python cli.py [--json] stock as-of YYYY-MM-DD [--item ITEM] [--location NAME]
+    python cli.py [--json] stock history ITEM [--days N] [--location NAME]
+    python cli.py [--json] deficits
+    python cli.py [--json] forecast [--item ITEM] [--within DAYS]
+    python cli.py [--json] expired
+    python cli.py [--json] import FILE [--dry-run]
+    python cli.py [--json] export [FILE] [--ndjson] [--changes]
+    python cli.py [--json] batch [FILE]
+
+ITEM is an item id, a barcode or the (case-insensitive) name of an item. 'batch' reads one 'stock add' or
+'stock remove' command per line (from FILE or stdin, '#' starts a comment) and runs them all in one
+transaction: if any of them fails, nothing is changed. 'python main.py <command> ...' does the same.
+'''
+import os
+import sys
+import json
+import shlex
+import logging
+import argparse
+import contextlib
+import datetime as dt
+from sqlalchemy import func
+import main
+import forecast
+import instrumentation
+from cache import barcode_index, reference_cache
+from models import Item, ItemGroup, ContainerType, Location
+
+
+class CommandError(Exception):
+    '''A command that can't be carried out, e.g. an unknown item or location'''
+
+
+def _resolve_item(session, text):
+    '''Returns the id of the item with that id, barcode or name'''
+    text = text.strip()
+    if text.isdigit() and session.get(Item, int(text)) is not None:
+        return int(text)
+    if not barcode_index.loaded:
+        barcode_index.load(session)
+    item_id = barcode_index.lookup(text)
+    if item_id is not None:
+        return item_id
+    # The same name can be in several groups (or containers)
+    matches = session.query(Item.id, ItemGroup.name, ContainerType.name).outerjoin(
+        ItemGroup, Item.group_id == ItemGroup.id).outerjoin(ContainerType, Item.type_id == ContainerType.id).filter(
+        func.upper(Item.name) == text.upper()).order_by(Item.id).all()
+    if not matches:
+        raise CommandError(f"Unknown item '{text}'")
+    if len(matches) > 1:
+        candidates = ', '.join(f"{item_id} ({group}{', ' + container if container else ''})"
+                               for item_id, group, container in matches)
+        raise CommandError(f"'{text}' matches several items: {candidates} - give the item id instead")
+    return matches[0][0]
+
+
+def _resolve_location(session, name):
+    '''Returns the id of the location with that name, None if no name is given'''
+    if name is None:
+        return None
+    location_id = reference_cache.id_of(session, Location, name)
+    if location_id is None:
+        raise CommandError(f"Unknown location '{name}'")
+    return location_id
+
+
+def _date(text):
+    '''argparse type for YYYY-MM-DD dates'''
+    try:
+        return dt.date.fromisoformat(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"'{text}' is not a date (YYYY-MM-DD)")
+
+
+def _storage_record(row):
+    '''The JSON record of a StockRow'''
+    return row._asdict()
+
+
+# The commands: each returns (result, text lines) - the result is what '--json' prints
+
+def stock_list(session, args):
+    item_id = _resolve_item(session, args.item) if args.item else None
+    if args.rows:
+        rows = main.stock_view(session, item_id=item_id)
+        return [_storage_record(row) for row in rows], [row.get_row(prefix='  ') for row in rows]
+    stock = main.list_items_with_stock_count(session, item_id=item_id)
+    result = [{'item_id': item.id, 'name': item.get_name(), 'portions': count, 'min_limit': item.min_limit}
+              for item, count in stock]
+    return result, [f"  {item.get_info(short=True)}: {count} portions" for item, count in stock] or \
+        ["The stock is currently empty!"]
+
+
+def stock_add(session, args, commit=True):
+    item_id = _resolve_item(session, args.item)
+    location_id = _resolve_location(session, args.location)
+    row = main.add_to_stock(session, item_id, location_id, args.portions, expiration_date=args.expires,
+                            interactive=False, default_expiry_days=args.default_expiry_days, commit=commit)
+    result = {'storage_id': row.id, 'item_id': item_id, 'portions': row.portions,
+              'expiration_date': row.expiration_date}
+    return result, [f"Added {row.portions} portions of item {item_id} (expires: {row.expiration_date})"]
+
+
+def stock_remove(session, args, commit=True):
+    item_id = _resolve_item(session, args.item)
+    location_id = _resolve_location(session, args.location)
+    if args.strategy == 'location' and location_id is None:
+        raise CommandError("The 'location' strategy needs --location")
+    plan = main.remove_from_stock(session, item_id, args.portions, strategy=args.strategy,
+                                  location_id=location_id, commit=commit)
+    taken = sum(allocation.taken for allocation in plan)
+    result = {'item_id': item_id, 'requested': args.portions, 'taken': taken,
+              'allocations': [allocation._asdict() for allocation in plan]}
+    lines = [f"Took {taken} of {args.portions} portions of item {item_id}"]
+    lines += [f"  {allocation.taken} from storage row {allocation.storage_id} (expires: {allocation.expiration_date}), "
+              f"{allocation.remaining} left" for allocation in plan]
+    return result, lines
+
+
+def stock_check(session, args):
+    mismatches = main.check_item_stock(session, repair=args.repair)
+    result = {'mismatches': mismatches, 'repaired': bool(args.repair and mismatches)}
+    if not mismatches:
+        return result, ["All stock totals match the storage rows."]
+    return result, [f"The stock totals of {len(mismatches)} items do not match their storage rows: {mismatches}"] + \
+        (["Stock totals rebuilt."] if args.repair else [])
+
+
+def stock_as_of(session, args):
+    item_id = _resolve_item(session, args.item) if args.item else None
+    location_id = _resolve_location(session, args.location)
+    stock = main.stock_as_of(session, args.date, item_id=item_id, location_id=location_id)
+    names = dict(session.query(Item.id, Item.name).filter(Item.id.in_({key[0] for key in stock})))
+    result = [{'item_id': key[0], 'name': names.get(key[0]), 'portions': portions,
+               'location': reference_cache.name_of(session, Location, key[1])}
+              for key, portions in sorted(stock.items(), key=lambda entry: names.get(entry[0][0], ''))]
+    return result, [f"  {record['name']} (id: {record['item_id']}) in {record['location']}: "
+                    f"{record['portions']} portions" for record in result] or \
+        [f"The stock was empty on {args.date}"]
+
+
+def stock_history(session, args):
+    item_id = _resolve_item(session, args.item)
+    history = main.stock_history(session, item_id, days=args.days,
+                                 location_id=_resolve_location(session, args.location))
+    result = [{'date': day, 'portions': portions, 'added': added, 'taken': taken}
+              for day, portions, added, taken in history]
+    return result, [f"  {day}: {portions} portions (+{added} -{taken})" for day, portions, added, taken in history]
+
+
+def deficits(session, args):
+    rows = main.deficit_stock(session)
+    result = [{'item_id': item_id, 'name': name, 'missing': missing} for name, item_id, missing in rows]
+    return result, [f"Item: {name} (id: {item_id}) is missing {missing} portions." for name, item_id, missing in rows] or \
+        ["Currently no deficits - all items meet minimum limits"]
+
+
+def forecasts(session, args):
+    try:
+        if args.item:
+            entries = [forecast.forecast(session)[_resolve_item(session, args.item)]]
+        else:
+            entries = forecast.running_out(session, within=args.within)
+    except ImportError as e:
+        raise CommandError(str(e))
+    items = {item_id: (name, min_limit) for item_id, name, min_limit in session.query(
+        Item.id, Item.name, Item.min_limit).filter(Item.id.in_([entry.item_id for entry in entries]))}
+    result = [{'item_id': entry.item_id, 'name': items[entry.item_id][0], 'portions': entry.stock,
+               'per_day': entry.rate, 'run_out': entry.run_out, 'min_limit': items[entry.item_id][1],
+               'suggested_min_limit': entry.min_limit} for entry in entries]
+    return result, [f"  {record['name']} (id: {record['item_id']}): {record['portions']} portions, "
+                    f"{record['per_day']} per day, runs out: {record['run_out'] or 'not in use'} - "
+                    f"min limit {record['min_limit']} (suggested: {record['suggested_min_limit']})"
+                    for record in result] or [f"Nothing runs out within {args.within} days"]
+
+
+def expired(session, args):
+    rows = main.stock_view(session, expired=True, order_by='expiry')
+    return [_storage_record(row) for row in rows], [row.get_row(prefix='  ') for row in rows] or \
+        ["Nothing has expired yet"]
+
+
+def item_import(session, args):
+    # The dry run prints the changes, keep them out of the JSON
+    with contextlib.redirect_stdout(sys.stderr) if args.json else contextlib.nullcontext():
+        result = main._item_import(session, args.file, dry_run=args.dry_run)
+    if result is None:
+        raise CommandError(f"Could not open '{args.file}'")
+    return result, [f"{'Dry run' if args.dry_run else 'Imported'} '{args.file}': {result}"]
+
+
+def item_export(session, args):
+    if args.changes:
+        count = main._item_export_changes(session, file=args.file)
+    else:
+        count = main._item_export(session, file=args.file, ndjson=args.ndjson)
+    return {'file': args.file, 'items': count}, [f"Exported {count} items to '{args.file}'"]
+
+
+def batch(session, args):
+    '''Runs the 'stock add'/'stock remove' lines of the file in one transaction'''
+    parser = _parser(batch_only=True)
+    results = []
+    lines = []
+    with open(args.file, encoding='utf-8') if args.file else contextlib.nullcontext(sys.stdin) as f:
+        try:
+            for number, line in enumerate(f, 1):
+                words = shlex.split(line, comments=True)
+                if not words:
+                    continue
+                try:
+                    operation = parser.parse_args(words)
+                except SystemExit:
+                    raise CommandError(f"Line {number}: invalid command '{line.strip()}'")
+                try:
+                    result, text = operation.func(session, operation, commit=False)
+                except CommandError as e:
+                    raise CommandError(f"Line {number}: {e}")
+                results.append(result)
+                lines += text
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+    logging.info("Batch of %s operations committed", len(results))
+    return results, lines + [f"{len(results)} operations committed"]
+
+
+def _parser(batch_only=False):
+    '''
+    Builds the argument parser
+
+    Parameters:
+        batch_only (boolean): Only the commands that can be part of a batch (those that change the stock)
+    '''
+    parser = argparse.ArgumentParser(prog='pai', description='Python Assisted Inventory (PAI)')
+    if not batch_only:
+        parser.add_argument('--json', action='store_true', help='print the result as JSON')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    stock = commands.add_parser('stock', help='list or change the stock').add_subparsers(
+        dest='action', required=True)
+
+    add = stock.add_parser('add', help='put portions of an item in stock')
+    add.add_argument('item', help='item id, barcode or name')
+    add.add_argument('portions', type=int)
+    add.add_argument('--location', help='location name')
+    add.add_argument('--expires', type=_date,
+                     help="expiry date (default: the item's standard duration)")
+    add.add_argument('--default-expiry-days', type=int, default=os.environ.get('PAI_DEFAULT_EXPIRY_DAYS'),
+                     help='days until expiry for items without a standard duration (default: no expiry date)')
+    add.set_defaults(func=stock_add, writes=True)
+
+    remove = stock.add_parser('remove', help='take portions of an item out of stock')
+    remove.add_argument('item', help='item id, barcode or name')
+    remove.add_argument('portions', type=int)
+    remove.add_argument('--strategy', choices=['fefo', 'fifo', 'location'], default='fefo')
+    remove.add_argument('--location', help="location name (for the 'location' strategy)")
+    remove.set_defaults(func=stock_remove, writes=True)
+
+    if batch_only:
+        return parser
+
+    listing = stock.add_parser('list', help='items in stock with their portions')
+    listing.add_argument('--item', help='only this item (id, barcode or name)')
+    listing.add_argument('--rows', action='store_true', help='list the storage rows instead')
+    listing.set_defaults(func=stock_list, writes=False)
+
+    check = stock.add_parser('check', help='check the stock totals against the storage rows')
+    check.add_argument('--repair', action='store_true', help='rebuild the totals that are off')
+    check.set_defaults(func=stock_check, writes=True)
+
+    as_of = stock.add_parser('as-of', help='the stock at the end of a past day, from the ledger')
+    as_of.add_argument('date', type=_date)
+    as_of.add_argument('--item', help='only this item (id, barcode or name)')
+    as_of.add_argument('--location', help='only this location')
+    as_of.set_defaults(func=stock_as_of, writes=False)
+
+    history = stock.add_parser('history', help='the stock of an item per day, with what was added and taken')
+    history.add_argument('item', help='item id, barcode or name')
+    history.add_argument('--days', type=int, default=90)
+    history.add_argument('--location', help='only this location')
+    history.set_defaults(func=stock_history, writes=False)
+
+    commands.add_parser('deficits', help='items below their minimum limit').set_defaults(
+        func=deficits, writes=False)
+    commands.add_parser('expired', help='stock past its expiry date').set_defaults(
+        func=expired, writes=False)
+
+    forecasting = commands.add_parser('forecast', help='items running out at their recent use (needs numpy)')
+    forecasting.add_argument('--item', help='only this item (id, barcode or name), whenever it runs out')
+    forecasting.add_argument('--within', type=int, default=14, help='days ahead (default: 14)')
+    forecasting.set_defaults(func=forecasts, writes=False)
+
+    importing = commands.add_parser('import', help='update items from an exported file')
+    importing.add_argument('file')
+    importing.add_argument('--dry-run', action='store_true', help='only list the changes')
+    importing.set_defaults(func=item_import, writes=True)
+
+    export = commands.add_parser('export', help='export the items and their stock')
+    export.add_argument('file', nargs='?', default='item_status.json')
+    export.add_argument('--ndjson', action='store_true', help='one item per line')
+    export.add_argument('--changes', action='store_true',
+                        help="only append the changed items to '<file>.delta'")
+    export.set_defaults(func=item_export, writes=False)
+
+    batching = commands.add_parser('batch', help="run many 'stock add/remove' lines in one transaction")
+    batching.add_argument('file', nargs='?', help='file with one command per line (default: stdin)')
+    batching.set_defaults(func=batch, writes=True)
+
+    return parser
+
+
+def _print(result, lines, as_json):
+    if as_json:
+        json.dump(result, sys.stdout, ensure_ascii=False, indent=2, default=str)
+        print()
+    else:
+        for line in lines:
+            print(line)
+
+
+def run(argv=None):
+    '''
+    Runs one command line
+
+    Returns:
+        The exit code: 0 if it went well, 1 if the command failed
+    '''
+    args = _parser().parse_args(argv)
+    main.setup(main.basedir)
+    session = main.db_init()
+    try:
+        with instrumentation.operation(f"cli: {args.command}"):
+            result, lines = args.func(session, args)
+        if args.writes and (main._exported_changes['all'] or main._exported_changes['items']):
+            main._item_export_changes(session)
+    except CommandError as e:
+        logging.error("Command '%s' failed: %s", args.command, e)
+        print(f"pai: {e}", file=sys.stderr)
+        return 1
+    finally:
+        session.close()
+        logging.info('** Program closing down!')
+    _print(result, lines, args.json)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(run())
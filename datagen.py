@@ -0,0 +1,196 @@
+'''
+Synthetic households for benchmarks: items spread over the groups, containers and locations of
+'default_values.json', with a few years of storage history
+
+Most storage rows are history (used up, 0 portions); the recent ones are in stock, some past their expiry date.
+Every purchase and use is in the stock movement ledger (with its checkpoints), in the order it happened.
+A few items are bought much more often than the rest, like in a real household.
+
+Usage:
+    python datagen.py [--items N] [--rows N] [--seed N]    (fills the empty database of SQLALCHEMY_DATABASE_URI)
+'''
+import sys
+import json
+import heapq
+import random
+import itertools
+import logging
+import argparse
+import datetime as dt
+from collections import Counter
+import sqlalchemy as db
+from models import Item, Storage, ItemGroup, ContainerType, Location, StockMovement
+import ledger
+
+# Base names per item group (English, Danish), combined with the variants below
+FOODS = {
+    'basics': [('salt', 'salt'), ('sugar', 'sukker'), ('flour', 'mel'), ('oil', 'olie'), ('vinegar', 'eddike'),
+               ('paper towel', 'køkkenrulle'), ('soap', 'sæbe'), ('coffee', 'kaffe'), ('tea', 'te')],
+    'beverages': [('juice', 'juice'), ('soda', 'sodavand'), ('beer', 'øl'), ('wine', 'vin'), ('milk', 'mælk'),
+                  ('water', 'vand')],
+    'fastfood': [('pizza', 'pizza'), ('lasagne', 'lasagne'), ('burger', 'burger'), ('spring rolls', 'forårsruller'),
+                 ('fries', 'pommes frites'), ('nuggets', 'nuggets')],
+    'grains': [('rice', 'ris'), ('pasta', 'pasta'), ('oats', 'havregryn'), ('bread', 'brød'), ('couscous', 'couscous'),
+               ('noodles', 'nudler')],
+    'meat': [('chicken', 'kylling'), ('minced beef', 'hakket oksekød'), ('pork chops', 'svinekoteletter'),
+             ('sausages', 'pølser'), ('salmon', 'laks'), ('mackerel', 'makrel'), ('ham', 'skinke')],
+    'toppings': [('ketchup', 'ketchup'), ('mustard', 'sennep'), ('jam', 'marmelade'), ('mayonnaise', 'mayonnaise'),
+                 ('pesto', 'pesto'), ('honey', 'honning')],
+    'vegetables': [('peas', 'ærter'), ('carrots', 'gulerødder'), ('tomatoes', 'tomater'), ('corn', 'majs'),
+                   ('beans', 'bønner'), ('spinach', 'spinat'), ('broccoli', 'broccoli')],
+}
+VARIANTS = [('', ''), ('organic', 'økologisk'), ('large', 'stor'), ('small', 'lille'), ('spicy', 'stærk'),
+            ('light', 'light'), ('family pack', 'familiepakke'), ('extra', 'ekstra')]
+
+# Typical days before expiry per item group (None: doesn't expire)
+DURATIONS = {'basics': None, 'beverages': 180, 'fastfood': 90, 'grains': 365, 'meat': 5, 'toppings': 120,
+             'vegetables': 7}
+
+
+def _read_defaults(file):
+    with open(file, encoding='utf-8') as json_file:
+        data = json.load(json_file)
+    return [name.capitalize() for name in data['itemgroups']], [name.capitalize() for name in data['containertypes']], \
+        [name.capitalize() for name in data['locations']]
+
+
+def item_name(number, group='basics'):
+    '''The (English, Danish) name of the generated item with that number (0-based within its group)'''
+    foods = FOODS.get(group.lower(), FOODS['basics'])
+    food, food_dk = foods[number % len(foods)]
+    variant, variant_dk = VARIANTS[(number // len(foods)) % len(VARIANTS)]
+    name, name_dk = ' '.join(filter(None, (variant, food))), ' '.join(filter(None, (variant_dk, food_dk)))
+    series = number // (len(foods) * len(VARIANTS))
+    if series:
+        name, name_dk = f'{name} {series + 1}', f'{name_dk} {series + 1}'
+    # Capitalised the way '_quick_init()' stores them
+    return name.capitalize(), name_dk.capitalize()
+
+
+def generate(session, items=10000, rows=1000000, seed=42, defaults='default_values.json', chunk_size=10000):
+    '''
+    Fills an empty database with a synthetic household and commits
+
+    Parameters:
+        items (int): The number of items
+        rows (int): The number of storage rows
+        seed (int): The same seed gives the same household
+        defaults (str): The file with the groups, container types and locations to use
+
+    Returns:
+        dict with the number of 'items', 'rows', the rows 'in_stock' and the ledger 'movements'
+    '''
+    import main
+    rnd = random.Random(seed)
+    today = dt.date.today()
+    groups, containers, locations = _read_defaults(defaults)
+    session.execute(db.insert(ItemGroup), [{'name': name} for name in groups])
+    session.execute(db.insert(ContainerType), [{'name': name} for name in containers])
+    session.execute(db.insert(Location), [{'name': name} for name in locations])
+    group_ids = dict(session.query(ItemGroup.name, ItemGroup.id))
+    type_ids = dict(session.query(ContainerType.name, ContainerType.id))
+    location_ids = dict(session.query(Location.name, Location.id))
+
+    # Items: spread over the groups, some in a container, most with a minimum limit
+    item_rows = []
+    catalogue = []
+    for count in range(items):
+        group = groups[count % len(groups)]
+        name, name_dk = item_name(count // len(groups), group)
+        container = rnd.choice(containers + [None] * len(containers))
+        duration = DURATIONS.get(group.lower())
+        if container == 'Can' and duration:
+            duration *= 10
+        elif container == 'Frozen':
+            duration = 365
+        location = 'Freezer' if container == 'Frozen' else \
+            'Fridge' if group.lower() in ('meat', 'vegetables') else 'Pantry'
+        item_rows.append({'name': name, 'name_dk': name_dk, 'group_id': group_ids[group],
+                          'type_id': type_ids.get(container), 'standard_duration': duration,
+                          'min_limit': rnd.choice((0, 0, 1, 1, 1, 2, 2, 3, 4, 6))})
+        catalogue.append((duration, location_ids.get(location) or rnd.choice(list(location_ids.values()))))
+    for start in range(0, items, chunk_size):
+        session.execute(db.insert(Item), item_rows[start:start + chunk_size])
+    # The ids come from the database, found again by the natural key
+    item_ids = {tuple(row[1:]): row[0] for row in session.query(Item.id, Item.name, Item.group_id, Item.type_id)}
+    catalogue = [(item_ids[(row['name'], row['group_id'], row['type_id'])],) + entry
+                 for row, entry in zip(item_rows, catalogue)]
+
+    # Storage rows day by day, oldest first, with their movements in the ledger: a few items are bought much more
+    # often (weights fall off like 1/rank), and the older a row the more likely it is used up
+    weights = [1 / rank for rank in range(1, items + 1)]
+    rnd.shuffle(weights)
+    cumulative = list(itertools.accumulate(weights))
+    per_day = Counter(int(rnd.expovariate(1 / 200)) for _ in range(rows))
+    removals = []
+    order = itertools.count()
+    storage = []
+    movements = []
+    since_checkpoint = 0
+    in_stock = 0
+    for age in range(max(per_day, default=0), -1, -1):
+        day = today - dt.timedelta(age)
+        bought_at = dt.datetime.combine(day, dt.time(8))
+        for number, (item_id, duration, location_id) in enumerate(
+                rnd.choices(catalogue, cum_weights=cumulative, k=per_day[age])):
+            bought = rnd.randint(1, 4)
+            # Recent rows are in stock (some partly used), older ones are mostly used up (some forgotten and past
+            # their date)
+            portions = 0 if rnd.random() < min(0.98, age / 60) else rnd.randint(1, bought)
+            in_stock += portions > 0
+            storage.append({'item_id': item_id, 'location_id': location_id, 'portions': portions,
+                            'storage_date': day,
+                            'expiration_date': day + dt.timedelta(duration) if duration else None})
+            movements.append({'timestamp': bought_at + dt.timedelta(seconds=number), 'item_id': item_id,
+                              'location_id': location_id, 'storage_id': None, 'delta': bought, 'source': 'add'})
+            if portions < bought:
+                # Used within its shelf life (or two months), but not later than today
+                used_on = day + dt.timedelta(rnd.randint(0, min(age, duration or 60)))
+                heapq.heappush(removals, (used_on, next(order), item_id, location_id, portions - bought))
+        # The day's removals come after its purchases
+        used_at = dt.datetime.combine(day, dt.time(18))
+        number = 0
+        while removals and removals[0][0] <= day:
+            _, _, item_id, location_id, delta = heapq.heappop(removals)
+            movements.append({'timestamp': used_at + dt.timedelta(seconds=number), 'item_id': item_id,
+                              'location_id': location_id, 'storage_id': None, 'delta': delta, 'source': 'remove'})
+            number += 1
+
+        if len(storage) >= chunk_size or len(movements) >= chunk_size or age == 0:
+            if storage:
+                session.execute(db.insert(Storage), storage)
+            if movements:
+                session.execute(db.insert(StockMovement), movements)
+                since_checkpoint += len(movements)
+            if since_checkpoint >= ledger.checkpoint_interval():
+                ledger.checkpoint(session, taken_at=movements[-1]['timestamp'])
+                since_checkpoint = 0
+            storage = []
+            movements = []
+
+    main.check_item_stock(session, repair=True)
+    # A complete database of the current schema, nothing for 'db_init()' to migrate
+    main._set_meta(session, 'schema_version', main.SCHEMA_VERSION)
+    session.commit()
+    result = {'items': items, 'rows': rows, 'in_stock': in_stock,
+              'movements': session.scalar(db.select(db.func.count(StockMovement.id)))}
+    logging.info("Generated a synthetic household: %s", result)
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fill an empty database with a synthetic household')
+    parser.add_argument('--items', type=int, default=10000)
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    import main
+    main.setup(main.basedir)
+    engine = db.create_engine(main._database_url())
+    main._sqlite_profile(engine)
+    main.Base.metadata.create_all(engine)
+    with main.Session(bind=engine) as session:
+        if session.query(Item.id).first() is not None:
+            sys.exit('The database already has items, datagen.py only fills an empty database')
+        print(generate(session, args.items, args.rows, args.seed))
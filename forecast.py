@@ -0,0 +1,147 @@
+'''
+Consumption rates, run-out dates and suggested minimum limits per item, from the stock movement ledger
+
+The removals of the last days are added up per item and date in the database (one grouped query over the ledger)
+into a NumPy matrix of the portions used per item and day. Every sliding window is a difference of the cumulative
+sums of that matrix, so all items are done in one pass instead of one query or loop per item.
+
+The use per day is the average of the window rates (recent days count in every window, so they weigh the most).
+An item runs out when its stock is used up at that rate, and the suggested minimum limit covers the use during
+the lead time plus a safety margin for the day-to-day variation.
+
+The results are kept until the ledger has new movements (or the day changes), so asking again costs one query;
+after new movements only today is read again.
+NumPy is only imported when a forecast is made.
+'''
+import math
+import itertools
+import datetime as dt
+from collections import namedtuple
+import sqlalchemy as db
+from sqlalchemy import func
+import instrumentation
+import ledger
+from models import Item, ItemStock, StockMovement
+
+# One item: its stock, the portions used per day (overall and per window), when it runs out (None if it isn't
+# used) and the suggested minimum limit
+Forecast = namedtuple('Forecast', 'item_id stock rate rates run_out min_limit')
+
+# The last forecast and what it was made from, and the use per day before today ('_use_per_day()')
+_cache = {'key': None, 'result': None, 'history': None}
+
+
+def _numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise ImportError("The forecasts need NumPy, install it with 'pip install numpy'") from None
+    return numpy
+
+
+def _integers(np, rows, columns):
+    '''The rows of integers as an array, without NumPy inspecting each row'''
+    return np.fromiter(itertools.chain.from_iterable(rows), dtype=np.int64).reshape(-1, columns)
+
+
+def _taken_per_day(np, session, item_ids, first, days):
+    '''
+    The portions taken per item (rows) and day (columns, oldest first) from the day first on, in one query
+
+    The removals are added up per item and date by the database; movements dated after the last day count on it.
+    '''
+    day = func.date(StockMovement.timestamp, type_=db.String)
+    # Grouped by date first: with the item first, SQLite scans the ledger in item order instead of the time range
+    stmt = db.select(day, StockMovement.item_id, func.sum(-StockMovement.delta)).where(
+        StockMovement.source == 'remove', StockMovement.timestamp >= dt.datetime.combine(first, dt.time())).group_by(
+        day, StockMovement.item_id)
+    used = np.zeros((len(item_ids), days))
+    # On the connection: the rows per item and day are many, and a Core result unpacks faster than an ORM one
+    result = session.connection().execute(stmt).all()
+    # The column of each date (text on SQLite, a date on PostgreSQL), worked out once per date instead of per row
+    columns = {date: min((dt.date.fromisoformat(str(date)) - first).days, days - 1)
+               for date in {date for date, _, _ in result}}
+    taken = _integers(np, ((item_id, columns[date], portions) for date, item_id, portions in result), 3)
+    rows = np.searchsorted(item_ids, taken[:, 0])
+    known = rows < len(item_ids)
+    known[known] = item_ids[rows[known]] == taken[known, 0]
+    np.add.at(used, (rows[known], taken[known, 1]), taken[known, 2])
+    return used
+
+
+def _use_per_day(np, session, item_ids, today, days):
+    '''
+    The portions taken per item (rows) and day (columns, oldest first) in the days up to today
+
+    The days before today don't change any more, so they are kept and the next call only reads today again.
+    '''
+    history = _cache['history']
+    if history is None or history[0] != (today, days) or not np.array_equal(history[1], item_ids):
+        used = _taken_per_day(np, session, item_ids, today - dt.timedelta(days - 1), days)
+        history = _cache['history'] = ((today, days), item_ids, used)
+    used = history[2]
+    used[:, -1] = _taken_per_day(np, session, item_ids, today, 1)[:, 0]
+    return used
+
+
+def clear_cache():
+    '''Forget the last forecast and the days it was made from'''
+    _cache.update(key=None, result=None, history=None)
+
+
+@instrumentation.measured
+def forecast(session, windows=(7, 30, 90), lead_days=7, service_factor=1.65, today=None):
+    '''
+    The consumption forecast of every item
+
+    Parameters:
+        windows (tuple): The sliding windows (in days, up to today) the rates are taken over
+        lead_days (int): The days between noticing a shortage and having it restocked
+        service_factor (float): Standard deviations of safety margin (1.65: enough on 95% of the days)
+        today (date): The last day of the windows (default: today)
+
+    Returns:
+        dict of Forecast by item_id
+    '''
+    ledger.write_pending(session)
+    today = today or dt.date.today()
+    last_id = session.scalar(db.select(func.max(StockMovement.id)))
+    key = (last_id, today, tuple(windows), lead_days, service_factor)
+    if _cache['key'] == key:
+        return _cache['result']
+
+    np = _numpy()
+    item_ids = np.fromiter(session.scalars(db.select(Item.id).order_by(Item.id)), dtype=np.int64)
+    stock = np.zeros(len(item_ids), dtype=np.int64)
+    stock_rows = _integers(np, session.execute(db.select(ItemStock.item_id, ItemStock.portions)), 2)
+    stock[np.searchsorted(item_ids, stock_rows[:, 0])] = stock_rows[:, 1]
+    used = _use_per_day(np, session, item_ids, today, max(windows))
+
+    # All items at once: the windows from the cumulative use, the spread from the use per day
+    cumulative = np.concatenate((np.zeros((len(item_ids), 1)), np.cumsum(used, axis=1)), axis=1)
+    rates = np.stack([(cumulative[:, -1] - cumulative[:, -1 - window]) / window for window in windows], axis=1)
+    rate = rates.mean(axis=1)
+    spread = used.std(axis=1)
+    days_left = np.divide(stock, rate, out=np.full(len(item_ids), np.inf), where=rate > 0)
+    run_out = [None if math.isinf(left) else today + dt.timedelta(int(left)) for left in days_left.tolist()]
+    min_limit = np.ceil(rate * lead_days + service_factor * spread * math.sqrt(lead_days)).astype(np.int64)
+
+    result = {item_id: Forecast(item_id, item_stock, item_rate, tuple(item_rates), item_run_out, item_limit)
+              for item_id, item_stock, item_rate, item_rates, item_run_out, item_limit in zip(
+                  item_ids.tolist(), stock.tolist(), rate.round(3).tolist(), rates.round(3).tolist(), run_out,
+                  min_limit.tolist())}
+    _cache['key'], _cache['result'] = key, result
+    return result
+
+
+def running_out(session, within=14, **options):
+    '''
+    The items that run out within that many days, soonest first (see 'forecast()' for the options)
+
+    Returns:
+        list of Forecast
+    '''
+    limit = (options.get('today') or dt.date.today()) + dt.timedelta(within)
+    return sorted((entry for entry in forecast(session, **options).values()
+                   if entry.run_out is not None and entry.run_out <= limit),
+                  key=lambda entry: (entry.run_out, entry.item_id))
@@ -0,0 +1,163 @@
+'''
+Query counts and timings per operation (a menu action, a command or a public helper of main.py)
+
+The engine events count every SQL statement (and the time it took) against the operation running in the same
+thread or task. When the outermost operation ends, its number of queries, SQL time and wall time are logged and
+appended as one JSON line to the metrics file, which is rotated like the log file. Statements executed more than 'PAI_NPLUS1_THRESHOLD' times in one
+operation (e.g. a lazy load per row) are logged as a warning, as a likely N+1 pattern.
+
+Settings (read when the first engine is instrumented, so a .env file applies too):
+    PAI_METRICS             '0' (or 'off'/'false') switches it off: then no events are registered and a measured
+                            function costs one dictionary lookup per call
+    PAI_METRICS_FILE        where the JSON lines go (default 'logs/metrics.jsonl' next to main.py)
+    PAI_METRICS_MAX_KB      the size at which the file is rotated (default 1024), 3 older files are kept
+    PAI_NPLUS1_THRESHOLD    how often the same statement may run in one operation (default 10)
+'''
+import os
+import json
+import time
+import logging
+from logging.handlers import RotatingFileHandler
+import functools
+import threading
+import contextlib
+import contextvars
+from collections import Counter
+from sqlalchemy import event
+
+# Stays off until 'instrument()' switches it on (an operation without an instrumented engine has nothing to count)
+settings = {
+    'enabled': False,
+    'file': os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logs', 'metrics.jsonl'),
+    'threshold': 10,
+    'max_bytes': 1024 * 1024,
+    'backups': 3,
+}
+
+# The outermost operation of the current thread or task
+_current = contextvars.ContextVar('pai_operation', default=None)
+_file_lock = threading.Lock()
+# Writes the JSON lines to the metrics file, see '_metrics_handler()'
+_writer = {'handler': None}
+
+
+class Operation:
+    '''The statements one operation executed, with their time'''
+
+    def __init__(self, name):
+        self.name = name
+        self.queries = 0
+        self.sql_time = 0.0
+        self.wall_time = 0.0
+        self.statements = Counter()
+
+    def repeated(self, threshold=None):
+        '''The statements executed more than threshold times, as (statement, count), most frequent first'''
+        threshold = settings['threshold'] if threshold is None else threshold
+        return [(statement, count) for statement, count in self.statements.most_common() if count > threshold]
+
+    def record(self):
+        '''The operation as written to the metrics file'''
+        return {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'operation': self.name, 'queries': self.queries,
+                'sql_ms': round(1000 * self.sql_time, 2), 'wall_ms': round(1000 * self.wall_time, 2),
+                'repeated': [{'statement': statement, 'count': count} for statement, count in self.repeated()]}
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current.get() is not None:
+        conn.info.setdefault('pai_query_start', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    operation = _current.get()
+    if operation is None or not conn.info.get('pai_query_start'):
+        return
+    operation.sql_time += time.perf_counter() - conn.info['pai_query_start'].pop()
+    operation.queries += 1
+    # The statement has placeholders for its values, so it is the same text for every execution of the same shape
+    operation.statements[statement] += 1
+
+
+def _flag(value):
+    return value.strip().lower() not in ('0', 'off', 'false', 'no')
+
+
+def instrument(engine):
+    '''
+    Count the statements of engine against the running operations (unless 'PAI_METRICS' switches it off)
+
+    Returns:
+        The engine
+    '''
+    settings['enabled'] = _flag(os.environ.get('PAI_METRICS', '1'))
+    settings['file'] = os.environ.get('PAI_METRICS_FILE', settings['file'])
+    settings['threshold'] = int(os.environ.get('PAI_NPLUS1_THRESHOLD', settings['threshold']))
+    settings['max_bytes'] = 1024 * int(os.environ.get('PAI_METRICS_MAX_KB', settings['max_bytes'] // 1024))
+    if settings['enabled'] and not event.contains(engine, 'after_cursor_execute', _after_cursor_execute):
+        event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+    return engine
+
+
+def _metrics_handler():
+    '''The rotating handler writing the metrics file (a new one when the file or its size changed)'''
+    handler = _writer['handler']
+    path = os.path.abspath(settings['file'])
+    if handler is None or handler.baseFilename != path or handler.maxBytes != settings['max_bytes']:
+        if handler is not None:
+            handler.close()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        handler = RotatingFileHandler(path, maxBytes=settings['max_bytes'], backupCount=settings['backups'],
+                                      encoding='utf-8', delay=True)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        _writer['handler'] = handler
+    return handler
+
+
+def _report(operation):
+    logging.info(
+        "Operation '%s': %s queries, %.1f ms SQL, %.1f ms total",
+        operation.name, operation.queries, 1000 * operation.sql_time, 1000 * operation.wall_time)
+    for statement, count in operation.repeated():
+        logging.warning(
+            "Possible N+1 in '%s': the same statement ran %s times: %s",
+            operation.name, count, ' '.join(statement.split())[:200])
+    try:
+        line = json.dumps(operation.record(), ensure_ascii=False)
+        with _file_lock:
+            _metrics_handler().handle(logging.makeLogRecord({'msg': line}))
+    except OSError as e:
+        logging.warning("Could not write the metrics to '%s': %s", settings['file'], e)
+
+
+@contextlib.contextmanager
+def operation(name):
+    '''
+    Context manager measuring everything inside it as one operation
+
+    Nested operations count towards the outermost one, so every statement is counted once. Yields the Operation
+    (None when switched off or nested).
+    '''
+    if not settings['enabled'] or _current.get() is not None:
+        yield None
+        return
+    current = Operation(name)
+    token = _current.set(current)
+    started = time.perf_counter()
+    try:
+        yield current
+    finally:
+        current.wall_time = time.perf_counter() - started
+        _current.reset(token)
+        _report(current)
+
+
+def measured(function):
+    '''Decorator measuring each call of function as an operation named after it (see 'operation()')'''
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if not settings['enabled']:
+            return function(*args, **kwargs)
+        with operation(function.__name__):
+            return function(*args, **kwargs)
+    return wrapper
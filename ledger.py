@@ -0,0 +1,144 @@
+'''
+Append-only ledger of the stock movements, with checkpoints of the stock it adds up to
+
+Every change to the portions in stock (adding, removing, scanning, corrections and imports) is recorded as a
+'StockMovement'. The storage rows keep only the current stock (emptied rows are removed); the history lives in the
+ledger. The movements of a transaction are kept in the session and written with one batched insert when it
+commits, so a bulk import or a burst of scans costs one statement instead of one per change.
+
+Every 'PAI_CHECKPOINT_MOVEMENTS' movements (default 50000) the stock per item and location is saved as a
+checkpoint. The stock at any movement is the checkpoint before it plus the movements since, so a read never
+replays more than that many movements however long the history grows. 'movement_at()' finds the last movement
+at a point in time (through the timestamp index), which makes the stock at any date just as cheap.
+'''
+import os
+import logging
+import datetime as dt
+import sqlalchemy as db
+from sqlalchemy import event, func
+from sqlalchemy.orm import Session
+from models import StockMovement, StockCheckpoint, CheckpointBalance
+
+
+def checkpoint_interval():
+    '''The number of movements between checkpoints'''
+    return int(os.environ.get('PAI_CHECKPOINT_MOVEMENTS', 50000))
+
+
+def record(session, item_id, delta, source, location_id=None, storage_id=None, timestamp=None):
+    '''
+    Record a movement, written to the ledger when the session commits (nothing is recorded for a delta of 0)
+
+    Parameters:
+        delta (int): The portions added (positive) or taken out (negative)
+        source (str): What made the change, e.g. 'add', 'remove' or 'correction'
+        timestamp (datetime): When it happened (default: now)
+    '''
+    if delta:
+        session.info.setdefault('ledger_pending', []).append(
+            {'timestamp': timestamp or dt.datetime.now(), 'item_id': item_id, 'location_id': location_id,
+             'storage_id': storage_id, 'delta': delta, 'source': source})
+
+
+def write_pending(session, chunk_size=10000):
+    '''
+    Write the recorded movements of the session now (otherwise done when it commits), and a checkpoint if due
+
+    Returns:
+        The number of movements written
+    '''
+    pending = session.info.pop('ledger_pending', None)
+    if not pending:
+        return 0
+    for start in range(0, len(pending), chunk_size):
+        session.execute(db.insert(StockMovement), pending[start:start + chunk_size])
+    last_checkpoint = session.scalar(db.select(func.max(StockCheckpoint.movement_id))) or 0
+    if (session.scalar(db.select(func.max(StockMovement.id))) or 0) - last_checkpoint >= checkpoint_interval():
+        checkpoint(session)
+    return len(pending)
+
+
+@event.listens_for(Session, 'before_commit')
+def _write_on_commit(session):
+    '''Session event: the recorded movements are written in the transaction they belong to'''
+    if session.info.get('ledger_pending'):
+        write_pending(session)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _drop_pending(session, previous_transaction):
+    '''Session event: the changes were rolled back, and so are their movements'''
+    session.info.pop('ledger_pending', None)
+
+
+def _checkpoint_before(session, movement_id=None):
+    '''The latest checkpoint at or before movement_id (default: the latest), None if there is none'''
+    stmt = db.select(StockCheckpoint).order_by(StockCheckpoint.movement_id.desc()).limit(1)
+    if movement_id is not None:
+        stmt = stmt.where(StockCheckpoint.movement_id <= movement_id)
+    return session.scalars(stmt).first()
+
+
+def balances(session, item_id=None, location_id=None, movement_id=None):
+    '''
+    The stock per item and location after movement movement_id (default: now), from the checkpoint before it
+    plus the movements since
+
+    Returns:
+        dict of the portions by (item_id, location_id), only those with portions
+    '''
+    write_pending(session)
+    start = _checkpoint_before(session, movement_id)
+    totals = {}
+    if start is not None:
+        stmt = db.select(CheckpointBalance.item_id, CheckpointBalance.location_id, CheckpointBalance.portions).where(
+            CheckpointBalance.checkpoint_id == start.id)
+        if item_id is not None:
+            stmt = stmt.where(CheckpointBalance.item_id == item_id)
+        if location_id is not None:
+            stmt = stmt.where(CheckpointBalance.location_id == location_id)
+        totals = {(row_item_id, row_location_id): portions for row_item_id, row_location_id, portions in
+                  session.execute(stmt)}
+
+    stmt = db.select(StockMovement.item_id, StockMovement.location_id, func.sum(StockMovement.delta)).where(
+        StockMovement.id > (start.movement_id if start is not None else 0)).group_by(
+        StockMovement.item_id, StockMovement.location_id)
+    if movement_id is not None:
+        stmt = stmt.where(StockMovement.id <= movement_id)
+    if item_id is not None:
+        stmt = stmt.where(StockMovement.item_id == item_id)
+    if location_id is not None:
+        stmt = stmt.where(StockMovement.location_id == location_id)
+    for row_item_id, row_location_id, delta in session.execute(stmt):
+        key = (row_item_id, row_location_id)
+        totals[key] = totals.get(key, 0) + delta
+    return {key: portions for key, portions in totals.items() if portions}
+
+
+def movement_at(session, moment):
+    '''The id of the last movement at or before moment (a datetime), None if there is none'''
+    return session.scalar(db.select(StockMovement.id).where(StockMovement.timestamp <= moment).order_by(
+        StockMovement.timestamp.desc(), StockMovement.id.desc()).limit(1))
+
+
+def checkpoint(session, taken_at=None):
+    '''
+    Save the current stock per item and location as a checkpoint (not committed)
+
+    Returns:
+        The new StockCheckpoint, or None if nothing moved since the last one
+    '''
+    last = session.scalar(db.select(func.max(StockMovement.id)))
+    previous = _checkpoint_before(session)
+    if last is None or (previous is not None and previous.movement_id == last):
+        return None
+    totals = balances(session, movement_id=last)
+    new = StockCheckpoint(movement_id=last, taken_at=taken_at or dt.datetime.now())
+    session.add(new)
+    session.flush()
+    rows = [{'checkpoint_id': new.id, 'item_id': item_id, 'location_id': location_id, 'portions': portions}
+            for (item_id, location_id), portions in totals.items()]
+    for start in range(0, len(rows), 10000):
+        session.execute(db.insert(CheckpointBalance), rows[start:start + 10000])
+    logging.info("Stock checkpoint %s after movement %s: %s balances", new.id, last, len(rows))
+    return new
@@ -1,20 +1,74 @@
 import os
 import sys
+import time
+_started = time.perf_counter()
 import logging
-from logging.handlers import RotatingFileHandler
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
+import queue
+import atexit
 import json
+import hashlib
+import itertools
+from operator import attrgetter
+from collections import namedtuple
 from dotenv import load_dotenv
 import sqlalchemy as db
-from sqlalchemy import func
+from sqlalchemy import func, literal_column
 from sqlalchemy.sql.functions import coalesce
-from sqlalchemy.orm import sessionmaker
-from models import Base, Item, Storage, Barcode, ItemGroup, ContainerType, Location, _create
+from sqlalchemy.orm import sessionmaker, joinedload
+from sqlalchemy.schema import CreateIndex
+from cache import barcode_index, reference_cache
+import instrumentation
+import ledger
+from models import Base, Item, Storage, Barcode, ItemGroup, ContainerType, Location, ItemStock, AppMeta, _upsert, \
+    StockMovement
 import datetime as dt
 
 basedir = os.path.abspath(os.path.dirname(__file__))
 load_dotenv(os.path.join(basedir, '.env'))
 Session = sessionmaker()
 
+# The database when 'SQLALCHEMY_DATABASE_URI' isn't set
+DEFAULT_DATABASE = 'sqlite:///' + os.path.join(basedir, 'inventory.db')
+
+# One storage row's part of a removal, see 'remove_from_stock()'
+Allocation = namedtuple(
+    'Allocation', 'storage_id location_id expiration_date taken remaining')
+
+
+class StockRow(namedtuple('StockRow', 'storage_id item_id item container location portions storage_date '
+                                      'expiration_date')):
+    '''One storage row of a listing, plain values from one joined query (see 'stock_view()')'''
+    __slots__ = ()
+
+    def get_row(self, prefix=None):
+        '''Returns the row pretty-printed like 'Storage.get_row()', with its location'''
+        name = f"{self.item} ({self.container})" if self.container else self.item
+        row_info = f"Item: {name} (id: {self.item_id}), #Portions: {self.portions}, stored on: {self.storage_date}"
+        if self.expiration_date is not None:
+            row_info += f" (Expire: {self.expiration_date})"
+        if self.location is not None:
+            row_info += f", in: {self.location}"
+        return (prefix or '') + row_info
+
+
+# How long each part of the start-up took (in ms), see 'db_init()'
+startup_timings = {'imports': round(1000 * (time.perf_counter() - _started), 1)}
+
+# Items changed (and committed) since the last export, see '_item_export_changes()'
+_exported_changes = {'all': False, 'items': set()}
+
+# Writes the log records to the log file, see 'setup()'
+_logging = {'listener': None}
+
+# A menu screen: the title, the (key, label, action) options and the question, see 'menu()'
+Screen = namedtuple('Screen', 'title options prompt')
+MAIN = 'main'
+QUIT = 'quit'
+
+# Where the prompts read their answers from and whether the screen is cleared, see 'menu(inputs=...)'
+_console = {'input': input, 'clear': True}
+
 
 def setup(basedir=''):
     '''
@@ -22,67 +76,256 @@ def setup(basedir=''):
     '''
     logdir = os.path.join(basedir, 'logs')
     if not os.path.exists(logdir):
-        os.mkdir('logs')
+        os.mkdir(logdir)
     loglevel = os.environ.get('LOG_LEVEL', 'INFO').upper()
     if loglevel.upper() not in ['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL']:
         loglevel = logging.INFO
-    logging.basicConfig(
-        # filename=logdir + '/logfile.log',
-        # filemode='a',
-        format='%(asctime)s %(levelname)s: %(message)s',
-        level=loglevel,
-        handlers=[RotatingFileHandler(
+    if _logging['listener'] is None:
+        file_handler = RotatingFileHandler(
             logdir + '/logfile.log',
             maxBytes=256000,
-            backupCount=10)]
-    )
+            backupCount=10)
+        file_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s: %(message)s'))
+        # The callers only put the records on a queue, a thread of its own writes them to the file
+        log_queue = queue.SimpleQueue()
+        _logging['listener'] = QueueListener(log_queue, file_handler)
+        _logging['listener'].start()
+        atexit.register(_logging['listener'].stop)
+        # The file handler adds the time and level when it writes the record
+        logging.basicConfig(format='%(message)s', level=loglevel, handlers=[QueueHandler(log_queue)])
     logging.info('** Program started!')
 
 
-def db_init():
-    '''Set the DB up, create basic tables, read default values, etc.'''
-    database = os.environ.get('SQLALCHEMY_DATABASE_URI')
-    if not database:
-        database = 'sqlite:///:memory:'
-    logging.info(f'Initialising database.')
-    engine = db.create_engine(database, echo=False)
-    Session.configure(bind=engine)
+def db_init(preload=False, **engine_options):
+    '''
+    Set the DB up, create basic tables, read default values, etc.
 
-    # Create tables - fails silently if the table already exists.
+    Only does what is needed: the tables are created and migrated only when the schema version recorded in the
+    database differs from SCHEMA_VERSION, and the default values are only read when 'default_values.json'
+    changed since they were last read. How long each step took is logged and kept in 'startup_timings'.
+
+    Parameters:
+        preload (boolean): Whether to fill the reference cache and barcode index right away (otherwise they
+                           are loaded when first needed)
+        engine_options: Passed on to 'create_engine()', e.g. the connection pool settings
+    '''
+    started = time.perf_counter()
+
+    def lap(step):
+        nonlocal started
+        now = time.perf_counter()
+        startup_timings[step] = round(1000 * (now - started), 1)
+        started = now
+
+    logging.info("Initialising database.")
+    engine = db.create_engine(_database_url(), echo=False, **engine_options)
+    _sqlite_profile(engine)
+    instrumentation.instrument(engine)
+    Session.configure(bind=engine)
     session = Session()
-    Base.metadata.create_all(engine)  # Creates the table
-    session.commit()
-    _read_defaults(session, 'default_values.json')
+    lap('engine')
+
+    _prepare_database(session, lap)
+    if preload:
+        reference_cache.load(session)
+        barcode_index.load(session)
+    lap('caches')
+
+    logging.info("Start-up took %.1f ms: %s", sum(startup_timings.values()),
+                 ', '.join(f"{step} {ms} ms" for step, ms in startup_timings.items()))
     return session
 
 
-def _read_defaults(session, file):
-    '''This reads a JSON file with default values, supporting function to get default values added to the DB'''
-    logging.info('Importing default values')
-    with open(file, encoding='utf-8') as json_file:
-        data = json.load(json_file)
-        # ItemGroup
-        for itemgroup in data['itemgroups']:
-            result = _create(session, ItemGroup, name=itemgroup.capitalize())
-            logging.debug(
-                f"Itemgroup '{itemgroup}' created? {result[1]} - {result[0]}")
-        # ContainerType
-        for container in data['containertypes']:
-            result = _create(session, ContainerType,
-                             name=container.capitalize())
-            logging.debug(
-                f"Containertype '{container}' created? {result[1]} - {result[0]}")
-        # StorageLocation
-        for location in data['locations']:
-            result = _create(session, Location,
-                             name=location.capitalize())
-            logging.debug(
-                f"Storagelocation '{location}' created? {result[1]} - {result[0]}")
+def _database_url():
+    '''Helper function to return the database to use: 'SQLALCHEMY_DATABASE_URI', or DEFAULT_DATABASE'''
+    return os.environ.get('SQLALCHEMY_DATABASE_URI') or DEFAULT_DATABASE
+
+
+def _sqlite_pragmas(dbapi_connection, connection_record):
+    '''Engine event: the settings of each new connection to a SQLite file, see _sqlite_profile()'''
+    cursor = dbapi_connection.cursor()
+    # Readers don't block the writer (and the other way around), and with WAL a commit needs no fsync
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    # Wait for the other writer instead of failing with 'database is locked' right away
+    cursor.execute(
+        f"PRAGMA busy_timeout={int(os.environ.get('PAI_SQLITE_BUSY_TIMEOUT', 10000))}")
+    cursor.execute(
+        f"PRAGMA cache_size=-{int(os.environ.get('PAI_SQLITE_CACHE_KB', 16384))}")
+    cursor.close()
+
+
+def _sqlite_profile(engine):
+    '''
+    Helper function to set a SQLite file database up for several connections and processes at once
+
+    Every connection gets WAL mode, synchronous=NORMAL, a busy timeout ('PAI_SQLITE_BUSY_TIMEOUT', in ms) and a
+    bigger page cache ('PAI_SQLITE_CACHE_KB'). Other databases (and in-memory SQLite) are left as they are.
+    '''
+    if engine.dialect.name == 'sqlite' and engine.url.database not in (None, '', ':memory:'):
+        db.event.listen(engine, 'connect', _sqlite_pragmas)
+    return engine
+
+
+def _prepare_database(session, lap=None):
+    '''
+    Helper function to bring the database up to date: the tables and migrations (if the schema version
+    changed) and the default values (if the file changed)
+
+    Parameters:
+        lap (function): Called with the name of each step when it is done (for the start-up timings)
+    '''
+    if _get_schema_version(session) != SCHEMA_VERSION:
+        # Create tables - fails silently if the table already exists.
+        Base.metadata.create_all(session.connection())  # Creates the table
         session.commit()
+        _migrate(session)
+    if lap:
+        lap('schema')
+    _read_defaults(session, os.path.join(basedir, 'default_values.json'))
+    if lap:
+        lap('defaults')
+
+
+def _get_meta(session, key, default=None):
+    '''Helper function to read a value from the 'app_meta' table'''
+    value = session.query(AppMeta.value).filter(AppMeta.key == key).scalar()
+    return default if value is None else value
+
+
+def _set_meta(session, key, value):
+    '''Helper function to write a value to the 'app_meta' table (not committed)'''
+    _upsert(session, AppMeta, {'key': key, 'value': str(value)})
+
+
+def _migration_1(session):
+    '''Schema version 1: natural keys, indexes on the filtered columns and the aggregated stock'''
+    bind = session.connection()
+    # Duplicates from before the natural keys would block the unique indexes - keep the newest row, it has the
+    # values last entered (updates used to insert a new row)
+    # The select list has to match the GROUP BY exactly (PostgreSQL rejects a bare type_id)
+    type_key = func.coalesce(Item.type_id, literal_column('0'))
+    for name, group_id, type_key_value, keep_id in session.query(Item.name, Item.group_id, type_key, func.max(Item.id)).group_by(
+            Item.name, Item.group_id, type_key).having(func.count(Item.id) > 1).all():
+        duplicates = [item_id for item_id, in session.query(Item.id).filter(Item.name == name, Item.group_id == group_id,
+                                                                            type_key == type_key_value, Item.id != keep_id)]
+        logging.warning("Merging duplicate items %s into item %s ('%s')", duplicates, keep_id, name)
+        session.query(Storage).filter(Storage.item_id.in_(duplicates)).update(
+            {Storage.item_id: keep_id}, synchronize_session=False)
+        session.query(Barcode).filter(Barcode.item_id.in_(duplicates)).update(
+            {Barcode.item_id: keep_id}, synchronize_session=False)
+        session.query(ItemStock).filter(ItemStock.item_id.in_(
+            duplicates)).delete(synchronize_session=False)
+        session.query(Item).filter(Item.id.in_(duplicates)).delete(
+            synchronize_session=False)
+    for name, keep_id in session.query(Location.name, func.min(Location.id)).group_by(Location.name).having(func.count(Location.id) > 1).all():
+        logging.warning("Merging duplicate locations named '%s' into location %s", name, keep_id)
+        duplicates = session.query(Location.id).filter(
+            Location.name == name, Location.id != keep_id)
+        session.query(Storage).filter(Storage.location_id.in_(duplicates.scalar_subquery())).update(
+            {Storage.location_id: keep_id}, synchronize_session=False)
+        session.query(Location).filter(Location.name == name, Location.id != keep_id).delete(
+            synchronize_session=False)
+
+    # create_all only creates indexes together with new tables (checkfirst can't see expression indexes on SQLite)
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            bind.execute(CreateIndex(index, if_not_exists=True))
+
+    _sync_item_stock(session, check_item_stock(session))
+
+
+def _migration_2(session):
+    '''Schema version 2: the stock movement ledger, opened with the stock in the storage rows'''
+    if session.query(StockMovement.id).first() is not None:
+        # Already filled, e.g. by datagen.py
+        return
+    for storage_id, item_id, location_id, portions, storage_date in session.query(
+            Storage.id, Storage.item_id, Storage.location_id, Storage.portions, Storage.storage_date).filter(
+            Storage.portions > 0).order_by(Storage.storage_date, Storage.id):
+        ledger.record(session, item_id, portions, 'opening', location_id=location_id, storage_id=storage_id,
+                      timestamp=dt.datetime.combine(storage_date or dt.date.today(), dt.time()))
+    ledger.write_pending(session)
+    ledger.checkpoint(session)
+
+
+def _migration_3(session):
+    '''Schema version 3: the index replaying the movements of one item from a checkpoint on'''
+    index = next(index for index in StockMovement.__table__.indexes if index.name == 'ix_stock_movement_item_id')
+    session.connection().execute(CreateIndex(index, if_not_exists=True))
+
+
+# The schema migrations by version, applied in order by '_migrate()'
+MIGRATIONS = {
+    1: _migration_1,
+    2: _migration_2,
+    3: _migration_3,
+}
+SCHEMA_VERSION = max(MIGRATIONS)
+
+
+def _get_schema_version(session):
+    '''Helper function to read the schema version of the database, None if it has no 'app_meta' table yet'''
+    try:
+        version = _get_meta(session, 'schema_version')
+    except db.exc.DBAPIError:
+        session.rollback()
+        return None
+    return None if version is None else int(version)
+
+
+def _migrate(session):
+    '''
+    Bring an existing database up to the current SCHEMA_VERSION
+
+    The version is kept in the 'app_meta' table, each migration runs and is recorded in its own transaction.
+    '''
+    version = int(_get_meta(session, 'schema_version', 0))
+    for target in range(version + 1, SCHEMA_VERSION + 1):
+        logging.info("Migrating the database to schema version %s", target)
+        try:
+            MIGRATIONS[target](session)
+            _set_meta(session, 'schema_version', target)
+            session.commit()
+        except Exception:
+            session.rollback()
+            logging.exception("Migration to schema version %s failed", target)
+            raise
+    return None
+
+
+def _read_defaults(session, file, force=False):
+    '''
+    This reads a JSON file with default values, supporting function to get default values added to the DB
+
+    The hash of the file is kept in the 'app_meta' table, so an unchanged file is not read again (unless force).
+
+    Returns:
+        Whether the default values were read
+    '''
+    with open(file, 'rb') as json_file:
+        content = json_file.read()
+    digest = hashlib.sha256(content).hexdigest()
+    if not force and _get_meta(session, 'defaults_hash') == digest:
+        logging.debug("Default values in '%s' are unchanged, not reading them", file)
+        return False
+
+    logging.info('Importing default values')
+    data = json.loads(content)
+    # One upsert per table, existing names are left as they are
+    for model, key in ((ItemGroup, 'itemgroups'), (ContainerType, 'containertypes'), (Location, 'locations')):
+        names = [{'name': name.capitalize()} for name in data[key]]
+        ids = _upsert(session, model, names)
+        logging.debug("%s defaults %s have ids %s", model.__name__, [n['name'] for n in names], ids)
+    _set_meta(session, 'defaults_hash', digest)
+    session.commit()
+    return True
 
 
 def clear_screen():
     '''Uses the OS system commands to clear output screen in the appropriate manner for that OS'''
+    if not _console['clear']:
+        return None
     # for windows
     if os.name == 'nt':
         return os.system('cls')
@@ -96,137 +339,470 @@ def pause():
     return get_input_str("Press <Enter> to resume:", accept_blank=True)
 
 
+@instrumentation.measured
 def _quick_init(session, file):
-    '''This reads a JSON file, supporting function to get default values added to the DB'''
+    '''
+    This reads a JSON file with item definitions, supporting function to get the items added to the DB
+
+    The group and container names are resolved once, the file is compared against the existing items
+    by their natural key (name, group, container), and the differences are written as batched
+    inserts and updates in a single transaction.
+
+    Parameters:
+        file (str): the name of the JSON file with the item definitions
+
+    Returns:
+        dict with the number of 'created', 'updated' and 'unchanged' items (or None if the file can't be read)
+    '''
     try:
         with open(file, encoding='utf-8') as json_file:
             data = json.load(json_file)
     except FileNotFoundError as e:
-        logging.error(f"Error opening {file}! Error message '{e}'")
+        logging.error("Error opening %s! Error message '%s'", file, e)
         return None
 
-    for group in data.keys():
-        group_id = session.query(ItemGroup.id).filter(
-            func.upper(ItemGroup.name) == group.upper()).scalar()
-        for item in data[group]:
+    # Index the existing items by their natural key
+    columns = ('name_dk', 'min_limit', 'standard_duration')
+    existing = {}
+    for row in session.query(Item.id, Item.name, Item.group_id, Item.type_id, *[getattr(Item, c) for c in columns]):
+        existing[(row.name.upper(), row.group_id, row.type_id)] = row
+
+    inserts = {}
+    updates = {}
+    unchanged = 0
+    for group, items in data.items():
+        group_id = reference_cache.id_of(session, ItemGroup, group)
+        if group_id is None:
+            logging.warning("Item group '%s' from '%s' does not exist, skipping its %s items", group, file, len(items))
+            continue
+        for item in items:
             type_id = None
             if item.get('container_type'):
-                type_id = session.query(ContainerType.id).filter(
-                    func.upper(ContainerType.name) == item['container_type'].upper()).scalar()
-            result = _create(session,
-                             Item,
-                             name=item['name_en'].capitalize(),
-                             name_dk=item['name_da'].capitalize(),
-                             min_limit=item['minimum_limit'],
-                             group_id=group_id,
-                             type_id=type_id,
-                             standard_duration=item.get('standard_duration', None))
-
-            logging.info(
-                f"Item '{result[0].name}' read from definitions file. Was it created now? '{result[1]}' (otherwise it existed already)")
-            logging.debug(
-                f"The item was read from '{file}', this is the row itself: {result[0]}")
-    session.commit()
+                type_id = reference_cache.id_of(
+                    session, ContainerType, item['container_type'])
+                if type_id is None:
+                    logging.warning(
+                        "Container type '%s' for '%s' does not exist, ignoring it",
+                        item['container_type'], item['name_en'])
+            values = {
+                'name': item['name_en'].capitalize(),
+                'name_dk': item['name_da'].capitalize(),
+                'min_limit': item['minimum_limit'],
+                'group_id': group_id,
+                'type_id': type_id,
+                'standard_duration': item.get('standard_duration', None)
+            }
+            key = (values['name'].upper(), group_id, type_id)
+            current = existing.get(key)
+            if current is None:
+                # New item (if it is listed twice in the file, the last one wins)
+                inserts[key] = values
+            elif any(getattr(current, c) != values[c] for c in columns):
+                values['id'] = current.id
+                updates[key] = values
+            else:
+                unchanged += 1
+            logging.debug("Item '%s' read from '%s', new? %s", values['name'], file, current is None)
+
+    try:
+        if inserts:
+            session.execute(db.insert(Item), list(inserts.values()))
+        if updates:
+            session.execute(db.update(Item), list(updates.values()))
+        if inserts or updates:
+            _mark_changed(session)
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+
+    result = {'created': len(inserts),
+              'updated': len(updates),
+              'unchanged': unchanged}
+    logging.info("Items read from definitions file '%s': %s", file, result)
+    return result
 
 
-def _item_export(session):
+def _item_status_records(session, item_ids=None, chunk_size=1000):
     '''
-    Helper function to export the items in the DB with current counts
+    Generator that yields the item status records (as written to 'item_status.json')
+
+    The items come with their group name and stock count from one joined query, streamed in chunks.
+
+    Parameters:
+        item_ids (list): Only these items (optional, defaults to all items)
+        chunk_size (int): The number of rows fetched from the database at a time
+    '''
+    query = session.query(Item.id, Item.name, coalesce(ItemStock.portions, 0), ItemGroup.name,
+                          Item.min_limit, Item.standard_duration).outerjoin(ItemGroup, Item.group_id == ItemGroup.id).outerjoin(
+        ItemStock, ItemStock.item_id == Item.id).order_by(Item.id)
 
-    Produces a JSON with current amounts and minimum limits (to support read in and ad hoc updates)
-    '''
-    # TODO: Should it be possible to do a partial export? For now, just take the whole shebang
-
-    # Get all the items with their counts, including items not in stock
-    items = list_items_with_stock_count(session,
-                                        item_id=None,
-                                        exclude_empty=False)
-
-    # Then generate the JSON layout
-    data = []
-    for item, count in items:
-        data.append(
-            {
-                "item_id": item.id,
-                "name": item.name,
-                "stock_count": count,
-                "itemgroup": item.itemgroup.name,
-                "min_limit": item.min_limit,
-                "standard_duration": item.standard_duration
+    if item_ids is None:
+        batches = [query]
+    else:
+        batches = (query.filter(Item.id.in_(ids))
+                   for ids in _chunked(sorted(item_ids), chunk_size))
+
+    for batch in batches:
+        for item_id, name, stock_count, group_name, min_limit, standard_duration in batch.yield_per(chunk_size):
+            yield {
+                "item_id": item_id,
+                "name": name,
+                "stock_count": stock_count,
+                "itemgroup": group_name,
+                "min_limit": min_limit,
+                "standard_duration": standard_duration
             }
-        )
 
-    # And write it as UTF-8 with pretty formatting
-    if data:
-        with open('item_status.json', 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=4)
-        logging.info(
-            "Created 'item_status.json' with current items and stock level")
 
-    return None
+@instrumentation.measured
+def _item_export(session, file='item_status.json', ndjson=False, chunk_size=1000):
+    '''
+    Helper function to export the items in the DB with current counts
 
+    Produces a JSON with current amounts and minimum limits (to support read in and ad hoc updates).
+    The rows are streamed from one joined query and written to a temporary file as they arrive,
+    which then replaces the old file - so a crash never leaves a half-written export behind.
+    A full export also replaces any changes file written by '_item_export_changes()'.
+
+    Parameters:
+        file (str): The name of the file to write
+        ndjson (boolean): Write one item per line instead of a pretty-printed JSON array
+        chunk_size (int): The number of rows fetched from the database at a time
+
+    Returns:
+        The number of items exported
+    '''
+    import tempfile  # Only needed here, so it isn't imported at start-up
+
+    directory = os.path.dirname(os.path.abspath(file))
+    fd, temp_file = tempfile.mkstemp(dir=directory, prefix='.'+os.path.basename(file),
+                                     suffix='.tmp')
+    count = 0
+    try:
+        # Write it as UTF-8, pretty formatted the same way as json.dump(indent=4) would do for the full list
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            for record in _item_status_records(session, chunk_size=chunk_size):
+                if ndjson:
+                    f.write(json.dumps(record, ensure_ascii=False) + '\n')
+                else:
+                    f.write('[\n    ' if count == 0 else ',\n    ')
+                    f.write(json.dumps(record, ensure_ascii=False,
+                                       indent=4).replace('\n', '\n    '))
+                count += 1
+            if count and not ndjson:
+                f.write('\n]')
+            f.flush()
+            os.fsync(f.fileno())
+
+        if count:
+            os.replace(temp_file, file)
+            logging.info("Created '%s' with current items and stock level (%s items)", file, count)
+    finally:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+
+    # The snapshot is current again
+    if os.path.exists(file + '.delta'):
+        os.remove(file + '.delta')
+    _exported_changes['all'] = False
+    _exported_changes['items'].clear()
+
+    return count
+
+
+@instrumentation.measured
+def _item_export_changes(session, file='item_status.json', compact_ratio=0.5, compact_days=7):
+    '''
+    Helper function to export only the items that changed since the last export
+
+    The changed items are appended as NDJSON to '<file>.delta' (later lines win over earlier lines and over the
+    snapshot in 'file'). It falls back to a full export (compaction) when there is no snapshot yet, when all items
+    are marked as changed, when the changes file grows beyond compact_ratio of the snapshot, or when the snapshot
+    is older than compact_days.
+
+    Returns:
+        The number of items exported
+    '''
+    delta_file = file + '.delta'
+    if not os.path.exists(file) or _exported_changes['all']:
+        return _item_export(session, file=file)
+    if os.path.exists(delta_file):
+        too_big = os.path.getsize(delta_file) > compact_ratio * \
+            os.path.getsize(file)
+        too_old = dt.datetime.now().timestamp() - os.path.getmtime(file) > \
+            compact_days * 24 * 3600
+        if too_big or too_old:
+            logging.debug("Compacting '%s' into '%s' (too big: %s, too old: %s)", delta_file, file, too_big, too_old)
+            return _item_export(session, file=file)
+
+    changed = set(_exported_changes['items'])
+    if not changed:
+        logging.info("No items changed, '%s' is up to date", file)
+        return 0
+
+    count = 0
+    with open(delta_file, 'a', encoding='utf-8') as f:
+        for record in _item_status_records(session, item_ids=changed):
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+            changed.discard(record['item_id'])
+            count += 1
+        for item_id in sorted(changed):
+            # No longer in the database
+            f.write(json.dumps({"item_id": item_id, "deleted": True}) + '\n')
+            count += 1
+        f.flush()
+        os.fsync(f.fileno())
+
+    _exported_changes['items'].clear()
+    logging.info("Added %s changed items to '%s'", count, delta_file)
+    return count
+
+
+def _mark_changed(session, item_ids=None):
+    '''
+    Remember which items were changed in the current transaction (for '_item_export_changes()')
 
-def _item_import(session, file):
+    Needed for bulk statements, ORM flushes are tracked automatically. None marks all items as changed.
+    '''
+    if item_ids is None:
+        session.info['changed_all'] = True
+    else:
+        session.info.setdefault('changed_items', set()).update(item_ids)
+
+
+@db.event.listens_for(Session, 'after_flush')
+def _track_changed_items(session, flush_context):
+    '''Session event: collect the items touched by a flush, either directly or through their storage rows'''
+    changed = set()
+    for instance in itertools.chain(session.new, session.dirty, session.deleted):
+        if isinstance(instance, Item):
+            changed.add(instance.id)
+        elif isinstance(instance, Storage):
+            changed.add(instance.item_id)
+    changed.discard(None)
+    if changed:
+        _mark_changed(session, changed)
+
+
+@db.event.listens_for(Session, 'after_commit')
+def _commit_changed_items(session):
+    '''Session event: the collected changes are saved, so they need to be exported'''
+    if session.info.pop('changed_all', False):
+        _exported_changes['all'] = True
+    _exported_changes['items'].update(session.info.pop('changed_items', ()))
+
+
+@db.event.listens_for(Session, 'after_rollback')
+def _rollback_changed_items(session):
+    '''Session event: the collected changes were discarded'''
+    session.info.pop('changed_all', None)
+    session.info.pop('changed_items', None)
+
+
+def _read_records(file, buffer_size=65536):
+    '''
+    Generator that yields the records of a JSON file one at a time without loading the whole file
+
+    The file can either be a JSON array of objects (as produced by '_item_export()') or NDJSON (one object per line).
+    '''
+    decoder = json.JSONDecoder()
+    with open(file, encoding='utf-8') as json_file:
+        buffer = json_file.read(buffer_size).lstrip()
+        if not buffer.startswith('['):
+            # NDJSON - one record per line
+            lines = buffer.splitlines(keepends=True)
+            buffer = lines.pop() if lines and not lines[-1].endswith('\n') else ''
+            for line in lines:
+                if line.strip():
+                    yield json.loads(line)
+            for line in json_file:
+                line = buffer + line
+                buffer = ''
+                if line.strip():
+                    yield json.loads(line)
+            if buffer.strip():
+                yield json.loads(buffer)
+            return
+
+        # JSON array - decode one element at a time from a rolling buffer
+        position = 1
+        while True:
+            # Skip whitespace and separators between the elements
+            while True:
+                while position < len(buffer) and buffer[position] in ' \t\r\n,':
+                    position += 1
+                if position < len(buffer):
+                    break
+                buffer, position = json_file.read(buffer_size), 0
+                if not buffer:
+                    raise ValueError(f"Unexpected end of file in '{file}'")
+            if buffer[position] == ']':
+                return
+            while True:
+                try:
+                    record, end = decoder.raw_decode(buffer, position)
+                    break
+                except json.JSONDecodeError:
+                    more = json_file.read(buffer_size)
+                    if not more:
+                        raise
+                    buffer, position = buffer[position:] + more, 0
+            yield record
+            position = end
+
+
+def _item_status_with_changes(file):
+    '''
+    Generator that yields the records of an item export with the changes in '<file>.delta' folded in
+
+    As when reading the changes file on its own, later lines win over earlier lines and over the snapshot. Deleted
+    items are left out and items that are only in the changes file come last.
+    '''
+    delta_file = file + '.delta'
+    if not os.path.exists(delta_file):
+        yield from _read_records(file)
+        return
+    changes = {}
+    for record in _read_records(delta_file):
+        changes[record.get('item_id')] = record
+    logging.info("Folding the %s changed items of '%s' into '%s'", len(changes), delta_file, file)
+    for record in _read_records(file):
+        record = changes.pop(record.get('item_id'), record)
+        if not record.get('deleted'):
+            yield record
+    for record in changes.values():
+        if not record.get('deleted'):
+            yield record
+
+
+def _chunked(iterable, size):
+    '''Generator that yields lists of up to size elements from iterable'''
+    chunk = []
+    for element in iterable:
+        chunk.append(element)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+@instrumentation.measured
+def _item_import(session, file, dry_run=False, chunk_size=500):
     '''
     Helper function to import JSON and update the Item values accordingly -- both stock count and minimum limits
 
-    The file is expected to be in the same format as produced by '_item_export()'.
+    The file is expected to be in the same format as produced by '_item_export()' (or NDJSON with the same records).
+    The changes '_item_export_changes()' appended to '<file>.delta' since are folded in, so the stock of an edited
+    snapshot is not reset to what it was at the last full export. It is read in chunks; per chunk the current values and stock counts are fetched with one query and the changes
+    are written as bulk updates/inserts. Everything is committed in one transaction at the end.
     Renames the file to avoid multiple imports of the data data
 
     Parameters:
         file (str): the name of the JSON file with the items
+        dry_run (boolean): Only print the changes, nothing is saved and the file is not renamed
+        chunk_size (int): The number of records handled per round trip
+
+    Returns:
+        dict with the number of 'records' read, 'items_updated', 'stock_updated' and 'skipped' (or None if the file can't be read)
     '''
 
     # The given file should be in the main directory and will be renamed to *.bak after import
-    try:
-        with open(file, encoding='utf-8') as json_file:
-            data = json.load(json_file)
-    except FileNotFoundError as e:
-        logging.error(f"Error opening {file}! Error message '{e}'")
+    if not os.path.exists(file):
+        logging.error("Error opening %s! The file does not exist", file)
         return None
 
-    # loop the items in the file
-    for record in data:
-        item_id = record.get('item_id', None)
-        stock_count = record.get('stock_count', 0)
-        min_limit = record.get('min_limit', 0)
-        std_duration = record.get('standard_duration', None)
-
-        item = _create(session, Item, id=item_id)[0]
-
-        logging.debug(
-            f"Updating item {item.name} (id: {item.id}) with MinLimit: '{min_limit}' and StdDuration: '{std_duration}'")
-
-        item.set_min(min_limit)
-        item.set_std_dur(std_duration)
+    result = {'records': 0, 'items_updated': 0,
+              'stock_updated': 0, 'skipped': 0}
+    try:
+        for records in _chunked(_item_status_with_changes(file), chunk_size):
+            result['records'] += len(records)
+            item_ids = [record.get('item_id', None) for record in records]
+
+            # One query for the current values and stock of the whole chunk
+            current = {row.id: row for row in session.query(
+                Item.id, Item.name, Item.min_limit, Item.standard_duration,
+                coalesce(ItemStock.portions, 0).label('stock_count')
+            ).outerjoin(ItemStock, ItemStock.item_id == Item.id).filter(Item.id.in_(item_ids))}
+
+            item_updates = []
+            stock_updates = {}
+            for record in records:
+                item_id = record.get('item_id', None)
+                stock_count = record.get('stock_count', 0)
+                min_limit = record.get('min_limit', 0)
+                std_duration = record.get('standard_duration', None)
+
+                row = current.get(item_id)
+                if row is None:
+                    logging.warning("Item with id '%s' from '%s' does not exist, skipping it", item_id, file)
+                    result['skipped'] += 1
+                    continue
 
-        current_stock = _get_portions_by_item(session, item_id=item_id)
+                if (row.min_limit, row.standard_duration) != (min_limit, std_duration):
+                    logging.debug(
+                        "Updating item %s (id: %s) with MinLimit: '%s' and StdDuration: '%s'",
+                        row.name, item_id, min_limit, std_duration)
+                    item_updates.append({'id': item_id,
+                                         'min_limit': min_limit,
+                                         'standard_duration': std_duration})
+                    if dry_run:
+                        print(f"Item: {row.name} (id: {item_id}) min limit {row.min_limit} -> {min_limit}, "
+                              f"standard duration {row.standard_duration} -> {std_duration}")
+
+                if stock_count != row.stock_count:
+                    stock_updates[item_id] = stock_count
+                    if dry_run:
+                        print(
+                            f"Item: {row.name} (id: {item_id}) stock {row.stock_count} -> {stock_count}")
+
+            result['items_updated'] += len(item_updates)
+            result['stock_updated'] += len(stock_updates)
+            if dry_run:
+                continue
+            if item_updates:
+                session.execute(db.update(Item), item_updates)
+                _mark_changed(session, [u['id'] for u in item_updates])
+            if stock_updates:
+                logging.debug(
+                    "Updating the stored item count of %s items based on the imported file", len(stock_updates))
+                _set_item_portions(session, stock_updates, source='import')
+
+        if dry_run:
+            session.rollback()
+        else:
+            session.commit()
+    except Exception:
+        session.rollback()
+        raise
 
-        if stock_count != current_stock:
-            logging.debug(
-                "Updating the stored item count based on the imported file")
-            current_contents = _reset_item_portions(session,
-                                                    item_id=item_id,
-                                                    new_count=stock_count)
+    logging.info("Imported '%s'%s: %s", file, ' (dry run)' if dry_run else '', result)
+    if dry_run:
+        return result
 
     # then rename the file
     backup_file = file+'.bak'
     if os.path.exists(backup_file):
-        logging.debug(
-            f"It looks like there is already a backed up file {backup_file}, so deleting it first")
+        logging.debug("It looks like there is already a backed up file %s, so deleting it first", backup_file)
         os.remove(backup_file)
-    logging.debug(
-        f"Renaming the imported file ({file}) to {backup_file}, so it won't be imported again")
+    logging.debug("Renaming the imported file (%s) to %s, so it won't be imported again", file, backup_file)
     os.rename(file, backup_file)
+    # The changes file belongs to the imported snapshot
+    if os.path.exists(file + '.delta'):
+        os.replace(file + '.delta', backup_file + '.delta')
+
+    return result
 
 
 def teardown(session):
     '''Close the setup gracefully'''
-    _item_export(session)
+    _item_export_changes(session)
     session.close()
     logging.info('** Program closing down!')
 
 
+@instrumentation.measured
 def add_item(session, name, group, item_id=None, **kwargs):
     '''Create a new item or update existing one
 
@@ -250,48 +826,49 @@ def add_item(session, name, group, item_id=None, **kwargs):
     # find the container
     # check if the item already exists, by id or name
     # associate the barcode to the item (get_or_create)
-    # add the item (get_or_create)
-    # specify min_limit to the item (get_or_create)
-    # specify the standard duration to the item (get_or_create)
+    # add the item (upsert on name, group and container)
+    # specify min_limit to the item
+    # specify the standard duration to the item
     # return the item with all associated data
 
     if not session:
         return None
 
     # Find the group
-    group_id = session.query(ItemGroup.id).filter(
-        func.upper(ItemGroup.name) == group.upper()).scalar()
+    group_id = reference_cache.id_of(session, ItemGroup, group)
 
     # Find the container if given
     container = kwargs.pop('container', None)
-    if container:
-        type_id = session.query(ContainerType.id).filter(func.upper(
-            ContainerType.name) == container.upper()).scalar()
-    else:
-        type_id = None
+    type_id = reference_cache.id_of(session, ContainerType, container)
 
-    # Check if the item already exists, either by ID or Name
+    # Check if the item already exists, either by ID or by its natural key (name, group and container)
     if item_id:
         item = session.query(Item).filter(Item.id == item_id).first()
     else:
         item = session.query(Item).filter(
-            func.upper(Item.name) == name.upper()).first()
+            func.upper(Item.name) == name.upper(), Item.group_id == group_id,
+            func.coalesce(Item.type_id, 0) == (type_id or 0)).first()
         if item:
             item_id = item.id
 
-    # Associate barcode
-    barcode_id = kwargs.pop('barcode', None)
-    # TODO: Get_or_create the barcode and barcode_id and then associate it to the item
+    # Barcode is associated once the item exists
+    barcode = kwargs.pop('barcode', None)
 
     # Create new item
-    result = _create(session, Item, name=name.capitalize(),
-                     group_id=group_id, type_id=type_id, id=item_id, ** kwargs)
-    logging.debug(
-        f"Item '{name}' created? {result[1]} - {result[0]}")
+    if item:
+        result = (item, False)
+    else:
+        item = _upsert(session, Item, dict(name=name.capitalize(), group_id=group_id,
+                                           type_id=type_id, **kwargs), instances=True)
+        result = (item, True)
+    logging.debug("Item '%s' created? %s (id: %s)", name, result[1], result[0].id)
     session.flush()
+    # The upsert is a bulk statement, so the new item is not tracked by the flush
+    _mark_changed(session, [result[0].id])
 
-    barcode = None
-    standard_duration = None
+    # Associate barcode
+    if barcode:
+        barcode_index.associate(session, barcode, result[0].id, commit=False)
 
     if kwargs.get('min_limit', ''):
         result[0].set_min(kwargs['min_limit'])
@@ -303,27 +880,117 @@ def add_item(session, name, group, item_id=None, **kwargs):
     return result
 
 
-def add_to_stock(session, item_id, location_id, portions, expiration_date=None):
-    '''Helper method to put items in stock'''
+@instrumentation.measured
+def add_to_stock(session, item_id, location_id, portions, expiration_date=None, interactive=True, default_expiry_days=None,
+                 commit=True):
+    '''
+    Helper method to put items in stock
+
+    Without an expiration date the item's standard duration is used. If the item has none either, the user is
+    asked - or, when not interactive, default_expiry_days is used (no expiry if that isn't given either).
+    With commit=False the new row is only flushed, and committing is left to the caller's transaction.
+    '''
     storage_date = dt.datetime.today().date()
-    item = _create(session, Item, id=item_id)[0]
+    item = session.get(Item, item_id)
+    if item is None:
+        raise ValueError(f"No item with id {item_id}")
     if expiration_date is not None:
         expiry_date = expiration_date
     elif item.get_std_dur() is not None:
         expiry_date = (dt.datetime.today() + dt.timedelta(item.get_std_dur())
                        ).date()
+    elif not interactive:
+        expiry_date = None
+        if default_expiry_days is not None:
+            expiry_date = storage_date + dt.timedelta(default_expiry_days)
     else:
         expiry_date = get_input_str("What is the expiry date? (YYYY-MM-DD or Blank for none)",
                                     valid_date=True, accept_blank=True)
         if expiry_date == '':
             expiry_date = None
-    result = _create(session, Storage, item_id=item_id, storage_date=storage_date,
+    # Every addition is its own storage row (a get_or_create would merge identical additions)
+    result = Storage(item_id=item_id, storage_date=storage_date,
                      expiration_date=expiry_date, portions=portions, location_id=location_id)
-    session.commit()
-    logging.info(f"Storage updated: {result}")
+    session.add(result)
+    _sync_item_stock(session, [item_id])
+    ledger.record(session, item_id, portions, 'add', location_id=location_id, storage_id=result.id)
+    if commit:
+        session.commit()
+    logging.info("Storage updated: %s portions of item %s in location %s (expires: %s)",
+                 portions, item_id, location_id, expiry_date)
     return result
 
 
+@instrumentation.measured
+def remove_from_stock(session, item_id, portions, strategy='fefo', location_id=None, delete_empty=False, commit=True):
+    '''
+    Helper method to take portions of an item out of stock
+
+    The storage rows to take from are picked in one query (using a running total in the database) and updated
+    with one batched statement.
+
+    Parameters:
+        item_id (int): The ID of the item to remove
+        portions (int): The number of portions to remove
+        strategy (str): 'fefo' (first expired, first out - rows without expiry last), 'fifo' (first stored, first out)
+                        or 'location' (the rows in location_id first, then fefo)
+        location_id (int): The location to take from first (only for the 'location' strategy)
+        delete_empty (boolean): Whether to delete the rows that are emptied instead of keeping them with 0 portions
+        commit (boolean): Whether to commit, otherwise it is left to the caller's transaction
+
+    Returns:
+        list of Allocation(storage_id, location_id, expiration_date, taken, remaining), in the order taken
+    '''
+    fefo = [Storage.expiration_date.is_(None), Storage.expiration_date,
+            Storage.storage_date, Storage.id]
+    if strategy == 'fefo':
+        ordering = fefo
+    elif strategy == 'fifo':
+        ordering = [Storage.storage_date, Storage.id]
+    elif strategy == 'location':
+        if location_id is None:
+            raise ValueError("The 'location' strategy needs a location_id")
+        ordering = [Storage.location_id != location_id] + fefo
+    else:
+        raise ValueError(f"Unknown removal strategy '{strategy}'")
+
+    # Only the rows needed to cover the portions, i.e. where the total before the row is still short
+    running = db.select(Storage.id, Storage.location_id, Storage.expiration_date, Storage.portions,
+                        func.sum(Storage.portions).over(order_by=ordering).label('running')).where(
+        Storage.item_id == item_id, Storage.portions > 0).subquery()
+    rows = session.execute(db.select(running.c.id, running.c.location_id, running.c.expiration_date, running.c.portions).where(
+        running.c.running - running.c.portions < portions).order_by(running.c.running)).all()
+
+    plan = []
+    left = portions
+    for storage_id, row_location_id, expiration_date, row_portions in rows:
+        taken = min(row_portions, left)
+        left -= taken
+        plan.append(Allocation(storage_id, row_location_id,
+                               expiration_date, taken, row_portions - taken))
+    if left > 0:
+        logging.warning("Only %s of %s portions of item %s were in stock", portions - left, portions, item_id)
+
+    emptied = [a.storage_id for a in plan if delete_empty and a.remaining == 0]
+    updated = [{'id': a.storage_id, 'portions': a.remaining}
+               for a in plan if a.storage_id not in emptied]
+    if updated:
+        session.execute(db.update(Storage), updated)
+    if emptied:
+        session.query(Storage).filter(Storage.id.in_(emptied)).delete(
+            synchronize_session='fetch')
+    for allocation in plan:
+        ledger.record(session, item_id, -allocation.taken, 'remove', location_id=allocation.location_id,
+                      storage_id=allocation.storage_id)
+    _sync_item_stock(session, [item_id])
+    _mark_changed(session, [item_id])
+    if commit:
+        session.commit()
+    logging.info(
+        "Removed %s portions of item %s from %s storage rows (%s)", portions - left, item_id, len(plan), strategy)
+    return plan
+
+
 def _get_portions_by_item(session, item_id):
     '''
     Helper method to return number of portions in stock for a given item
@@ -335,12 +1002,133 @@ def _get_portions_by_item(session, item_id):
         total_portions (int): The total number of portions across all storage rows for that item
     '''
 
-    stock_rows = list_stock(session, item_id=item_id, exclude_empty=True)
-    total_portions = 0
-    for row in stock_rows:
-        total_portions += row.portions
+    total_portions = session.query(ItemStock.portions).filter(
+        ItemStock.item_id == item_id).scalar()
+
+    return total_portions or 0
+
+
+def _sync_item_stock(session, item_ids, chunk_size=500):
+    '''
+    Helper method to bring the aggregated stock ('ItemStock') up to date for the given items
+
+    Must be called in the same transaction as the changes to the storage rows of those items. Only rows with
+    portions in stock are counted, so removing zero rows ('_purge_zero_stock') never changes the aggregates.
 
-    return total_portions
+    Parameters:
+        item_ids (list): The IDs of the items whose storage rows changed
+    '''
+    session.flush()
+    for ids in _chunked(set(item_ids), chunk_size):
+        totals = {item_id: {'item_id': item_id, 'portions': 0, 'row_count': 0, 'earliest_expiry': None}
+                  for item_id in ids}
+        for item_id, portions, row_count, earliest_expiry in session.query(
+                Storage.item_id, func.sum(Storage.portions), func.count(Storage.id), func.min(Storage.expiration_date)).filter(
+                Storage.item_id.in_(ids)).filter(Storage.portions > 0).group_by(Storage.item_id):
+            totals[item_id].update(portions=portions, row_count=row_count,
+                                   earliest_expiry=earliest_expiry)
+        _upsert(session, ItemStock, list(totals.values()))
+    return None
+
+
+@instrumentation.measured
+def check_item_stock(session, repair=False):
+    '''
+    Consistency check of the aggregated stock ('ItemStock') and of the ledger against the storage rows
+
+    Parameters:
+        repair (boolean): Whether to rebuild the aggregates of the items that don't match and record corrections
+                          for the ledger balances that don't match (and commit)
+
+    Returns:
+        list of the IDs of the items whose aggregates or ledger balances didn't match
+    '''
+    expected = {item_id: (portions, row_count, earliest_expiry) for item_id, portions, row_count, earliest_expiry in session.query(
+        Storage.item_id, func.sum(Storage.portions), func.count(Storage.id), func.min(Storage.expiration_date)).filter(
+        Storage.portions > 0).group_by(Storage.item_id)}
+    actual = {row.item_id: (row.portions, row.row_count, row.earliest_expiry) for row in session.query(
+        ItemStock.item_id, ItemStock.portions, ItemStock.row_count, ItemStock.earliest_expiry)}
+
+    mismatches = []
+    for item_id, in session.query(Item.id).order_by(Item.id):
+        if expected.get(item_id, (0, 0, None)) != actual.get(item_id, (0, 0, None)):
+            mismatches.append(item_id)
+    logging.info("Stock consistency check found %s items not matching their storage rows", len(mismatches))
+
+    # The ledger should add up to the storage rows per item and location
+    in_storage = {(item_id, location_id): portions for item_id, location_id, portions in session.query(
+        Storage.item_id, Storage.location_id, func.sum(Storage.portions)).filter(
+        Storage.portions > 0).group_by(Storage.item_id, Storage.location_id)}
+    in_ledger = ledger.balances(session)
+    differences = {key: in_storage.get(key, 0) - in_ledger.get(key, 0) for key in in_storage.keys() | in_ledger.keys()
+                   if in_storage.get(key, 0) != in_ledger.get(key, 0)}
+    ledger_mismatches = sorted({item_id for item_id, _ in differences})
+    logging.info("Ledger check found %s items not matching their storage rows", len(ledger_mismatches))
+
+    if repair and (mismatches or differences):
+        _sync_item_stock(session, mismatches)
+        # The stock count is part of the exported record
+        _mark_changed(session, mismatches)
+        for (item_id, location_id), delta in differences.items():
+            ledger.record(session, item_id, delta, 'correction', location_id=location_id)
+        session.commit()
+        logging.info("Rebuilt the stock of items %s and corrected the ledger of items %s", mismatches,
+                     ledger_mismatches)
+
+    return sorted(set(mismatches) | set(ledger_mismatches))
+
+
+def _set_item_portions(session, new_counts, source='correction'):
+    '''
+    Helper method to reset the number of portions in stock for many items at once with bulk statements
+
+    For each item all storage rows are set to 0 and the newest storage row is updated to the new count,
+    items without any storage rows get a new row. The differences are recorded in the ledger. Nothing is committed.
+
+    Parameters:
+        new_counts (dict): The new number of portions by item_id
+        source (str): The source of the movements, e.g. 'correction' or 'import'
+    '''
+    if not new_counts:
+        return None
+    item_ids = list(new_counts)
+
+    # The newest storage row of each item keeps the stock
+    newest = dict(session.query(Storage.item_id, func.max(Storage.id)).filter(
+        Storage.item_id.in_(item_ids)).group_by(Storage.item_id))
+
+    # The changes of the rows in stock (and of the newest rows) go to the ledger
+    for storage_id, item_id, location_id, portions in session.query(
+            Storage.id, Storage.item_id, Storage.location_id, Storage.portions).filter(
+            Storage.item_id.in_(item_ids)).filter(db.or_(Storage.portions > 0, Storage.id.in_(list(newest.values())))):
+        new_count = new_counts[item_id] if storage_id == newest[item_id] else 0
+        ledger.record(session, item_id, new_count - (portions or 0), source, location_id=location_id,
+                      storage_id=storage_id)
+
+    session.query(Storage).filter(Storage.item_id.in_(item_ids)).filter(Storage.portions > 0).filter(
+        Storage.id.notin_(list(newest.values()))).update({Storage.portions: 0}, synchronize_session='fetch')
+    if newest:
+        session.execute(db.update(Storage), [{'id': storage_id, 'portions': new_counts[item_id]}
+                                             for item_id, storage_id in newest.items()])
+
+    # Items that were never in stock get a new storage row
+    missing = [item_id for item_id in item_ids
+               if item_id not in newest and new_counts[item_id] > 0]
+    if missing:
+        today = dt.date.today()
+        new_rows = []
+        for item_id, std_duration in session.query(Item.id, Item.standard_duration).filter(Item.id.in_(missing)):
+            expiry_date = today + \
+                dt.timedelta(std_duration) if std_duration is not None else None
+            new_rows.append({'item_id': item_id, 'storage_date': today, 'expiration_date': expiry_date,
+                             'portions': new_counts[item_id], 'location_id': None})
+            ledger.record(session, item_id, new_counts[item_id], source)
+        session.execute(db.insert(Storage), new_rows)
+
+    _sync_item_stock(session, item_ids)
+    _mark_changed(session, item_ids)
+    logging.debug("Updated the storage rows of %s items", len(item_ids))
+    return None
 
 
 def _reset_item_portions(session, item_id, new_count):
@@ -355,16 +1143,10 @@ def _reset_item_portions(session, item_id, new_count):
     Returns:
         The updated storage rows for that item
     '''
-    current_contents = list_stock(session, item_id=item_id, exclude_empty=True)
-    for row in current_contents:
-        row.portions = 0
-        logging.debug(f"Updated storage row {row} to 0 portions in stock")
-        current_contents[-1].portions = updated_count
-        logging.debug(
-            f"Updated storage row {row} to have {updated_count} portions in stock")
-        session.flush()
+    _set_item_portions(session, {item_id: new_count})
+    session.flush()
 
-    return current_contents
+    return list_stock(session, item_id=item_id, exclude_empty=True)
 
 
 def _confirm_stock(session, item_id):
@@ -417,14 +1199,86 @@ def _get_items_by_group(session, group_id):
         yield row
 
 
+# Statement builders, shared by the functions below and their async versions in aio.py
+
+def _zero_stock_delete():
+    '''The statement that removes the storage rows without portions'''
+    return db.delete(Storage).where(Storage.portions <= 0)
+
+
+def _stock_select(item_id=None, exclude_empty=True):
+    '''The storage rows (with their item), for one item or all'''
+    stmt = db.select(Storage).options(joinedload(Storage.item))
+    if item_id:
+        stmt = stmt.where(Storage.item_id == item_id)
+    if exclude_empty:
+        stmt = stmt.where(Storage.portions > 0)
+    return stmt
+
+
+def _items_with_stock_select(item_id=None, exclude_empty=True):
+    '''The items with their number of portions in stock, ordered by id'''
+    stmt = db.select(Item, coalesce(ItemStock.portions, 0)).outerjoin(
+        ItemStock, Item.id == ItemStock.item_id)
+    if item_id:
+        # get only for that specific item
+        stmt = stmt.where(Item.id == item_id)
+    if exclude_empty:
+        # omit items not in stock
+        stmt = stmt.where(ItemStock.portions > 0)
+    return stmt.order_by(Item.id)
+
+
+def _deficits_select():
+    '''The (name, id, number missing) of the items below their minimum limits, ordered by id'''
+    # All items with their current count (including the items without anything in storage)
+    count = coalesce(ItemStock.portions, 0)
+    return db.select(Item.name, Item.id, Item.min_limit - count).outerjoin(
+        ItemStock, Item.id == ItemStock.item_id).where(Item.min_limit > count).order_by(Item.id)
+
+
+def _expired_select(today=None):
+    '''The storage rows (with their item) in stock that are past their date'''
+    today = today or dt.date.today()
+    return db.select(Storage).options(joinedload(Storage.item)).where(
+        Storage.expiration_date < today).where(Storage.portions > 0)
+
+
+# The sort orders of 'stock_view()'; rows without an expiry date come after those with one
+_STOCK_VIEW_ORDER = {
+    'item': lambda: (Item.name, Item.id, Storage.expiration_date.is_(None), Storage.expiration_date, Storage.id),
+    'location': lambda: (Location.name.is_(None), Location.name, Item.name, Item.id,
+                         Storage.expiration_date.is_(None), Storage.expiration_date, Storage.id),
+    'expiry': lambda: (Storage.expiration_date.is_(None), Storage.expiration_date, Item.name, Storage.id),
+}
+
+
+def _stock_view_select(item_id=None, location_id=None, expired=False, exclude_empty=True, order_by='item'):
+    '''The storage rows as the columns of StockRow, with the item, container and location names joined in'''
+    stmt = db.select(Storage.id, Storage.item_id, Item.name, ContainerType.name, Location.name, Storage.portions,
+                     Storage.storage_date, Storage.expiration_date).join(
+        Item, Storage.item_id == Item.id).outerjoin(
+        ContainerType, Item.type_id == ContainerType.id).outerjoin(
+        Location, Storage.location_id == Location.id)
+    if item_id:
+        stmt = stmt.where(Storage.item_id == item_id)
+    if location_id:
+        stmt = stmt.where(Storage.location_id == location_id)
+    if expired:
+        stmt = stmt.where(Storage.expiration_date < dt.date.today())
+    if exclude_empty or expired:
+        stmt = stmt.where(Storage.portions > 0)
+    return stmt.order_by(*_STOCK_VIEW_ORDER[order_by]())
+
+
 def _purge_zero_stock(session):
-    '''Prune the zero items from the stock'''
-    result = session.query(Storage).filter(Storage.portions <= 0).delete()
-    logging.info(
-        f"Database clean-up. Clearing zero portion rows from the storage database, removed {result} rows.")
+    '''Prune the zero items from the stock (the aggregated stock only counts rows in stock, so it is not affected)'''
+    result = session.execute(_zero_stock_delete()).rowcount
+    logging.info("Database clean-up. Clearing zero portion rows from the storage database, removed %s rows.", result)
     return None
 
 
+@instrumentation.measured
 def list_stock(session, item_id=None, exclude_empty=True):
     '''Helper function list the items from the stock
 
@@ -435,22 +1289,105 @@ def list_stock(session, item_id=None, exclude_empty=True):
     Returns:
         list of the storage rows
     '''
+    return session.scalars(_stock_select(item_id, exclude_empty)).all()
 
-    if item_id and exclude_empty:
-        storage_rows = session.query(Storage).filter(
-            Storage.item_id == item_id).filter(Storage.portions > 0).all()
-    elif item_id:
-        storage_rows = session.query(Storage).filter(
-            Storage.item_id == item_id).all()
-    elif exclude_empty:
-        storage_rows = session.query(Storage).filter(
-            Storage.portions > 0).all()
-    else:
-        storage_rows = session.query(Storage).all()
 
-    return storage_rows
+@instrumentation.measured
+def stock_view(session, item_id=None, location_id=None, expired=False, exclude_empty=True, order_by='item',
+               group_by=None):
+    '''
+    Read-only listing of the storage rows, from one joined query without loading any ORM objects
+
+    Parameters:
+        item_id (int): Only the rows of this item
+        location_id (int): Only the rows in this location
+        expired (boolean): Only the rows in stock that are past their date
+        exclude_empty (boolean): Whether to exclude rows with 0 or less portions
+        order_by (str): 'item' (name, then expiry), 'location' (name, then item) or 'expiry' (earliest first)
+        group_by (str): 'item' or 'location' to group the rows (and sort them that way)
+
+    Returns:
+        list of StockRow, or with group_by a dict of those lists by item_id or location name
+    '''
+    result = session.execute(_stock_view_select(item_id, location_id, expired, exclude_empty, group_by or order_by))
+    return _stock_rows(result, group_by)
+
+
+def _stock_rows(result, group_by=None):
+    '''Helper function to turn the rows of '_stock_view_select()' into StockRow, grouped like 'stock_view()' does'''
+    rows = [StockRow(*row) for row in result]
+    if not group_by:
+        return rows
+    key = attrgetter('item_id' if group_by == 'item' else 'location')
+    return {group: list(group_rows) for group, group_rows in itertools.groupby(rows, key)}
+
+
+def _end_of(moment):
+    '''Helper function for the moment a date or datetime stands for: a date means the end of that day'''
+    if isinstance(moment, dt.datetime):
+        return moment
+    return dt.datetime.combine(moment, dt.time.max)
+
+
+@instrumentation.measured
+def stock_as_of(session, moment, item_id=None, location_id=None):
+    '''
+    The stock at a moment in the past, from the stock movement ledger
+
+    The latest checkpoint before that moment plus the movements since are added up, so it never replays more
+    than 'PAI_CHECKPOINT_MOVEMENTS' movements, however long the history is.
+
+    Parameters:
+        moment (date or datetime): A date means the end of that day
+        item_id (int): Only this item
+        location_id (int): Only this location
+
+    Returns:
+        dict of the portions by (item_id, location_id), only those with portions
+    '''
+    movement_id = ledger.movement_at(session, _end_of(moment))
+    if movement_id is None:
+        return {}
+    return ledger.balances(session, item_id, location_id, movement_id=movement_id)
+
+
+@instrumentation.measured
+def stock_history(session, item_id, days=90, location_id=None):
+    '''
+    The stock of an item at the end of each of the last days, with what was added and taken out that day
 
+    Parameters:
+        days (int): The number of days, today included
+        location_id (int): Only this location (default: all of them)
 
+    Returns:
+        list of (date, portions, added, taken) tuples, oldest first
+    '''
+    ledger.write_pending(session)
+    today = dt.date.today()
+    first = today - dt.timedelta(days - 1)
+    start_id = ledger.movement_at(session, _end_of(first - dt.timedelta(1))) or 0
+    portions = sum(ledger.balances(session, item_id, location_id, movement_id=start_id).values()) if start_id else 0
+
+    added, taken = {}, {}
+    stmt = db.select(StockMovement.timestamp, StockMovement.delta).where(
+        StockMovement.item_id == item_id, StockMovement.id > start_id)
+    if location_id is not None:
+        stmt = stmt.where(StockMovement.location_id == location_id)
+    for timestamp, delta in session.execute(stmt):
+        day = min(max(timestamp.date(), first), today)
+        changes = added if delta > 0 else taken
+        changes[day] = changes.get(day, 0) + abs(delta)
+
+    history = []
+    for number in range(days):
+        day = first + dt.timedelta(number)
+        portions += added.get(day, 0) - taken.get(day, 0)
+        history.append((day, portions, added.get(day, 0), taken.get(day, 0)))
+    return history
+
+
+@instrumentation.measured
 def list_items_with_stock_count(session, item_id=None, exclude_empty=True):
     '''Helper function to list all items and their current number in stock
 
@@ -461,30 +1398,7 @@ def list_items_with_stock_count(session, item_id=None, exclude_empty=True):
     Returns:
         list of tuples (Item, stockCount)
     '''
-
-    stmt = session.query(Storage.portions, Storage.item_id, func.sum(
-        Storage.portions).label('stored_count')).group_by(Storage.item_id).subquery()
-
-    item_list = []
-
-    if item_id and exclude_empty:
-        # get only for that specific item and omit items not in stock
-        for item, count in session.query(Item, coalesce(stmt.c.stored_count, 0)).outerjoin(stmt, Item.id == stmt.c.item_id).filter(Item.id == item_id).filter(stmt.c.stored_count > 0).order_by(Item.id):
-            item_list.append((item, count))
-    elif item_id:
-        # get only for that specific item regardless of whether it is in stock
-        for item, count in session.query(Item, coalesce(stmt.c.stored_count, 0)).outerjoin(stmt, Item.id == stmt.c.item_id).filter(Item.id == item_id):
-            item_list.append((item, count))
-    elif exclude_empty:
-        # get all items except the ones that are not in stock
-        for item, count in session.query(Item, coalesce(stmt.c.stored_count, 0)).outerjoin(stmt, Item.id == stmt.c.item_id).filter(stmt.c.stored_count > 0).order_by(Item.id):
-            item_list.append((item, count))
-    else:
-        # get all items regardless of whether it is in stock
-        for item, count in session.query(Item, coalesce(stmt.c.stored_count, 0)).outerjoin(stmt, Item.id == stmt.c.item_id).order_by(Item.id):
-            item_list.append((item, count))
-
-    return item_list
+    return [tuple(row) for row in session.execute(_items_with_stock_select(item_id, exclude_empty))]
 
 
 def get_input_str(message, max_length=None, accept_string=None, valid_date=False, accept_blank=False):
@@ -502,7 +1416,7 @@ def get_input_str(message, max_length=None, accept_string=None, valid_date=False
     '''
     message += " "
     while True:
-        user_input = input(message)
+        user_input = _console['input'](message)
         try:
             if (accept_blank and user_input == ''):
                 return user_input
@@ -532,7 +1446,7 @@ def get_input_int(message, lower_bound=None, upper_bound=None, acceptable_values
     '''
     message += " "
     while True:
-        user_input = input(message)
+        user_input = _console['input'](message)
         try:
             if (accept_blank and user_input == ''):
                 return user_input
@@ -562,18 +1476,42 @@ def _select_group(session):
         Tuple consisting of(group_id, group_name)
     '''
     print("These are the existing item groups:")
-    for group in list_items(session, ItemGroup):
-        max_group_id = group.id
-        print(f'  {group.id}) {group.name}')
+    groups = reference_cache.names(session, ItemGroup)
+    for group_id, group_name in groups.items():
+        print(f'  {group_id}) {group_name}')
 
     group_id = get_input_int('Which group do you want to open?',
-                             lower_bound=1, upper_bound=max_group_id)
-    group_name = session.query(ItemGroup.name).filter(
-        ItemGroup.id == group_id).scalar()
+                             acceptable_values=list(groups))
+    group_name = groups[group_id]
 
     return group_id, group_name
 
 
+def _search_item(session, message="Search for an item by name (Blank to pick it from a group instead):"):
+    '''
+    Helper function to find an item by (part of) its English or Danish name, typos are tolerated
+
+    Returns:
+        The chosen item_id, '' if the user cancelled, or None if the search was left blank or found nothing
+    '''
+    text = get_input_str(message, accept_blank=True)
+    if text == '':
+        return None
+
+    # The search index is built on the first search
+    from search import search_index
+    matches = search_index.search(session, text)
+    if not matches:
+        print(f"No items match '{text}'.")
+        return None
+    print("These are the best matching items:")
+    for item_id, name, name_dk, _ in matches:
+        print(f"  {name} / {name_dk} (id: {item_id})")
+
+    return get_input_int("Which item ID do you want? (Blank to cancel)",
+                         acceptable_values=[match[0] for match in matches], accept_blank=True)
+
+
 def _select_location(session):
     '''
     Helper function to select location
@@ -582,35 +1520,30 @@ def _select_location(session):
         Tuple consisting of(location_id, location_name)
     '''
     print("The available locations are:")
-    for location in list_items(session, Location):
-        max_location_id = location.id
-        print(f'  {location.id}) {location.name}')
+    locations = reference_cache.names(session, Location)
+    for location_id, location_name in locations.items():
+        print(f'  {location_id}) {location_name}')
 
     location_id = get_input_int('Which location do you want to use?',
-                                lower_bound=1, upper_bound=max_location_id)
-    location_name = session.query(Location.name).filter(
-        Location.id == location_id).scalar()
+                                acceptable_values=list(locations))
+    location_name = locations[location_id]
 
     return location_id, location_name
 
 
-def interactivate_list_stock(session):
-    '''The interactive session to add or remove items from stock or to list expired or deficits'''
-    group_id = None
-    item = None
-
-    print("List or update stock")
-
-    ch = get_input_str("Press 'L' to list stock contents, or 'A' to add to stock, 'R' to remove from stock. Press 'Q' to go back.",
-                       max_length=1, accept_string='ALQR')
-
-    if ch.upper() == 'A':
-        # Add -- to which group?
-        location_id, _ = _select_location(session)
+def interactive_add_to_stock(session):
+    '''The interactive session to put an item in stock'''
+    # Add -- to which location?
+    location_id, _ = _select_location(session)
 
+    # Find the item by name, or pick it from its group
+    item_id = _search_item(session)
+    valid_ids = [item_id]
+    if item_id is None:
         group_id, group_name = _select_group(session)
 
-        print(f"These are the existing items in the '{group_name}' category:")
+        print(
+            f"These are the existing items in the '{group_name}' category:")
         valid_ids = []
         for item in _get_items_by_group(session, group_id):
             valid_ids.append(item.id)
@@ -618,109 +1551,102 @@ def interactivate_list_stock(session):
 
         item_id = get_input_int("Which item ID do you wish to add to stock? (Blank to cancel)",
                                 acceptable_values=valid_ids, accept_blank=True)
-        if item_id == '':
-            return menu(session)
+    if item_id == '':
+        return MAIN
 
-        portions = get_input_int("How many portions are you adding? (Blank to cancel)",
-                                 lower_bound=1, accept_blank=True)
-        if item_id in valid_ids and portions:
-            result = add_to_stock(session, item_id=item_id,
-                                  location_id=location_id,
-                                  portions=portions)
-            logging.info(f"Added {result} to stock")
+    portions = get_input_int("How many portions are you adding? (Blank to cancel)",
+                             lower_bound=1, accept_blank=True)
+    if item_id in valid_ids and portions:
+        add_to_stock(session, item_id=item_id,
+                     location_id=location_id,
+                     portions=portions)
+        logging.info("Added %s portions of item %s to stock", portions, item_id)
 
-        session.flush()
+    session.flush()
 
-        # Ask the user to confirm the stock - or update it in accordance with the visual inspection done
-        _confirm_stock(session, item_id=item_id)
+    # Ask the user to confirm the stock - or update it in accordance with the visual inspection done
+    _confirm_stock(session, item_id=item_id)
 
-        session.commit()
+    session.commit()
+    return MAIN
 
-    elif ch.upper() == 'L':
-        # Listing menu
-        ch = get_input_str("Press 'L' to list current contents, or 'E' to list expired contents, or 'D' to list deficits (missing). Press 'Q' to go back.",
-                           max_length=1, accept_string='DELQ')
-
-        if ch.upper() == 'D':
-            # Listing deficits
-            print("These are the deficits:")
-            deficits = deficit_stock(session)
-            if deficits:
-                for item_name, item_id, number_missing in deficits:
-                    print(
-                        f"Item: {item_name} (id: {item_id}) is missing {number_missing} portions.")
-            else:
-                print("Currently no deficits - all items meet minimum limits")
 
-            pause()
+def interactive_remove_from_stock(session):
+    '''The interactive session to take an item out of stock'''
+    print("These are the items in stock:")
 
-        elif ch.upper() == 'E':
-            # Listing expired items
-            expired = expired_stock(session)
+    stock_contents = stock_view(session)
 
-            if expired:
-                for row in expired:
-                    print(row.get_row(prefix='  '))
-            else:
-                print("Nothing has expired yet")
+    valid_ids = []
+    for row in stock_contents:
+        valid_ids.append(row.item_id)
+        print(row.get_row(prefix='  '))
 
-            pause()
+    item_id = get_input_int("Which item ID do you wish to update? (Blank to cancel)",
+                            acceptable_values=valid_ids, accept_blank=True)
 
-        elif ch.upper() == 'L':
-            # Listing all items (omitting empty rows)
-            stock_contents = list_stock(session, exclude_empty=True)
+    if item_id == '':
+        return MAIN
 
-            if len(stock_contents) == 0:
-                print("The stock is currently empty!")
+    # TODO: Do we want to make a check not to "over-remove" from stock? For now, I'll leave it out under the presumption that human eyes are better judges of how many items are in stock
+    portions_to_remove = get_input_int("How many portions are you removing?",
+                                       lower_bound=0)
 
-            for row in stock_contents:
-                print(row.get_row(prefix='  '))
+    # First expired, first out
+    for allocation in remove_from_stock(session, item_id=item_id, portions=portions_to_remove):
+        print(f"  Took {allocation.taken} from storage row {allocation.storage_id} "
+              f"(expires: {allocation.expiration_date}), {allocation.remaining} left")
 
-            pause()
+    # Ask the user to confirm the stock - or update it in accordance with the visual inspection done
+    _confirm_stock(session, item_id=item_id)
 
-        else:
-            return menu(session)
+    session.commit()
+    return MAIN
 
-    elif ch.upper() == 'R':
-        # Remove from stock
-        print("These are the items in stock:")
 
-        stock_contents = list_stock(session, exclude_empty=True)
+def interactive_list_stock(session):
+    '''Lists the current stock contents (omitting empty rows)'''
+    stock_contents = stock_view(session)
 
-        valid_ids = []
-        for row in stock_contents:
-            valid_ids.append(row.item_id)
-            print(row.get_row(prefix='  '))
+    if len(stock_contents) == 0:
+        print("The stock is currently empty!")
 
-        item_id = get_input_int("Which item ID do you wish to update? (Blank to cancel)",
-                                acceptable_values=valid_ids, accept_blank=True)
+    for row in stock_contents:
+        print(row.get_row(prefix='  '))
 
-        if item_id == '':
-            return menu(session)
+    pause()
+    return MAIN
 
-        # TODO: Do we want to make a check not to "over-remove" from stock? For now, I'll leave it out under the presumption that human eyes are better judges of how many items are in stock
-        portions_to_remove = get_input_int("How many portions are you removing?",
-                                           lower_bound=0)
 
-        storage_rows = list_stock(session, item_id=item_id, exclude_empty=True)
+def interactive_list_expired(session):
+    '''Lists the stock that is past its date'''
+    # Begin by removing any zero-rows from Storage (like 'expired_stock()')
+    _purge_zero_stock(session)
+    expired = stock_view(session, expired=True, order_by='expiry')
 
-        for storage_row in storage_rows:
-            temp_reduction = min(storage_row.portions, portions_to_remove)
-            storage_row.portions -= temp_reduction
-            portions_to_remove -= temp_reduction
-            logging.debug(
-                f"Removing {temp_reduction} portions from Row {storage_row}")
-            session.flush()
+    if expired:
+        for row in expired:
+            print(row.get_row(prefix='  '))
+    else:
+        print("Nothing has expired yet")
 
-        session.commit()
+    pause()
+    return MAIN
 
-        _confirm_stock(session, item_id=item_id)
 
+def interactive_list_deficits(session):
+    '''Lists the items below their minimum limits'''
+    print("These are the deficits:")
+    deficits = deficit_stock(session)
+    if deficits:
+        for item_name, item_id, number_missing in deficits:
+            print(
+                f"Item: {item_name} (id: {item_id}) is missing {number_missing} portions.")
     else:
-        # Quit -- back to menu
-        return menu(session)
+        print("Currently no deficits - all items meet minimum limits")
 
-    return menu(session)
+    pause()
+    return MAIN
 
 
 def interactive_add_update_item(session):
@@ -729,39 +1655,47 @@ def interactive_add_update_item(session):
     item = None
 
     print("Add or update items")
-    group_id, group_name = _select_group(session)
+    # Find the item to update by name, or go through its group
+    item_id = _search_item(session,
+                           "Search for an item to update by name (Blank to pick a group instead):")
+    if item_id == '':
+        return MAIN
+    elif item_id is not None:
+        item = session.get(Item, item_id)
+    else:
+        group_id, group_name = _select_group(session)
 
-    clear_screen()
-    print(f"These are the existing items in the '{group_name}' category:")
-    valid_ids = []
-    for item in _get_items_by_group(session, group_id):
-        valid_ids.append(item.id)
-        print(item.get_info(prefix='  '))
+        clear_screen()
+        print(f"These are the existing items in the '{group_name}' category:")
+        valid_ids = []
+        for item in _get_items_by_group(session, group_id):
+            valid_ids.append(item.id)
+            print(item.get_info(prefix='  '))
 
-    ch = get_input_str("Press 'C' to create a new item or 'U' to update the limit of an item. Press 'Q' to go back.",
-                       max_length=1, accept_string='CUQ')
+        ch = get_input_str("Press 'C' to create a new item or 'U' to update the limit of an item. Press 'Q' to go back.",
+                           max_length=1, accept_string='CUQ')
 
-    if ch.upper() == 'C':
-        # Create item in item group
-        name = get_input_str("What is the name of the item?").capitalize()
-        if name:
-            logging.info(f'Creating item {name} in category: \'{group_name}\'')
-            item = add_item(session, name=name, group=group_name)[0]
+        if ch.upper() == 'C':
+            # Create item in item group
+            name = get_input_str("What is the name of the item?").capitalize()
+            if name:
+                logging.info("Creating item %s in category: '%s'", name, group_name)
+                item = add_item(session, name=name, group=group_name)[0]
 
-        # then proceed with the shared steps
+            # then proceed with the shared steps
 
-    elif ch.upper() == 'U':
-        # Update item values (e.g. min_limit)
-        item_id = get_input_int("Which item ID do you wish to update? (Blank to cancel)",
-                                acceptable_values=valid_ids, accept_blank=True)
-        if item_id in valid_ids:
-            item = _create(session, Item, id=item_id)[0]
+        elif ch.upper() == 'U':
+            # Update item values (e.g. min_limit)
+            item_id = get_input_int("Which item ID do you wish to update? (Blank to cancel)",
+                                    acceptable_values=valid_ids, accept_blank=True)
+            if item_id in valid_ids:
+                item = session.get(Item, item_id)
 
-        # then proceed with the shared steps
+            # then proceed with the shared steps
 
-    else:
-        # Quit -- back to menu
-        return menu(session)
+        else:
+            # Quit -- back to menu
+            return MAIN
 
     # Shared Create/Update steps
     clear_screen()
@@ -771,16 +1705,16 @@ def interactive_add_update_item(session):
     std_duration = get_input_int("Which standard duration (in days) do you want to use? (Blank for none)",
                                  lower_bound=0, accept_blank=True)
     if min_limit:
-        logging.info(f"Specifying minimum limit to {min_limit}")
+        logging.info("Specifying minimum limit to %s", min_limit)
         item.set_min(min_limit)
     if std_duration:
-        logging.info(f"Specifying standard duration to {std_duration}")
+        logging.info("Specifying standard duration to %s", std_duration)
         item.set_std_dur(std_duration)
     session.commit()
-    logging.info(f"Item successfully updated! {item.get_info()}")
+    logging.info("Item %s successfully updated", item.id)
     print(f"Item successfully updated! {item.get_info()}")
 
-    return menu(session)
+    return MAIN
 
 
 def debug(session):
@@ -855,6 +1789,7 @@ def debug_stock(session):
         print(row.get_row(prefix='  '))
 
 
+@instrumentation.measured
 def deficit_stock(session):
     '''
 
@@ -870,46 +1805,16 @@ def deficit_stock(session):
     # Begin by removing any zero-rows from Storage
     _purge_zero_stock(session)
 
-    deficits = []
-
-    # Then build the deficits list by looking at all items with their current count (including the items without anything in storage)
-    for item, count in list_items_with_stock_count(session, item_id=None, exclude_empty=False):
-        if item.min_limit > count:
-            deficits.append((item.name, item.id, item.min_limit - count))
-        else:
-            logging.debug(
-                f"Omitting {item} with {count} portions left from the deficit list")
-
-    return deficits
+    return [tuple(row) for row in session.execute(_deficits_select())]
 
 
+@instrumentation.measured
 def expired_stock(session):
     '''Get the items that are past their date'''
     # Begin by removing any zero-rows from Storage
     _purge_zero_stock(session)
 
-    today = dt.date.today()
-
-    results = session.query(Storage).filter(
-        Storage.expiration_date < today).filter(Storage.portions > 0).all()
-
-    return results
-
-
-def exec_menu(session, choice, menu_actions):
-    clear_screen()
-    ch = str(choice)
-    logging.debug(
-        f'Menu execution of choice: {ch} against actions: {menu_actions}')
-    if ch == '':
-        main_menu(session)
-    else:
-        try:
-            menu_actions[ch](session)
-        except KeyError:
-            print("Invalid selection, please try again.\n")
-            # TODO: Is this okay? It works in my playground, but it seems like a hack. :)
-            globals()[sys._getframe().f_back.f_code.co_name](session)
+    return session.scalars(_expired_select()).all()
 
 
 def ad_hoc_import(session):
@@ -922,49 +1827,158 @@ def ad_hoc_import(session):
     filename = get_input_str("What is the filename of the JSON file with updated item values? (Blank to cancel)",
                              accept_blank=True)
     if filename == '':
-        return menu(session)
+        return MAIN
     else:
-        logging.info(f"Starting adhoc item update from file '{filename}'")
-        _item_import(session, filename)
-
-        print("Item values updated and file renamed to '.bak'.")
+        ch = get_input_str("Press 'D' for a dry run (only list the changes) or 'U' to update the items.",
+                           max_length=1, accept_string='DU')
+        dry_run = ch.upper() == 'D'
+        logging.info("Starting adhoc item update from file '%s' (dry run: %s)", filename, dry_run)
+        result = _item_import(session, filename, dry_run=dry_run)
+
+        if result is None:
+            print(f"Could not open '{filename}'.")
+        elif dry_run:
+            print(f"Dry run done, nothing was changed: {result}")
+        else:
+            print(f"Item values updated and file renamed to '.bak': {result}")
         pause()
 
-    return menu(session)
+    return MAIN
 
 
-def menu(session):
+def interactive_check_stock(session):
+    '''The interactive session to verify the aggregated stock counts against the storage rows'''
+
+    print("Check stock totals")
+    mismatches = check_item_stock(session)
+    if not mismatches:
+        print("All stock totals match the storage rows.")
+    else:
+        print(
+            f"The stock totals of {len(mismatches)} items do not match their storage rows: {mismatches}")
+        ch = get_input_str("Press 'R' to rebuild them or 'Q' to go back.",
+                           max_length=1, accept_string='RQ')
+        if ch.upper() == 'R':
+            check_item_stock(session, repair=True)
+            print("Stock totals rebuilt.")
+    pause()
+
+    return MAIN
+
+
+# The menu screens by name. An action is the name of the next screen, or a function that takes the session
+# and returns the name of the next screen (the main menu if it returns None)
+MENUS = {
+    MAIN: Screen("Welcome to Python Assisted Inventory (PAI)!", [
+        ('1', "Add or update items", interactive_add_update_item),
+        ('2', "List or update stock", 'stock'),
+        ('3', "Mass-update items", ad_hoc_import),
+        ('4', "Check stock totals", interactive_check_stock),
+        ('0', "Quit", QUIT),
+    ], "Please choose what you would like to do?"),
+    'stock': Screen("List or update stock", [
+        ('L', "List stock contents", 'stock_list'),
+        ('A', "Add to stock", interactive_add_to_stock),
+        ('R', "Remove from stock", interactive_remove_from_stock),
+        ('Q', "Go back", MAIN),
+    ], "What would you like to do?"),
+    'stock_list': Screen("List stock contents", [
+        ('L', "List current contents", interactive_list_stock),
+        ('E', "List expired contents", interactive_list_expired),
+        ('D', "List deficits (missing)", interactive_list_deficits),
+        ('Q', "Go back", MAIN),
+    ], "What would you like to list?"),
+}
+
+
+def _scripted_input(answers):
+    '''Returns an input() replacement that gives the answers in turn (echoing them), and EOFError after the last'''
+    answers = iter(answers)
+
+    def read(message):
+        answer = next(answers, None)
+        if answer is None:
+            raise EOFError
+        print(message + answer)
+        return answer
+    return read
+
+
+def _show_screen(session, screen):
+    '''
+    Shows one screen, asks for the option and carries it out
+
+    Returns:
+        The name of the next screen
+    '''
     clear_screen()
-    menu_actions = {
-        '1': interactive_add_update_item,
-        '2': interactivate_list_stock,
-        '3': ad_hoc_import,
-        '0': teardown
-    }
-    print("Welcome to Python Assisted Inventory (PAI)!")
-    print("1) Add or update items")
-    print("2) List or update stock")
-    print("3) Mass-update items")
-    print("\n0) Quit")
-    choice = get_input_int("Please choose what you would like to do?",
-                           lower_bound=0,
-                           upper_bound=int(max(menu_actions, key=int)))
-    exec_menu(session, choice, menu_actions)
+    print(screen.title)
+    for key, label, _ in screen.options:
+        if key == '0':
+            print()
+        print(f"{key}) {label}")
+    actions = {key.upper(): (label, action) for key, label, action in screen.options}
+    choice = get_input_str(screen.prompt, max_length=1,
+                           accept_string=''.join(actions)).upper()
+    logging.debug("Menu choice '%s' on screen '%s'", choice, screen.title)
+
+    label, action = actions[choice]
+    if callable(action):
+        clear_screen()
+        with instrumentation.operation(f"menu: {label}"):
+            action = action(session)
+    return action or MAIN
+
+
+def menu(session, screen=MAIN, inputs=None):
+    '''
+    Runs the menu until the user quits (or the input ends), then closes the session down
+
+    Every action returns to this loop before the next screen is shown, so the call stack stays the same depth
+    however long it runs, and each action's data is released when it returns.
+
+    Parameters:
+        screen (str): The name of the first screen (see MENUS)
+        inputs (iterable): Scripted answers to use instead of the keyboard (e.g. for tests and benchmarks); the
+                           screen isn't cleared then
+
+    Returns:
+        The number of screens shown
+    '''
+    previous = dict(_console)
+    if inputs is not None:
+        _console.update(input=_scripted_input(inputs), clear=False)
+    shown = 0
+    try:
+        while screen != QUIT:
+            screen = _show_screen(session, MENUS[screen])
+            shown += 1
+    except EOFError:
+        logging.info('The menu input ended')
+    finally:
+        _console.update(previous)
+    teardown(session)
+    return shown
 
 
 if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        # A command instead of the menu, see cli.py
+        import cli
+        sys.exit(cli.run(sys.argv[1:]))
+
     # Initialising
     setup(basedir)
     session = db_init()
 
     # Read the minimum limits from the JSON and add to DB - debug start, TODO: Improve this e.g. via Admin submenu
     #_quick_init(session, 'raw_data.json')
-    _item_export(session)
+    # The changed items are exported when the menu quits (see 'teardown()')
 
     # TODO: Turn this into proper tests
     # debug(session)
     # debug_stock(session)
 
     # Normal operation
-    logging.info('Launching the main menu for the first time')
+    logging.info('Launching the main menu')
     menu(session)
@@ -1,9 +1,12 @@
-from sqlalchemy import Column, Integer, String, Date, Boolean
+from sqlalchemy import Column, Integer, String, Date, DateTime
 from sqlalchemy import ForeignKey
 from sqlalchemy import Sequence
-from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy import Index
+from sqlalchemy import func, literal_column
+from sqlalchemy import inspect
+from sqlalchemy.orm import declarative_base
 from sqlalchemy.orm import relationship
-from sqlalchemy.sql.expression import ClauseElement
+from sqlalchemy.orm import object_session
 
 
 Base = declarative_base()
@@ -20,12 +23,20 @@ class Item(Base):
     standard_duration = Column(Integer())
     min_limit = Column(Integer())
 
+    # Natural key - the same name may exist in several containers (e.g. 'Peas (Can)' and 'Peas (Frozen)')
+    __natural_key__ = (name, group_id, func.coalesce(type_id, literal_column('0')))
+    __table_args__ = (Index('uq_item_natural_key', *__natural_key__, unique=True),
+                      Index('ix_item_group_id', group_id),
+                      # For the case-insensitive name lookups
+                      Index('ix_item_upper_name', func.upper(name)))
+
     # Relationships
     itemgroup = relationship("ItemGroup", back_populates="item")
     containertype = relationship("ContainerType", back_populates="item")
     barcode = relationship("Barcode", order_by="Barcode.id",
                            back_populates="item")
     storage = relationship("Storage", back_populates="item")
+    stock = relationship("ItemStock", uselist=False, back_populates="item")
 
     def get_name(self):
         '''Returns "Item Name" either as "Name" or "Name (Container)"'''
@@ -35,7 +46,7 @@ class Item(Base):
         return name_type
 
     def __repr__(self):
-        return f"<Item(name='{self.get_name()}', id='{self.id}', mininimum='{self.min_limit}', group_id='{self.group_id}', std_duration='{self.standard_duration}')>"
+        return f"<Item(name='{self.name}', id='{self.id}', type_id='{self.type_id}', mininimum='{self.min_limit}', group_id='{self.group_id}', std_duration='{self.standard_duration}')>"
 
     def set_min(self, minimum=None):
         '''Specify the minimum limit for the item, defaults to no limit'''
@@ -70,18 +81,32 @@ class Storage(Base):
     portions = Column(Integer())
     location_id = Column(Integer(), ForeignKey('location.id'))
 
+    __table_args__ = (Index('ix_storage_item_portions', item_id, portions),
+                      Index('ix_storage_location_id', location_id),
+                      # Only the rows in stock are ever checked for expiry
+                      Index('ix_storage_expiry_in_stock', expiration_date,
+                            sqlite_where=portions > 0, postgresql_where=portions > 0))
+
     # Relationships
     item = relationship("Item", order_by=Item.id, back_populates="storage")
     location = relationship("Location", back_populates="storage")
 
     def get_location(self):
-        return f"{self.location.name} (id: {self.location_id})"
+        if self.location_id is None:
+            # e.g. stock created by an import
+            return "Unknown location"
+        # The name comes from the reference cache instead of lazy-loading the location
+        from cache import reference_cache
+        session = object_session(self)
+        if session is None:
+            return f"{self.location.name} (id: {self.location_id})"
+        return f"{reference_cache.name_of(session, Location, self.location_id)} (id: {self.location_id})"
 
     def get_item(self):
         return f"{self.item.name} (id: {self.item_id})"
 
     def __repr__(self):
-        return f"<Storage(id='{self.id}', item='{self.get_item()}', portions='{self.portions}', storage_location='{self.get_location()}', storage_date='{self.storage_date}', expiration_date='{self.expiration_date}')>"
+        return f"<Storage(id='{self.id}', item_id='{self.item_id}', portions='{self.portions}', location_id='{self.location_id}', storage_date='{self.storage_date}', expiration_date='{self.expiration_date}')>"
 
     def get_store_info(self):
         store_info = f"{self.storage_date}"
@@ -97,12 +122,90 @@ class Storage(Base):
         return row_info
 
 
+class ItemStock(Base):
+    '''
+    The stock per item aggregated over its storage rows with portions in stock
+
+    Kept up to date by the stock helpers in main.py, so stock lookups don't have to sum the storage rows.
+    '''
+    __tablename__ = 'item_stock'
+    __natural_key__ = ('item_id',)
+
+    item_id = Column(Integer(), ForeignKey('item.id'), primary_key=True)
+    portions = Column(Integer(), nullable=False, default=0)
+    row_count = Column(Integer(), nullable=False, default=0)
+    earliest_expiry = Column(Date())
+
+    # Relationships
+    item = relationship("Item", back_populates="stock")
+
+    def __repr__(self):
+        return f"<ItemStock(item_id='{self.item_id}', portions='{self.portions}', row_count='{self.row_count}', earliest_expiry='{self.earliest_expiry}')>"
+
+
+class StockMovement(Base):
+    '''
+    One change of the stock: append-only, rows are never updated or deleted (see ledger.py)
+
+    The source says what made the change: 'add', 'remove', 'scan', 'correction', 'import' or 'opening' (the
+    stock when the ledger was started). storage_id is the storage row that changed, if known; it isn't a
+    foreign key because emptied storage rows are removed.
+    '''
+    __tablename__ = 'stock_movement'
+
+    id = Column(Integer, Sequence('stock_movement_id_seq'), primary_key=True)
+    timestamp = Column(DateTime(), nullable=False)
+    item_id = Column(Integer(), ForeignKey('item.id'), nullable=False)
+    location_id = Column(Integer(), ForeignKey('location.id'))
+    storage_id = Column(Integer())
+    delta = Column(Integer(), nullable=False)
+    source = Column(String(20), nullable=False)
+
+    __table_args__ = (Index('ix_stock_movement_item_time', item_id, timestamp),
+                      Index('ix_stock_movement_item_id', item_id, id),
+                      Index('ix_stock_movement_time', timestamp))
+
+    def __repr__(self):
+        return f"<StockMovement(id='{self.id}', timestamp='{self.timestamp}', item_id='{self.item_id}', location_id='{self.location_id}', delta='{self.delta}', source='{self.source}')>"
+
+
+class StockCheckpoint(Base):
+    '''The stock per item and location after the movement movement_id (see CheckpointBalance)'''
+    __tablename__ = 'stock_checkpoint'
+
+    id = Column(Integer, Sequence('stock_checkpoint_id_seq'), primary_key=True)
+    movement_id = Column(Integer(), nullable=False, unique=True)
+    taken_at = Column(DateTime(), nullable=False)
+
+    def __repr__(self):
+        return f"<StockCheckpoint(id='{self.id}', movement_id='{self.movement_id}', taken_at='{self.taken_at}')>"
+
+
+class CheckpointBalance(Base):
+    '''The portions of one item in one location at a checkpoint (only those with portions are kept)'''
+    __tablename__ = 'checkpoint_balance'
+
+    id = Column(Integer, Sequence('checkpoint_balance_id_seq'), primary_key=True)
+    checkpoint_id = Column(Integer(), ForeignKey('stock_checkpoint.id'), nullable=False)
+    item_id = Column(Integer(), ForeignKey('item.id'), nullable=False)
+    location_id = Column(Integer(), ForeignKey('location.id'))
+    portions = Column(Integer(), nullable=False)
+
+    __table_args__ = (Index('ix_checkpoint_balance_item', checkpoint_id, item_id),)
+
+    def __repr__(self):
+        return f"<CheckpointBalance(checkpoint_id='{self.checkpoint_id}', item_id='{self.item_id}', location_id='{self.location_id}', portions='{self.portions}')>"
+
+
 class Location(Base):
     __tablename__ = 'location'
+    __natural_key__ = ('name',)
 
     id = Column(Integer, Sequence('location_id_seq'), primary_key=True)
     name = Column(String(50))
 
+    __table_args__ = (Index('uq_location_name', name, unique=True),)
+
     # Relationships
     storage = relationship("Storage", order_by=Storage.id,
                            back_populates="location")
@@ -111,8 +214,21 @@ class Location(Base):
         return f"<Location(name='{self.name}', id='{self.id}')>"
 
 
+class AppMeta(Base):
+    '''Key/value pairs about the database itself, e.g. the schema version'''
+    __tablename__ = 'app_meta'
+    __natural_key__ = ('key',)
+
+    key = Column(String(50), primary_key=True)
+    value = Column(String(200))
+
+    def __repr__(self):
+        return f"<AppMeta(key='{self.key}', value='{self.value}')>"
+
+
 class Barcode(Base):
     __tablename__ = 'barcode'
+    __natural_key__ = ('barcode',)
 
     id = Column(Integer, Sequence('barcode_id_seq'), primary_key=True)
     barcode = Column(String(50), unique=True)
@@ -127,6 +243,7 @@ class Barcode(Base):
 
 class ItemGroup(Base):
     __tablename__ = 'itemgroup'
+    __natural_key__ = ('name',)
 
     id = Column(Integer, Sequence('itemgroup_id_seq'), primary_key=True)
     name = Column(String(50), unique=True)
@@ -140,6 +257,7 @@ class ItemGroup(Base):
 
 class ContainerType(Base):
     __tablename__ = 'containertype'
+    __natural_key__ = ('name',)
 
     id = Column(Integer, Sequence('containertype_id_seq'), primary_key=True)
     name = Column(String(50), unique=True)
@@ -152,25 +270,63 @@ class ContainerType(Base):
         return f"<ContainerType(name='{self.name}', id='{self.id}')>"
 
 
-def _create(session, model, defaults=None, id=None, **kwargs):
+def _upsert(session, model, rows, instances=False, batch_size=500):
     '''
-    Get_or_create method - defaults will overwrite **kwargs.
+    Insert or update rows on the natural key of the model (INSERT ... ON CONFLICT DO UPDATE)
 
-    :returns a tuple (instance, created):
-        instance of the data
-        boolean of whether it was created
-    '''
-    if id:
-        instance = session.query(model).filter(model.id == id).first()
-    else:
-        instance = session.query(model).filter_by(**kwargs).first()
+    Columns given in the rows overwrite the existing values, columns left out are kept as they are.
 
-    if instance:
-        return instance, False
+    Parameters:
+        model: The model class, it must define '__natural_key__'
+        rows (dict or list of dicts): The row(s) to insert or update
+        instances (boolean): Whether to return the ORM instances instead of the ids
+        batch_size (int): The number of rows per statement
+
+    Returns:
+        The primary key (or instance) for a single row, otherwise a list of them in the same order as the rows
+    '''
+    single = isinstance(rows, dict)
+    if single:
+        rows = [rows]
+
+    natural_key = getattr(model, '__natural_key__', None)
+    if not natural_key:
+        raise ValueError(f"{model.__name__} has no natural key to upsert on")
+    index_elements = [getattr(model, c) if isinstance(c, str) else c
+                      for c in natural_key]
+    key_columns = {c.key for c in index_elements if hasattr(c, 'key')}
+
+    dialect = session.get_bind().dialect.name
+    if dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+    elif dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
     else:
-        params = dict((k, v) for k, v in kwargs.items()
-                      if not isinstance(v, ClauseElement))
-        params.update(defaults or {})
-        instance = model(**params)
-        session.add(instance)
-        return instance, True
+        raise ValueError(f"Upsert is not supported for '{dialect}' databases")
+
+    results = [None] * len(rows)
+    # executemany needs the same columns in every row, so group the rows by their columns
+    shapes = {}
+    for position, row in enumerate(rows):
+        shapes.setdefault(tuple(sorted(row)), []).append(position)
+
+    for columns, positions in shapes.items():
+        stmt = insert(model)
+        update_columns = [c for c in columns if c not in key_columns and c != 'id']
+        if not update_columns:
+            # Still "update" so that RETURNING gives back the existing rows as well
+            update_columns = [c for c in columns if c in key_columns][:1]
+        stmt = stmt.on_conflict_do_update(
+            index_elements=index_elements,
+            set_={c: getattr(stmt.excluded, c) for c in update_columns})
+        returning = model if instances else inspect(model).primary_key[0]
+        stmt = stmt.returning(returning, sort_by_parameter_order=True)
+
+        for start in range(0, len(positions), batch_size):
+            batch = positions[start:start + batch_size]
+            result = session.execute(stmt, [rows[p] for p in batch],
+                                     execution_options={'populate_existing': True})
+            for position, value in zip(batch, result.scalars()):
+                results[position] = value
+
+    return results[0] if single else results
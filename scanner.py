@@ -0,0 +1,225 @@
+'''
+Batched ingestion of barcode scans, e.g. piped from a barcode scanner
+
+Each line is one scan: '[location:]barcode [+N|-N]', for example '5701234567890', 'freezer:5701234567890 +2'
+or '5701234567890 -1' (no quantity means +1). Repeated scans of the same item and location within the
+window are combined into one storage row (or one removal) and the changes are committed in batches.
+Scans that can't be resolved are appended to the quarantine file instead.
+
+Usage:
+    python scanner.py [file] [--location NAME] [--batch-size N] [--window SECONDS] [--quarantine FILE]
+                      [--default-expiry-days N]
+'''
+import os
+import re
+import sys
+import time
+import queue
+import logging
+import argparse
+import threading
+import datetime as dt
+import sqlalchemy as db
+from models import Item, Storage, Location
+from cache import barcode_index, reference_cache
+import main
+import ledger
+
+SCAN = re.compile(
+    r'^(?:(?P<location>[^:\s]+):)?(?P<code>\S+)(?:\s+(?P<quantity>[+-]\d+))?\s*$')
+
+# Marks the end of the input on the queue
+_END = object()
+
+# The shortest wait for the next scan (seconds), so a window of 0 doesn't make the loop spin
+MIN_WAIT = 0.05
+
+
+def parse_scan(line):
+    '''
+    Helper function to split a scan line
+
+    Returns:
+        Tuple consisting of (location name or None, barcode, quantity), or None if the line isn't a scan
+    '''
+    match = SCAN.match(line.strip())
+    if not match:
+        return None
+    quantity = int(match.group('quantity') or 1)
+    return match.group('location'), match.group('code'), quantity
+
+
+def _read_lines(lines, scans):
+    '''Reader thread: puts the lines on the queue, so waiting for the next scan can time out'''
+    try:
+        for line in lines:
+            scans.put(line)
+    finally:
+        scans.put(_END)
+
+
+def _quarantine(file, line, reason):
+    '''Appends a scan that couldn't be handled to the quarantine file'''
+    with open(file, 'a', encoding='utf-8') as f:
+        f.write(f"{dt.datetime.now().isoformat(timespec='seconds')}\t{reason}\t{line.strip()}\n")
+    logging.warning("Quarantined scan '%s': %s", line.strip(), reason)
+
+
+def _apply(session, changes, default_expiry_days):
+    '''
+    Writes the combined scans to the database - one storage row per item/location added, one removal per
+    item/location taken out - and commits
+
+    Parameters:
+        changes (dict): The net number of portions by (item_id, location_id)
+    '''
+    today = dt.date.today()
+    added = {key: portions for key, portions in changes.items() if portions > 0}
+    removed = {key: -portions for key, portions in changes.items() if portions < 0}
+
+    if added:
+        durations = dict(session.query(Item.id, Item.standard_duration).filter(
+            Item.id.in_({item_id for item_id, _ in added})))
+        rows = []
+        for (item_id, location_id), portions in added.items():
+            days = durations.get(item_id)
+            if days is None:
+                days = default_expiry_days
+            rows.append({'item_id': item_id, 'location_id': location_id, 'portions': portions,
+                         'storage_date': today,
+                         'expiration_date': today + dt.timedelta(days) if days is not None else None})
+        session.execute(db.insert(Storage), rows)
+        for row in rows:
+            ledger.record(session, row['item_id'], row['portions'], 'scan', location_id=row['location_id'])
+        main._sync_item_stock(session, [item_id for item_id, _ in added])
+        main._mark_changed(session, [item_id for item_id, _ in added])
+
+    for (item_id, location_id), portions in removed.items():
+        # Take from the scanned location first
+        main.remove_from_stock(session, item_id, portions, strategy='location',
+                               location_id=location_id, commit=False)
+
+    session.commit()
+    return sum(added.values()), sum(removed.values())
+
+
+def ingest_scans(session, lines, location=None, batch_size=100, window=2.0, quarantine='quarantine.txt',
+                 default_expiry_days=None):
+    '''
+    Reads scans from lines (any iterable, e.g. a file or sys.stdin) and puts them in or takes them out of stock
+
+    Never asks for input: items without a standard duration get default_expiry_days (or no expiry date).
+
+    Parameters:
+        location (str): The location for scans without a location prefix
+        batch_size (int): The number of scans per commit
+        window (float): Seconds in which repeated scans of an item/location are combined; pending scans are
+                        also committed when no scan arrives for this long (at least MIN_WAIT)
+        quarantine (str): The file unknown barcodes and invalid lines are appended to
+        default_expiry_days (int): The number of days until expiry for items without a standard duration
+
+    Returns:
+        dict with the number of 'scans', 'quarantined', 'added' and 'removed' portions and 'commits'
+    '''
+    if not barcode_index.loaded:
+        barcode_index.load(session)
+
+    result = {'scans': 0, 'quarantined': 0,
+              'added': 0, 'removed': 0, 'commits': 0}
+    pending = {}
+    opened = {}
+    scans_in_batch = 0
+
+    def flush(keys):
+        changes = {key: pending.pop(key) for key in keys}
+        for key in keys:
+            opened.pop(key)
+        if any(changes.values()):
+            added, removed = _apply(session, changes, default_expiry_days)
+            result['added'] += added
+            result['removed'] += removed
+            result['commits'] += 1
+
+    scans = queue.Queue()
+    threading.Thread(target=_read_lines, args=(lines, scans), daemon=True).start()
+    wait = max(window, MIN_WAIT)
+
+    while True:
+        try:
+            line = scans.get(timeout=wait)
+        except queue.Empty:
+            # The scanner is quiet, save what we have
+            if pending:
+                flush(list(pending))
+                scans_in_batch = 0
+            continue
+        if line is _END:
+            break
+        if not line.strip():
+            continue
+
+        result['scans'] += 1
+        parsed = parse_scan(line)
+        if parsed is None:
+            _quarantine(quarantine, line, 'invalid scan')
+            result['quarantined'] += 1
+            continue
+        location_name, code, quantity = parsed
+        item_id = barcode_index.lookup(code)
+        location_id = reference_cache.id_of(
+            session, Location, location_name or location)
+        if item_id is None:
+            _quarantine(quarantine, line, 'unknown barcode')
+            result['quarantined'] += 1
+            continue
+        if location_id is None:
+            _quarantine(quarantine, line,
+                        f"unknown location '{location_name or location}'")
+            result['quarantined'] += 1
+            continue
+
+        now = time.monotonic()
+        key = (item_id, location_id)
+        if key in opened and now - opened[key] > window:
+            # A new scan of the same item/location after the window, so it gets its own row
+            flush([key])
+        opened.setdefault(key, now)
+        pending[key] = pending.get(key, 0) + quantity
+
+        scans_in_batch += 1
+        if scans_in_batch >= batch_size:
+            flush(list(pending))
+            scans_in_batch = 0
+
+    flush(list(pending))
+    logging.info("Scan ingestion done: %s", result)
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Put scanned barcodes in or out of stock')
+    parser.add_argument('file', nargs='?',
+                        help='file with one scan per line (default: stdin)')
+    parser.add_argument('--location', default=os.environ.get('PAI_SCAN_LOCATION'),
+                        help='location for scans without a location prefix')
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--window', type=float, default=2.0)
+    parser.add_argument('--quarantine', default='quarantine.txt')
+    parser.add_argument('--default-expiry-days', type=int,
+                        default=os.environ.get('PAI_DEFAULT_EXPIRY_DAYS'))
+    args = parser.parse_args()
+
+    main.setup(main.basedir)
+    session = main.db_init()
+    if args.file:
+        with open(args.file, encoding='utf-8') as f:
+            result = ingest_scans(session, f, location=args.location, batch_size=args.batch_size,
+                                  window=args.window, quarantine=args.quarantine,
+                                  default_expiry_days=args.default_expiry_days)
+    else:
+        result = ingest_scans(session, sys.stdin, location=args.location, batch_size=args.batch_size,
+                              window=args.window, quarantine=args.quarantine,
+                              default_expiry_days=args.default_expiry_days)
+    print(result)
+    main.teardown(session)
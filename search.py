@@ -0,0 +1,244 @@
+'''
+Typo-tolerant search over the English and Danish item names
+'''
+import heapq
+import logging
+import threading
+import unicodedata
+from collections import Counter, defaultdict
+from operator import itemgetter
+import sqlalchemy as db
+from sqlalchemy import event, func
+from sqlalchemy.orm import Session
+from models import Item
+
+
+class SearchIndex:
+    '''
+    In-memory trigram index over 'Item.name' and 'Item.name_dk'
+
+    Matches are ranked by the trigram similarity of the query with either name, with a bonus when a name
+    (or a word in it) starts with the query, so both prefixes and small typos are found. The index is
+    loaded with one query on the first search and then kept up to date through session events: the items a
+    transaction changed (through the ORM or bulk statements) are re-read on the first search after its commit.
+
+    One index is shared by all threads, a lock keeps the searches from seeing it halfway through a change.
+    '''
+
+    def __init__(self):
+        # Reentrant: 'add()' removes the item first
+        self._lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        '''Empty the index, it is loaded again on the next search'''
+        with self._lock:
+            self._postings = defaultdict(set)
+            self._names = {}
+            self._grams = {}
+            # Items to re-read on the next search, by id and by (upper case) name
+            self._stale_ids = set()
+            self._stale_names = set()
+            self.loaded = False
+
+    # Letters without a decomposition, so 'kokken' finds 'Køkkenrulle' on a keyboard without them
+    _FOLD = str.maketrans({'ø': 'o', 'æ': 'ae', 'ß': 'ss'})
+
+    @classmethod
+    def _normalise(cls, text):
+        '''Case-insensitive and without accents (e.g. 'å' is 'a')'''
+        text = unicodedata.normalize('NFKD', (text or '').casefold())
+        text = ''.join(c for c in text if not unicodedata.combining(c))
+        return ' '.join(text.translate(cls._FOLD).split())
+
+    @staticmethod
+    def _trigrams(text):
+        '''The trigrams of each word, padded so that the start of a word counts more'''
+        grams = set()
+        for word in text.split():
+            padded = f'  {word} '
+            grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+        return grams
+
+    def load(self, session):
+        '''(Re)build the index from all items with one query, the searches meanwhile use the old one'''
+        fresh = SearchIndex()
+        for item_id, name, name_dk in session.query(Item.id, Item.name, Item.name_dk):
+            fresh.add(item_id, name, name_dk)
+        # The items marked as changed meanwhile are still re-read
+        with self._lock:
+            self._postings, self._names, self._grams = fresh._postings, fresh._names, fresh._grams
+            self.loaded = True
+        logging.info("Loaded %s items into the search index", len(fresh._names))
+        return len(fresh._names)
+
+    def invalidate(self):
+        '''Rebuild the index on the next search'''
+        self.loaded = False
+
+    def mark_changed(self, item_ids=(), names=()):
+        '''Re-read these items (by id, or by name for new ones) on the next search'''
+        with self._lock:
+            self._stale_ids.update(item_ids)
+            self._stale_names.update(name.upper() for name in names)
+
+    def refresh(self, session, chunk_size=500):
+        '''
+        Re-read the items marked as changed, with one query per chunk (or reload everything if that is less work)
+
+        Returns:
+            The number of items read
+        '''
+        with self._lock:
+            ids, names = self._stale_ids, self._stale_names
+            self._stale_ids, self._stale_names = set(), set()
+            size = len(self._names)
+        if len(ids) + len(names) > size // 2:
+            return self.load(session)
+        rows = {}
+        for column, keys in ((Item.id, sorted(ids)), (func.upper(Item.name), sorted(names))):
+            for start in range(0, len(keys), chunk_size):
+                for item_id, name, name_dk in session.query(Item.id, Item.name, Item.name_dk).filter(
+                        column.in_(keys[start:start + chunk_size])):
+                    rows[item_id] = (name, name_dk)
+        with self._lock:
+            for item_id, (name, name_dk) in rows.items():
+                self.add(item_id, name, name_dk)
+            # Gone from the database
+            for item_id in ids - rows.keys():
+                self.remove(item_id)
+        return len(rows)
+
+    def add(self, item_id, name, name_dk=None):
+        '''Add an item to the index, or update it if it is already there (e.g. renamed)'''
+        names = tuple(self._normalise(n) for n in (name, name_dk) if n)
+        grams = tuple(self._trigrams(n) for n in names)
+        with self._lock:
+            self.remove(item_id)
+            self._names[item_id] = (name, name_dk, names)
+            self._grams[item_id] = grams
+            for gram in set().union(*grams):
+                self._postings[gram].add(item_id)
+
+    def remove(self, item_id):
+        '''Take an item out of the index'''
+        with self._lock:
+            for grams in self._grams.pop(item_id, ()):
+                for gram in grams:
+                    self._postings[gram].discard(item_id)
+            self._names.pop(item_id, None)
+
+    def search(self, session, text, limit=10, min_score=0.2):
+        '''
+        Find the items best matching text
+
+        Returns:
+            list of tuples (item_id, name, name_dk, score), best match first
+        '''
+        if not self.loaded:
+            self.load(session)
+        elif self._stale_ids or self._stale_names:
+            self.refresh(session)
+        query = self._normalise(text)
+        query_grams = self._trigrams(query)
+        if not query_grams:
+            return []
+
+        with self._lock:
+            # Only the items sharing the most trigrams with the query are scored
+            candidates = Counter()
+            for gram in query_grams:
+                candidates.update(self._postings.get(gram, ()))
+
+            results = []
+            for item_id, _ in heapq.nlargest(limit * 10, candidates.items(), key=itemgetter(1)):
+                name, name_dk, names = self._names[item_id]
+                score = 0
+                for normalised, grams in zip(names, self._grams[item_id]):
+                    shared = len(query_grams & grams)
+                    similarity = shared / len(query_grams | grams)
+                    if normalised.startswith(query):
+                        similarity += 1
+                    elif any(word.startswith(query) for word in normalised.split()):
+                        similarity += 0.5
+                    score = max(score, similarity)
+                if score >= min_score:
+                    results.append((item_id, name, name_dk, round(score, 3)))
+        results.sort(key=lambda result: (-result[3], result[1]))
+        return results[:limit]
+
+
+# Process-wide instance
+search_index = SearchIndex()
+
+
+def _pending(session):
+    '''The items changed in the session's transaction, re-read after it commits'''
+    return session.info.setdefault('search_pending', {'ids': set(), 'names': set(), 'all': False})
+
+
+@event.listens_for(Session, 'after_flush')
+def _search_flush(session, flush_context):
+    '''Session event: note the added, renamed and deleted items'''
+    if not search_index.loaded:
+        return
+    changed = {instance.id for instance in list(session.new) + list(session.deleted) if isinstance(instance, Item)}
+    # Other changes (e.g. the minimum limit) don't change the index
+    changed.update(instance.id for instance in session.dirty if isinstance(instance, Item) and any(
+        db.inspect(instance).attrs[name].history.has_changes() for name in ('name', 'name_dk')))
+    if changed:
+        _pending(session)['ids'].update(changed)
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def _search_execute(orm_execute_state):
+    '''
+    Session event: note the items a bulk statement changes, they are re-read on the next search after the commit
+
+    Inserts (including upserts) are noted by their names, updates and deletes by the ids in their parameters
+    or, with a WHERE clause, by the ids it selects before the statement runs.
+    '''
+    if not search_index.loaded or not (
+            orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete):
+        return
+    mapper = orm_execute_state.bind_mapper
+    if mapper is None or mapper.class_ is not Item:
+        return
+    session = orm_execute_state.session
+    pending = _pending(session)
+    params = orm_execute_state.parameters
+    rows = params if isinstance(params, list) else [params] if params else []
+
+    if orm_execute_state.is_insert:
+        if rows and all(row.get('name') for row in rows):
+            pending['names'].update(row['name'] for row in rows)
+        else:
+            pending['all'] = True
+    elif rows and all('id' in row for row in rows):
+        # Bulk UPDATE/DELETE by primary key; an update of other columns doesn't change the index
+        if orm_execute_state.is_delete or any('name' in row or 'name_dk' in row for row in rows):
+            pending['ids'].update(row['id'] for row in rows)
+    else:
+        where = orm_execute_state.statement.whereclause
+        if where is None:
+            pending['all'] = True
+        else:
+            pending['ids'].update(session.scalars(db.select(Item.id).where(where)))
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _search_rollback(session, previous_transaction):
+    '''Session event: the changes were discarded'''
+    session.info.pop('search_pending', None)
+
+
+@event.listens_for(Session, 'after_commit')
+def _search_commit(session):
+    '''Session event: the changed items are committed, re-read them on the next search'''
+    pending = session.info.pop('search_pending', None)
+    if pending is None:
+        return
+    if pending['all']:
+        search_index.invalidate()
+    else:
+        search_index.mark_changed(pending['ids'], pending['names'])
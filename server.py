@@ -0,0 +1,258 @@
+'''
+HTTP/JSON service for PAI, so several devices (e.g. kitchen tablets and phones) can use the stock at once
+
+Every request runs in its own thread with its own short-lived session, taken from the engine's connection pool.
+The changes are all made by one writer thread (see writer.py), the reads run in parallel.
+The list endpoints send an ETag and answer a matching 'If-None-Match' with '304 Not Modified'.
+
+Endpoints:
+    GET  /items[?q=TEXT]               all items with their stock count, or the best matches for TEXT
+    GET  /items/ID                     one item with its storage rows
+    GET  /stock[?item=ITEM&all=1]      items with their portions in stock (all=1 includes empty items)
+    GET  /stock/rows[?item=ITEM]       the storage rows in stock
+    GET  /deficits                     items below their minimum limit
+    GET  /expired                      stock past its expiry date
+    POST /stock/add                    {"item": ITEM, "portions": N, "location": NAME, "expires": "YYYY-MM-DD"}
+    POST /stock/remove                 {"item": ITEM, "portions": N, "strategy": "fefo", "location": NAME}
+
+ITEM is an item id, barcode or name (see cli.py). Errors are answered as {"error": message}.
+
+Usage:
+    python server.py [--host HOST] [--port PORT]
+'''
+import os
+import sys
+import json
+import hashlib
+import logging
+import argparse
+import datetime as dt
+from argparse import Namespace
+from urllib.parse import urlsplit, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import sqlalchemy as db
+from sqlalchemy.pool import StaticPool
+import main
+import cli
+import instrumentation
+from writer import WriteQueue
+
+# Makes all the changes, one after the other
+write_queue = WriteQueue(main.Session)
+
+
+def _engine_options(database):
+    '''
+    The connection pool settings, from 'PAI_POOL_SIZE', 'PAI_POOL_OVERFLOW' and 'PAI_POOL_TIMEOUT'
+
+    An in-memory SQLite database only exists on its own connection, so that one connection is shared instead.
+    '''
+    url = db.engine.make_url(database)
+    if url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:'):
+        return {'poolclass': StaticPool, 'connect_args': {'check_same_thread': False}}
+    return {'pool_size': int(os.environ.get('PAI_POOL_SIZE', 5)),
+            'max_overflow': int(os.environ.get('PAI_POOL_OVERFLOW', 10)),
+            'pool_timeout': float(os.environ.get('PAI_POOL_TIMEOUT', 30)),
+            'pool_pre_ping': True}
+
+
+class HTTPError(Exception):
+    '''An error answered with its status code'''
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def _param(query, name, default=None):
+    values = query.get(name)
+    return values[0] if values else default
+
+
+def _int(value, name):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise HTTPError(400, f"'{name}' must be a number")
+
+
+def _items(session, query, body):
+    text = _param(query, 'q')
+    if text:
+        from search import search_index
+        return [{'item_id': item_id, 'name': name, 'name_dk': name_dk, 'score': score}
+                for item_id, name, name_dk, score in search_index.search(session, text, limit=25)]
+    return list(main._item_status_records(session))
+
+
+def _item(session, query, body, item_id):
+    records = list(main._item_status_records(session, item_ids=[_int(item_id, 'id')]))
+    if not records:
+        raise HTTPError(404, f"Unknown item '{item_id}'")
+    records[0]['storage'] = [cli._storage_record(row)
+                             for row in main.stock_view(session, item_id=records[0]['item_id'], order_by='expiry')]
+    return records[0]
+
+
+def _stock(session, query, body):
+    args = Namespace(item=_param(query, 'item'), rows=False)
+    if _param(query, 'all'):
+        item_id = cli._resolve_item(session, args.item) if args.item else None
+        return [{'item_id': item.id, 'name': item.get_name(), 'portions': count, 'min_limit': item.min_limit}
+                for item, count in main.list_items_with_stock_count(session, item_id=item_id, exclude_empty=False)]
+    return cli.stock_list(session, args)[0]
+
+
+def _stock_rows(session, query, body):
+    return cli.stock_list(session, Namespace(item=_param(query, 'item'), rows=True))[0]
+
+
+# These two read without the clean-up of 'main.deficit_stock()'/'main.expired_stock()': it doesn't change the
+# result, and a write on every read would make the readers wait for each other
+
+def _deficits(session, query, body):
+    return [{'item_id': item_id, 'name': name, 'missing': missing}
+            for name, item_id, missing in session.execute(main._deficits_select())]
+
+
+def _expired(session, query, body):
+    return [cli._storage_record(row) for row in main.stock_view(session, expired=True, order_by='expiry')]
+
+
+def _expires(body):
+    if body.get('expires') is None:
+        return None
+    try:
+        return dt.date.fromisoformat(body['expires'])
+    except (TypeError, ValueError):
+        raise HTTPError(400, "'expires' must be a date (YYYY-MM-DD)")
+
+
+def _stock_add(session, query, body):
+    args = Namespace(item=str(body.get('item', '')), portions=_int(body.get('portions'), 'portions'),
+                     location=body.get('location'), expires=_expires(body),
+                     default_expiry_days=body.get('default_expiry_days'))
+    if args.portions < 1:
+        raise HTTPError(400, "'portions' must be at least 1")
+    return cli.stock_add(session, args)[0]
+
+
+def _stock_remove(session, query, body):
+    args = Namespace(item=str(body.get('item', '')), portions=_int(body.get('portions'), 'portions'),
+                     strategy=body.get('strategy', 'fefo'), location=body.get('location'))
+    if args.strategy not in ('fefo', 'fifo', 'location'):
+        raise HTTPError(400, f"Unknown strategy '{args.strategy}'")
+    return cli.stock_remove(session, args)[0]
+
+
+# The endpoints by method and path: the function and whether the answer gets an ETag
+ROUTES = {
+    ('GET', '/items'): (_items, True),
+    ('GET', '/stock'): (_stock, True),
+    ('GET', '/stock/rows'): (_stock_rows, True),
+    ('GET', '/deficits'): (_deficits, True),
+    ('GET', '/expired'): (_expired, True),
+    ('POST', '/stock/add'): (_stock_add, False),
+    ('POST', '/stock/remove'): (_stock_remove, False),
+}
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    '''Answers one request with a session of its own'''
+    protocol_version = 'HTTP/1.1'
+    server_version = 'PAI'
+    # The headers and the body are written separately, don't let them wait for each other's ACK
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def _handle(self, method):
+        url = urlsplit(self.path)
+        path = url.path.rstrip('/') or '/'
+        query = parse_qs(url.query)
+        try:
+            body = self._read_body()
+            route = ROUTES.get((method, path))
+            arguments = ()
+            if route is None and method == 'GET' and path.startswith('/items/'):
+                route, arguments = (_item, True), (path[len('/items/'):],)
+            if route is None:
+                raise HTTPError(404, f"No endpoint {method} {path}")
+            function, etag = route
+            if method == 'POST':
+                result = write_queue.run(function, query, body, *arguments)
+            else:
+                with main.Session() as session, instrumentation.operation(f"GET {path}"):
+                    result = function(session, query, body, *arguments)
+            self._send(200, result, etag)
+        except HTTPError as e:
+            self._send(e.status, {'error': str(e)})
+        except cli.CommandError as e:
+            self._send(400, {'error': str(e)})
+        except Exception:
+            logging.exception("Request %s %s failed", method, self.path)
+            self._send(500, {'error': 'Internal error'})
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if not length:
+            return {}
+        try:
+            body = json.loads(self.rfile.read(length))
+        except ValueError:
+            raise HTTPError(400, 'The body is not valid JSON')
+        if not isinstance(body, dict):
+            raise HTTPError(400, 'The body must be a JSON object')
+        return body
+
+    def _send(self, status, result, etag=False):
+        content = json.dumps(result, ensure_ascii=False, default=str).encode('utf-8')
+        headers = {'Content-Type': 'application/json; charset=utf-8'}
+        if etag:
+            headers['ETag'] = tag = '"' + hashlib.sha1(content).hexdigest() + '"'
+            headers['Cache-Control'] = 'no-cache'
+            if tag in (value.strip() for value in self.headers.get('If-None-Match', '').split(',')):
+                status, content = 304, b''
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        logging.debug('%s ' + format, self.address_string(), *args)
+
+
+def create_server(host='127.0.0.1', port=8080):
+    '''Sets the database up (with a connection pool) and returns the server, call 'serve_forever()' to run it'''
+    main.db_init(**_engine_options(main._database_url())).close()
+    write_queue.start()
+    server = ThreadingHTTPServer((host, port), RequestHandler)
+    server.daemon_threads = True
+    logging.info("Serving PAI on http://%s:%s", host, server.server_port)
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='HTTP/JSON service for PAI')
+    parser.add_argument('--host', default=os.environ.get('PAI_HOST', '127.0.0.1'))
+    parser.add_argument('--port', type=int, default=int(os.environ.get('PAI_PORT', 8080)))
+    args = parser.parse_args()
+
+    main.setup(main.basedir)
+    server = create_server(args.host, args.port)
+    print(f"Serving PAI on http://{args.host}:{server.server_port} (Ctrl+C to stop)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    write_queue.stop()
+    with main.Session() as session:
+        main.teardown(session)
+    sys.exit(0)
@@ -0,0 +1,28 @@
+import os
+import sys
+import pytest
+
+# The modules live in the repository root
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from cache import reference_cache  # noqa: E402
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    '''A new SQLite file database'''
+    monkeypatch.setenv('PAI_METRICS', '0')
+    reference_cache.invalidate()
+    return 'sqlite:///' + str(tmp_path / 'inventory.db')
+
+
+@pytest.fixture
+def session(database, monkeypatch):
+    '''A session of main.py on the new database'''
+    import main
+    monkeypatch.setenv('SQLALCHEMY_DATABASE_URI', database)
+    session = main.db_init()
+    yield session
+    session.close()
+    session.get_bind().dispose()
@@ -0,0 +1,39 @@
+'''
+The non-interactive command line
+'''
+import os
+import sys
+import json
+import subprocess
+import pytest
+import cli
+import main
+from conftest import ROOT
+
+
+def test_runs_from_another_directory(database, tmp_path):
+    '''Scripts and cron jobs start it from anywhere: the defaults and logs are found next to the program'''
+    workdir = tmp_path / 'elsewhere'
+    workdir.mkdir()
+    env = dict(os.environ, SQLALCHEMY_DATABASE_URI=database, PAI_METRICS='0')
+    done = subprocess.run([sys.executable, os.path.join(ROOT, 'cli.py'), '--json', 'stock', 'list'], cwd=workdir,
+                          env=env, capture_output=True, text=True, timeout=60)
+    assert done.returncode == 0, done.stderr
+    assert json.loads(done.stdout) == []
+    assert os.listdir(workdir) == []
+
+
+def test_resolve_item_by_id_or_name(session):
+    milk, _ = main.add_item(session, 'Milk', 'beverages')
+    assert cli._resolve_item(session, str(milk.id)) == milk.id
+    assert cli._resolve_item(session, ' milk ') == milk.id
+    with pytest.raises(cli.CommandError, match='Unknown item'):
+        cli._resolve_item(session, 'Cheese')
+
+
+def test_resolve_item_name_in_several_groups(session):
+    '''The natural key is name, group and container, so a name alone can match several items'''
+    milk, _ = main.add_item(session, 'Milk', 'beverages')
+    frozen, _ = main.add_item(session, 'Milk', 'basics', container='frozen')
+    with pytest.raises(cli.CommandError, match=f"{milk.id} \\(Beverages\\), {frozen.id} \\(Basics, Frozen\\)"):
+        cli._resolve_item(session, 'Milk')
@@ -0,0 +1,48 @@
+'''
+The item export and the mass-update import reading it back
+'''
+import json
+import main
+from models import Item
+
+FRIDGE = 2
+
+
+def _edit(file, item_id, **values):
+    with open(file, encoding='utf-8') as f:
+        records = json.load(f)
+    for record in records:
+        if record['item_id'] == item_id:
+            record.update(values)
+    with open(file, 'w', encoding='utf-8') as f:
+        json.dump(records, f)
+
+
+def test_import_keeps_exported_changes(session, tmp_path):
+    '''Stock added after the full export is in the changes file, editing and importing the snapshot keeps it'''
+    file = str(tmp_path / 'item_status.json')
+    milk, _ = main.add_item(session, 'Milk', 'beverages')
+    beans, _ = main.add_item(session, 'Beans', 'vegetables')
+    main._item_export(session, file=file)
+
+    main.add_to_stock(session, milk.id, FRIDGE, 5, interactive=False)
+    assert main._item_export_changes(session, file=file) == 1
+    _edit(file, beans.id, min_limit=7)
+
+    result = main._item_import(session, file)
+    assert result['items_updated'] == 1 and result['stock_updated'] == 0
+    assert main._get_portions_by_item(session, milk.id) == 5
+    assert session.get(Item, beans.id).min_limit == 7
+    assert sorted(p.name for p in tmp_path.iterdir() if p.name.startswith('item_status')) == [
+        'item_status.json.bak', 'item_status.json.bak.delta']
+
+
+def test_import_applies_edited_stock(session, tmp_path):
+    file = str(tmp_path / 'item_status.json')
+    milk, _ = main.add_item(session, 'Milk', 'beverages')
+    main._item_export(session, file=file)
+    _edit(file, milk.id, stock_count=4)
+
+    assert main._item_import(session, file)['stock_updated'] == 1
+    assert main._get_portions_by_item(session, milk.id) == 4
+    assert main.check_item_stock(session) == []
@@ -0,0 +1,44 @@
+'''
+The consumption forecast from the removals in the ledger
+'''
+import datetime as dt
+import pytest
+import main
+import forecast
+from models import StockMovement
+
+pytest.importorskip('numpy')
+
+FRIDGE = 2
+
+TODAY = dt.date.today()
+
+
+@pytest.fixture
+def milk(session):
+    '''Milk with 20 portions added, 4 of them taken yesterday (only in the ledger) and 3 today'''
+    forecast.clear_cache()
+    item, _ = main.add_item(session, 'Milk', 'beverages')
+    main.add_to_stock(session, item.id, FRIDGE, 20, interactive=False)
+    session.add(StockMovement(timestamp=dt.datetime.combine(TODAY - dt.timedelta(1), dt.time(12)), item_id=item.id,
+                              location_id=FRIDGE, delta=-4, source='remove'))
+    session.commit()
+    main.remove_from_stock(session, item.id, 3)
+    yield item
+    forecast.clear_cache()
+
+
+def test_forecast_per_day(session, milk):
+    result = forecast.forecast(session, windows=(1, 7), lead_days=1, service_factor=0)
+    # 3 taken today and 7 in the week: 3 and 1 per day
+    assert result[milk.id] == forecast.Forecast(milk.id, 17, 2.0, (3.0, 1.0), TODAY + dt.timedelta(8), 2)
+
+
+def test_forecast_after_new_movements(session, milk):
+    forecast.forecast(session, windows=(1, 7))
+    main.remove_from_stock(session, milk.id, 1)
+    again = forecast.forecast(session, windows=(1, 7))
+    assert again[milk.id].rates == (4.0, 1.143)
+
+    forecast.clear_cache()
+    assert forecast.forecast(session, windows=(1, 7)) == again
@@ -0,0 +1,22 @@
+'''
+The query counts and timings per operation
+'''
+import json
+import instrumentation
+
+
+def test_metrics_file_is_rotated(tmp_path, monkeypatch):
+    file = tmp_path / 'metrics.jsonl'
+    monkeypatch.setitem(instrumentation.settings, 'enabled', True)
+    monkeypatch.setitem(instrumentation.settings, 'file', str(file))
+    monkeypatch.setitem(instrumentation.settings, 'max_bytes', 2048)
+    for _ in range(500):
+        with instrumentation.operation('test'):
+            pass
+    instrumentation._writer['handler'].close()
+
+    files = sorted(path.name for path in tmp_path.iterdir())
+    assert files == ['metrics.jsonl', 'metrics.jsonl.1', 'metrics.jsonl.2', 'metrics.jsonl.3']
+    assert all((tmp_path / name).stat().st_size <= 2048 for name in files)
+    with open(file, encoding='utf-8') as f:
+        assert json.loads(f.readline())['operation'] == 'test'
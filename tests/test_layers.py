@@ -0,0 +1,171 @@
+'''
+The same scenarios against the sync data access functions (main.py) and their async versions (aio.py)
+'''
+import asyncio
+import datetime as dt
+import pytest
+import main
+import aio
+
+# The ids of the defaults from 'default_values.json' in a new database
+BEVERAGES, MEAT = 2, 5
+CAN = 1
+FRIDGE, PANTRY = 2, 3
+
+TODAY = dt.date.today()
+
+
+class SyncLayer:
+    '''Calls the functions of main.py on one session'''
+
+    def __init__(self, session):
+        self.session = session
+
+    def __call__(self, name, *args, **kwargs):
+        if name == 'add_to_stock':
+            # aio.add_to_stock() never asks for the expiry date
+            kwargs.setdefault('interactive', False)
+        return getattr(main, name)(self.session, *args, **kwargs)
+
+
+class AsyncLayer:
+    '''Calls the functions of aio.py on one session, waiting for each on the event loop'''
+
+    def __init__(self, loop, session):
+        self.loop = loop
+        self.session = session
+
+    def __call__(self, name, *args, **kwargs):
+        return self.loop.run_until_complete(getattr(aio, name)(self.session, *args, **kwargs))
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest.fixture
+def session_factory(database, loop):
+    '''aio's session factory, bound to the new database'''
+    factory = loop.run_until_complete(aio.db_init(database))
+    yield factory
+    loop.run_until_complete(factory.kw['bind'].dispose())
+
+
+@pytest.fixture(params=['main', 'aio'])
+def layer(request):
+    if request.param == 'main':
+        yield SyncLayer(request.getfixturevalue('session'))
+    else:
+        loop = request.getfixturevalue('loop')
+        session = request.getfixturevalue('session_factory')()
+        yield AsyncLayer(loop, session)
+        loop.run_until_complete(session.close())
+
+
+def test_add_item(layer):
+    item, created = layer('add_item', 'milk', 'beverages', min_limit=2)
+    assert created
+    assert (item.name, item.group_id, item.type_id, item.min_limit) == ('Milk', BEVERAGES, None, 2)
+
+    again, created = layer('add_item', 'Milk', 'Beverages', min_limit=3)
+    assert not created
+    assert (again.id, again.min_limit) == (item.id, 3)
+
+
+def test_add_item_natural_key(layer):
+    item, _ = layer('add_item', 'Milk', 'beverages')
+    other_group, created = layer('add_item', 'Milk', 'meat')
+    assert created
+    assert other_group.id != item.id and other_group.group_id == MEAT
+    canned, created = layer('add_item', 'Milk', 'beverages', container='can')
+    assert created
+    assert canned.id not in (item.id, other_group.id) and canned.type_id == CAN
+
+
+def test_add_to_stock(layer):
+    item, _ = layer('add_item', 'Milk', 'beverages')
+    expiry = TODAY + dt.timedelta(5)
+    row = layer('add_to_stock', item.id, FRIDGE, 3, expiration_date=expiry)
+    assert (row.item_id, row.location_id, row.portions, row.expiration_date) == (item.id, FRIDGE, 3, expiry)
+    assert layer('stock_view') == [main.StockRow(row.id, item.id, 'Milk', None, 'Fridge', 3, TODAY, expiry)]
+
+
+def test_add_to_stock_unknown_item(layer):
+    with pytest.raises(ValueError):
+        layer('add_to_stock', 12345, FRIDGE, 1)
+
+
+def test_remove_from_stock(layer):
+    item, _ = layer('add_item', 'Milk', 'beverages')
+    later = layer('add_to_stock', item.id, PANTRY, 5, expiration_date=TODAY + dt.timedelta(10))
+    sooner = layer('add_to_stock', item.id, FRIDGE, 3, expiration_date=TODAY + dt.timedelta(2))
+
+    plan = layer('remove_from_stock', item.id, 4)
+    assert plan == [main.Allocation(sooner.id, FRIDGE, TODAY + dt.timedelta(2), 3, 0),
+                    main.Allocation(later.id, PANTRY, TODAY + dt.timedelta(10), 1, 4)]
+    assert [(row.storage_id, row.portions) for row in layer('stock_view')] == [(later.id, 4)]
+    assert layer('check_item_stock') == []
+
+
+def test_stock_view(layer):
+    milk, _ = layer('add_item', 'Milk', 'beverages')
+    beans, _ = layer('add_item', 'Beans', 'vegetables', container='can')
+    layer('add_to_stock', milk.id, FRIDGE, 2, expiration_date=TODAY - dt.timedelta(1))
+    layer('add_to_stock', beans.id, PANTRY, 6)
+
+    assert [(row.item, row.container, row.location) for row in layer('stock_view')] == [
+        ('Beans', 'Can', 'Pantry'), ('Milk', None, 'Fridge')]
+    assert [row.item for row in layer('stock_view', expired=True)] == ['Milk']
+    assert [row.item for row in layer('stock_view', location_id=PANTRY)] == ['Beans']
+    grouped = layer('stock_view', group_by='location')
+    assert {location: [row.item for row in rows] for location, rows in grouped.items()} == {
+        'Fridge': ['Milk'], 'Pantry': ['Beans']}
+
+
+def test_stock_as_of(layer):
+    item, _ = layer('add_item', 'Milk', 'beverages')
+    layer('add_to_stock', item.id, FRIDGE, 3)
+    layer('add_to_stock', item.id, PANTRY, 2)
+    layer('remove_from_stock', item.id, 1, strategy='location', location_id=PANTRY)
+
+    assert layer('stock_as_of', TODAY) == {(item.id, FRIDGE): 3, (item.id, PANTRY): 1}
+    assert layer('stock_as_of', TODAY, location_id=FRIDGE) == {(item.id, FRIDGE): 3}
+    assert layer('stock_as_of', TODAY - dt.timedelta(1)) == {}
+
+
+def test_async_sessions_share_changes(session_factory, loop):
+    '''A change made through run_sync in one session is committed and seen by the others'''
+    async def scenario():
+        async with session_factory() as writer, session_factory() as reader:
+            item, _ = await aio.add_item(writer, 'Milk', 'beverages')
+            assert await aio.stock_view(reader) == []
+            await aio.add_to_stock(writer, item.id, FRIDGE, 3)
+            return item.id, await aio.stock_view(reader, item_id=item.id)
+
+    item_id, rows = loop.run_until_complete(scenario())
+    assert [(row.item_id, row.portions) for row in rows] == [(item_id, 3)]
+
+
+def test_async_concurrent_readers(session_factory, loop):
+    '''Readers on sessions of their own run at the same time and get the same rows'''
+    async def read(item_id):
+        async with session_factory() as session:
+            counts = await aio.list_items_with_stock_count(session, item_id)
+            return (await aio.stock_view(session), [(item.id, count) for item, count in counts],
+                    await aio.stock_as_of(session, TODAY))
+
+    async def scenario():
+        async with session_factory() as session:
+            item, _ = await aio.add_item(session, 'Milk', 'beverages', min_limit=5)
+            await aio.add_to_stock(session, item.id, FRIDGE, 3)
+        return await asyncio.gather(*[read(item.id) for _ in range(8)])
+
+    results = loop.run_until_complete(scenario())
+    views, counts, stock = results[0]
+    assert [row.portions for row in views] == [3]
+    assert [count for _, count in counts] == [3]
+    assert sum(stock.values()) == 3
+    assert all(result == results[0] for result in results)
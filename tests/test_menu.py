@@ -0,0 +1,24 @@
+'''
+The interactive screens, driven by scripted answers
+'''
+import main
+
+FRIDGE = 2
+
+
+def _answer(monkeypatch, *answers):
+    monkeypatch.setitem(main._console, 'input', main._scripted_input(list(answers)))
+    monkeypatch.setitem(main._console, 'clear', False)
+
+
+def test_remove_keeps_the_corrected_count(session, monkeypatch):
+    '''A correction entered after a removal is committed, not rolled back when the session closes'''
+    milk, _ = main.add_item(session, 'Milk', 'beverages')
+    main.add_to_stock(session, milk.id, FRIDGE, 5, interactive=False)
+
+    # Remove 2 of item milk, then correct the 3 left to 4
+    _answer(monkeypatch, str(milk.id), '2', '4')
+    assert main.interactive_remove_from_stock(session) == main.MAIN
+    session.rollback()
+    assert main._get_portions_by_item(session, milk.id) == 4
+    assert main.check_item_stock(session) == []
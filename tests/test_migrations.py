@@ -0,0 +1,19 @@
+'''
+The schema migrations on a database from before them
+'''
+import sqlalchemy as db
+import main
+from models import Item
+
+
+def test_migration_1_keeps_newest_duplicate(session):
+    '''Updates used to insert a new item row, the newest one has the values entered last'''
+    connection = session.connection()
+    connection.execute(db.text('DROP INDEX uq_item_natural_key'))
+    connection.execute(db.text("INSERT INTO item (name, group_id, type_id, min_limit) VALUES "
+                               "('Milk', 2, NULL, 1), ('Milk', 2, NULL, 5), ('Milk', 2, 1, 3), ('Milk', 2, 1, 4)"))
+    connection.execute(db.text("UPDATE app_meta SET value = '0' WHERE key = 'schema_version'"))
+    session.commit()
+
+    main._migrate(session)
+    assert session.query(Item.id, Item.type_id, Item.min_limit).order_by(Item.id).all() == [(2, None, 5), (4, 1, 4)]
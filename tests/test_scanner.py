@@ -0,0 +1,40 @@
+'''
+Scan ingestion from a scanner that pauses between scans
+'''
+import time
+import queue
+import main
+import scanner
+from cache import barcode_index
+
+
+class CountingQueue(queue.Queue):
+    '''A queue counting the waits for the next scan'''
+    waits = 0
+
+    def get(self, *args, **kwargs):
+        CountingQueue.waits += 1
+        return super().get(*args, **kwargs)
+
+
+def _paused(*lines, pause):
+    '''The lines, with a pause before each but the first'''
+    for number, line in enumerate(lines):
+        if number:
+            time.sleep(pause)
+        yield line
+
+
+def test_window_zero_waits_for_scans(session, tmp_path, monkeypatch):
+    milk, _ = main.add_item(session, 'Milk', 'beverages', barcode='5701234567890')
+    barcode_index.load(session)
+    monkeypatch.setattr(scanner.queue, 'Queue', CountingQueue)
+    CountingQueue.waits = 0
+
+    result = scanner.ingest_scans(session, _paused('fridge:5701234567890', 'fridge:5701234567890 +2', pause=0.3),
+                                  window=0, quarantine=str(tmp_path / 'quarantine.txt'))
+    assert (result['scans'], result['added'], result['quarantined']) == (2, 3, 0)
+    # Each pause is a few waits of MIN_WAIT, committing the scan before it, not a busy loop
+    assert result['commits'] == 2
+    assert CountingQueue.waits < 30
+    assert main._get_portions_by_item(session, milk.id) == 3
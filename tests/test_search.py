@@ -0,0 +1,92 @@
+'''
+The trigram search index, kept up to date by the session events
+'''
+import threading
+import pytest
+import sqlalchemy as db
+import main
+from models import Item
+from search import SearchIndex, search_index
+
+
+@pytest.fixture
+def index(session, monkeypatch):
+    '''The loaded index, failing the test if it is loaded again'''
+    main.add_item(session, 'Milk', 'beverages', name_dk='Mælk')
+    main.add_item(session, 'Beans', 'vegetables', name_dk='Bønner')
+    search_index.load(session)
+
+    def reload(session):
+        raise AssertionError('the whole index was loaded again')
+    monkeypatch.setattr(search_index, 'load', reload)
+    yield search_index
+    search_index.clear()
+
+
+def _names(session, text):
+    return [name for _, name, _, _ in search_index.search(session, text)]
+
+
+def test_search_names(session, index):
+    assert _names(session, 'mil') == ['Milk']
+    assert _names(session, 'bonner') == ['Beans']
+    assert _names(session, 'bens') == ['Beans']
+
+
+def test_add_item_is_added(session, index):
+    '''add_item() inserts through a bulk upsert'''
+    main.add_item(session, 'Milkshake', 'beverages')
+    assert _names(session, 'milk') == ['Milk', 'Milkshake']
+
+
+def test_orm_rename(session, index):
+    milk = session.query(Item).filter(Item.name == 'Milk').one()
+    milk.name = 'Oat milk'
+    session.commit()
+    assert _names(session, 'oat') == ['Oat milk']
+
+
+def test_bulk_update_and_delete(session, index):
+    milk = session.query(Item.id).filter(Item.name == 'Milk').scalar()
+    session.execute(db.update(Item), [{'id': milk, 'name': 'Oat milk'}])
+    session.commit()
+    assert _names(session, 'oat') == ['Oat milk']
+
+    session.query(Item).filter(Item.name == 'Beans').delete(synchronize_session=False)
+    session.commit()
+    assert _names(session, 'beans') == []
+
+
+def test_rolled_back_changes_are_not_indexed(session, index):
+    session.execute(db.insert(Item), [{'name': 'Butter', 'group_id': 1}])
+    session.rollback()
+    assert _names(session, 'butter') == []
+
+
+def test_concurrent_searches_and_changes():
+    '''Searches in other threads (e.g. the requests of server.py) never see an item halfway through a change'''
+    index = SearchIndex()
+    for item_id in range(500):
+        index.add(item_id, f'Item {item_id}')
+    index.loaded = True
+    stop = threading.Event()
+    errors = []
+
+    def searching():
+        try:
+            while not stop.is_set():
+                index.search(None, 'item 12')
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=searching) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for n in range(20000):
+        item_id = n % 500
+        index.remove(item_id)
+        index.add(item_id, f'Item {item_id} v{n}')
+    stop.set()
+    for thread in threads:
+        thread.join()
+    assert errors == []
@@ -0,0 +1,92 @@
+'''
+A single writer thread, so the writes of one process never wait for each other's database locks
+
+SQLite allows one writer at a time. When several threads write through their own connections they queue up
+on the file lock (or fail with 'database is locked' once the busy timeout runs out), while readers in WAL mode
+carry on regardless. Sending every write through one 'WriteQueue' runs them one after the other on one
+connection instead, and readers keep using their own sessions in parallel.
+'''
+import queue
+import logging
+import threading
+from concurrent.futures import Future
+
+# Tells the writer thread to stop
+_STOP = object()
+
+
+class WriteQueue:
+    '''
+    Runs the submitted write functions one at a time on a thread of its own, each in its own transaction
+
+    A function is called with a new session (from session_factory) and its arguments; it is committed when the
+    function returns and rolled back when it raises. The result or exception is passed back through a Future.
+    '''
+
+    def __init__(self, session_factory, name='pai-writer'):
+        self._session_factory = session_factory
+        self._name = name
+        self._jobs = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.written = 0
+        self.failed = 0
+
+    def start(self):
+        '''Start the writer thread (also done by the first 'submit()')'''
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._work, name=self._name, daemon=True)
+                self._thread.start()
+        return self
+
+    def submit(self, function, *args, **kwargs):
+        '''
+        Queue function(session, *args, **kwargs) for the writer thread
+
+        Returns:
+            A Future with the result of the function
+        '''
+        if self._thread is None:
+            self.start()
+        future = Future()
+        self._jobs.put((future, function, args, kwargs))
+        return future
+
+    def run(self, function, *args, **kwargs):
+        '''Queue function like 'submit()' and wait for its result (or exception)'''
+        return self.submit(function, *args, **kwargs).result()
+
+    def pending(self):
+        '''The number of writes waiting for the writer thread'''
+        return self._jobs.qsize()
+
+    def stop(self):
+        '''Finish the queued writes and stop the writer thread'''
+        if self._thread is not None:
+            self._jobs.put(_STOP)
+            self._thread.join()
+            self._thread = None
+
+    def _work(self):
+        while True:
+            job = self._jobs.get()
+            if job is _STOP:
+                return
+            future, function, args, kwargs = job
+            if not future.set_running_or_notify_cancel():
+                continue
+            session = self._session_factory()
+            try:
+                result = function(session, *args, **kwargs)
+                session.commit()
+            except BaseException as e:
+                session.rollback()
+                self.failed += 1
+                logging.debug("Write %s failed: %r", function.__name__, e)
+                future.set_exception(e)
+            else:
+                self.written += 1
+                future.set_result(result)
+            finally:
+                session.close()